@@ -221,7 +221,7 @@ def run_eval_tasks(args):
         model_path = kwargs.pop("model_path")
         
         from nexa.eval.nexa_eval import NexaEval
-        evaluator = NexaEval(model_path, args.tasks, args.limit, args.nctx, args.num_workers)
+        evaluator = NexaEval(model_path, args.tasks, args.limit, args.nctx, args.num_workers, args.response_cache)
         if not args.tasks:
             evaluator.run_perf_eval(args.device, args.new_tokens)
         else:
@@ -239,6 +239,7 @@ def run_embedding_generation(args):
     hf = kwargs.pop('huggingface', False)
     normalize = kwargs.pop('normalize', False)
     no_truncate = kwargs.pop('no_truncate', False)
+    embedding_cache = kwargs.pop('embedding_cache', False)
 
     local_path = None
     if is_local_path or hf:
@@ -254,7 +255,7 @@ def run_embedding_generation(args):
 
     try:
         from nexa.gguf.nexa_inference_text import NexaTextInference
-        inference = NexaTextInference(model_path=model_path, local_path=local_path, embedding=True)
+        inference = NexaTextInference(model_path=model_path, local_path=local_path, embedding=True, embedding_cache=embedding_cache)
         embedding = inference.create_embedding(prompt, normalize=normalize, truncate=not no_truncate)
         print({"embedding": embedding})
     except Exception as e:
@@ -332,6 +333,8 @@ def main():
     text_group.add_argument("-sw", "--stop_words", nargs="*", help="List of stop words for early stopping")
     text_group.add_argument("--lora_path", type=str, help="Path to a LoRA file to apply to the model.")
     text_group.add_argument("--nctx", type=int, default=2048, help="Maximum context length of the model you're using")
+    text_group.add_argument("--draft_model", type=str, help="Path or identifier of a small model with the same vocabulary to draft tokens for speculative decoding")
+    text_group.add_argument("--draft_tokens", type=int, default=8, help="Number of tokens drafted per step for speculative decoding")
 
     # Image generation arguments
     image_group = run_parser.add_argument_group('Image generation options')
@@ -394,6 +397,7 @@ def main():
     embed_parser.add_argument("-hf", "--huggingface", action="store_true", help="Load model from Hugging Face Hub")
     embed_parser.add_argument("-n", "--normalize", action="store_true", help="Normalize the embeddings")
     embed_parser.add_argument("-nt", "--no_truncate", action="store_true", help="Not truncate the embeddings")
+    embed_parser.add_argument("--embedding_cache", action="store_true", help="Store computed embeddings on disk and reuse them for repeated inputs")
 
     # Convert command
     convert_parser = subparsers.add_parser("convert", help="Convert and quantize a Hugging Face model to GGUF format.")
@@ -433,6 +437,13 @@ def main():
     server_parser.add_argument("--port", type=int, default=8000, help="Port to bind the server to")
     server_parser.add_argument("--reload", action="store_true", help="Enable automatic reloading on code changes")
     server_parser.add_argument("--nctx", type=int, default=2048, help="Maximum context length of the model you're using")
+    server_parser.add_argument("--prompt_cache", action="store_true", help="Cache KV state of recent prompts in RAM to skip re-evaluating shared prefixes")
+    server_parser.add_argument("--embedding_cache", action="store_true", help="Store computed embeddings on disk and reuse them for repeated inputs")
+    server_parser.add_argument("--n_parallel", type=int, default=1, help="Number of text generation requests decoded together (continuous batching)")
+    server_parser.add_argument("--max_queue_size", type=int, default=64, help="Maximum number of queued requests before new ones are rejected with 429")
+    server_parser.add_argument("--request_timeout", type=float, help="Seconds before a request times out with 504, including time spent queued")
+    server_parser.add_argument("--draft_model", type=str, help="Path or identifier of a small model with the same vocabulary to draft tokens for speculative decoding")
+    server_parser.add_argument("--draft_tokens", type=int, default=8, help="Number of tokens drafted per step for speculative decoding")
 
     # Other commands
     pull_parser = subparsers.add_parser("pull", help="Pull a model from official or hub.")
@@ -458,6 +469,7 @@ def main():
     general_eval_group.add_argument("--limit", type=float, help="Limit the number of examples per task. If <1, limit is a percentage of the total number of examples.", default=None)
     general_eval_group.add_argument("--num_workers", type=int, help="Number of workers to use for evaluation", default=1)
     general_eval_group.add_argument("--nctx", type=int, help="Length of context window", default=4096)
+    general_eval_group.add_argument("--response_cache", action="store_true", help="Cache model responses on disk and reuse them when evaluating the same model again")
 
     # Performance evaluation options
     perf_eval_group = eval_parser.add_argument_group('Performance evaluation options')
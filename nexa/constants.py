@@ -7,9 +7,12 @@ NEXA_CACHE_ROOT = Path(os.getenv("NEXA_CACHE_ROOT") or "~/.cache/nexa").expandus
 NEXA_TOKEN_PATH = NEXA_CACHE_ROOT / "token"
 NEXA_MODELS_HUB_DIR = NEXA_CACHE_ROOT / "hub"
 NEXA_MODEL_EVAL_RESULTS_PATH = NEXA_CACHE_ROOT / "eval"
+NEXA_EMBEDDING_CACHE_DIR = NEXA_CACHE_ROOT / "embeddings"
+NEXA_EVAL_RESPONSE_CACHE_DIR = NEXA_CACHE_ROOT / "eval_responses"
 NEXA_MODELS_HUB_OFFICIAL_DIR = NEXA_MODELS_HUB_DIR / "official"
 NEXA_MODELS_HUB_HF_DIR = NEXA_MODELS_HUB_DIR / "huggingface"
 NEXA_MODEL_LIST_PATH = NEXA_MODELS_HUB_DIR / "model_list.json"
+NEXA_MODEL_REGISTRY_PATH = NEXA_MODELS_HUB_DIR / "model_registry.db"
 
 # URLs and buckets
 NEXA_API_URL = "https://model-hub-backend.nexa4ai.com"
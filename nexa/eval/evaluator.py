@@ -6,10 +6,14 @@ from collections import defaultdict
 from typing import TYPE_CHECKING, List, Optional, Union
 import multiprocessing
 import queue
+from pathlib import Path
 import numpy as np
 from tqdm import tqdm
 
 from nexa import __version__
+from nexa.constants import NEXA_EMBEDDING_CACHE_DIR, NEXA_EVAL_RESPONSE_CACHE_DIR
+from nexa.general import pull_model
+from nexa.gguf.llama.llama_cache import LlamaEmbeddingCache
 import nexa.eval.nexa_task.metrics
 import nexa.eval.nexa_task.registry
 from nexa.eval.nexa_task.task import Task
@@ -27,6 +31,7 @@ from nexa.eval.nexa_task.task_manager import (
     get_task_dict,
 )
 from nexa.eval.utils import (
+    ResponseCache,
     eval_logger,
     handle_non_serializable,
     hash_string,
@@ -36,7 +41,7 @@ if TYPE_CHECKING:
     from nexa.eval.nexa_task.task import Task
 
 # Define the worker function at the global scope
-def worker(task_queue, result_queue, stop_event, model_path):
+def worker(task_queue, result_queue, stop_event, model_path, n_threads, n_threads_batch):
     # Disable tqdm in worker processes
     import sys
     import os
@@ -46,25 +51,60 @@ def worker(task_queue, result_queue, stop_event, model_path):
     sys.stdout = open(os.devnull, 'w')
     sys.stderr = open(os.devnull, 'w')
 
-    # Initialize the model in each process
-    lm_worker = GGUFLM(model_path)
+    # Initialize the model in each process. Weights are mmap'd, so workers
+    # share them through the page cache, and each worker gets its own slice
+    # of the CPU threads instead of every worker using all cores.
+    lm_worker = GGUFLM(model_path, n_threads=n_threads, n_threads_batch=n_threads_batch)
     while not stop_event.is_set():
         try:
             item = task_queue.get(timeout=0.1)
             if item is None:
                 task_queue.task_done()
                 break  # Received sentinel value, exit loop
-            idx, req = item
-            # Process the request
-            reqtype = req.request_type
-            resps = getattr(lm_worker, reqtype)([req])
-            # Put the response in the result queue
-            result_queue.put((idx, resps[0]))
+            reqtype, batch = item
+            idxs = [idx for idx, _ in batch]
+            try:
+                # Process the batch of requests
+                resps = getattr(lm_worker, reqtype)([req for _, req in batch])
+            except Exception as e:
+                resps = e
+            # Put the responses in the result queue
+            result_queue.put((idxs, resps))
             task_queue.task_done()
         except queue.Empty:
             continue
-        except Exception as e:
-            task_queue.task_done()
+
+
+def _make_batches(indexed_requests, num_workers, max_batch_size=64):
+    """Split requests into batches of a single request type, longest first.
+
+    Requests are sorted by the length of their first argument so long
+    requests are dispatched early and balance out across workers, and
+    requests sharing a context stay together so a worker scores the context
+    once.
+    """
+    reqs_by_type = defaultdict(list)
+    for idx, req in indexed_requests:
+        reqs_by_type[req.request_type].append((idx, req))
+
+    # Aim for several batches per worker so the tail stays short
+    batch_size = max(
+        1, min(max_batch_size, len(indexed_requests) // (4 * num_workers))
+    )
+    batches = []
+    for reqtype, reqs in reqs_by_type.items():
+        reqs.sort(key=lambda x: (-len(x[1].args[0]), x[1].args[0]))
+        batch = []
+        for idx, req in reqs:
+            # Only close a batch where the context changes
+            if len(batch) >= batch_size and batch[-1][1].args[0] != req.args[0]:
+                batches.append((reqtype, batch))
+                batch = []
+            batch.append((idx, req))
+        if batch:
+            batches.append((reqtype, batch))
+    batches.sort(key=lambda x: -len(x[1][0][1].args[0]))
+    return batches
 
 def nexa_evaluate(
     model_path,
@@ -78,6 +118,7 @@ def nexa_evaluate(
     numpy_random_seed: int = 1234,
     fewshot_random_seed: int = 1234,
     num_workers: int = 1,
+    response_cache: bool = False,
 ):
     eval_logger.setLevel(getattr(logging, f"{verbosity}"))
     start_date = time.time()
@@ -137,70 +178,119 @@ def nexa_evaluate(
         idx_to_req[idx] = req
         indexed_requests.append((idx, req))
 
-    # Run LM on inputs, get all outputs
-    if num_workers == 1:
-        # Without multiprocessing
-        lm = GGUFLM(model_path)
-        eval_logger.info(f"Running requests with a single worker")
-        reqs_by_type = defaultdict(list)
+    # Reuse the responses cached by earlier runs of the same model file
+    cache = None
+    idx_to_key = {}
+    pending = indexed_requests
+    if response_cache:
+        local_path, _ = pull_model(model_path)
+        # The embedding cache remembers file digests by path, size and mtime,
+        # so the model file is only read on the first run
+        model_hash = LlamaEmbeddingCache(str(NEXA_EMBEDDING_CACHE_DIR)).model_hash(local_path)
+        cache = ResponseCache(
+            Path(NEXA_EVAL_RESPONSE_CACHE_DIR) / f"{model_hash}.jsonl"
+        )
+        occurrences = defaultdict(int)
+        pending = []
         for idx, req in indexed_requests:
-            reqs_by_type[req.request_type].append((idx, req))
-        for reqtype, reqs in reqs_by_type.items():
-            idxs, reqs_only = zip(*reqs)
-            resps = getattr(lm, reqtype)(reqs_only)
-            for idx, x in zip(idxs, resps):
-                req = idx_to_req[idx]
-                req.resps.append(x)
-    else:
-        # Multiprocessing logic
-        # Define the task queue, result queue, and stop event
-        task_queue = multiprocessing.JoinableQueue()
-        result_queue = multiprocessing.Queue()
-        stop_event = multiprocessing.Event()
-
-        # Add all requests to the task queue
-        for item in indexed_requests:
-            task_queue.put(item)
-
-        # Add sentinel values to stop workers
-        for _ in range(num_workers):
-            task_queue.put(None)
-
-        # Start worker processes
-        processes = []
-        for _ in range(num_workers):
-            p = multiprocessing.Process(
-                target=worker,
-                args=(task_queue, result_queue, stop_event, model_path),
+            # Repeats of an instance are cached separately
+            key = ResponseCache.key(req.request_type, req.args, occurrences[id(req)])
+            occurrences[id(req)] += 1
+            idx_to_key[idx] = key
+            if key in cache:
+                req.resps.append(cache.get(key))
+            else:
+                pending.append((idx, req))
+        eval_logger.info(
+            f"Reusing {len(indexed_requests) - len(pending)} cached responses, {len(pending)} requests to run"
+        )
+
+    def store(idxs, resps):
+        for idx, resp in zip(idxs, resps):
+            idx_to_req[idx].resps.append(resp)
+            if cache is not None:
+                cache.put(idx_to_key[idx], resp)
+        if cache is not None:
+            cache.flush()
+
+    # Run LM on inputs, get all outputs
+    try:
+        if pending and num_workers == 1:
+            # Without multiprocessing
+            lm = GGUFLM(model_path)
+            eval_logger.info(f"Running requests with a single worker")
+            # Run in batches so responses are stored as they complete
+            with tqdm(total=len(pending)) as pbar:
+                for reqtype, batch in _make_batches(pending, 1):
+                    idxs, reqs_only = zip(*batch)
+                    resps = getattr(lm, reqtype)(reqs_only, disable_tqdm=True)
+                    store(idxs, resps)
+                    pbar.update(len(batch))
+        elif pending:
+            # Multiprocessing logic
+            # Partition the CPU threads between the workers
+            n_cpus = multiprocessing.cpu_count()
+            n_threads_batch = max(n_cpus // num_workers, 1)
+            n_threads = max(n_threads_batch // 2, 1)
+            eval_logger.info(
+                f"Running requests with {num_workers} workers, {n_threads_batch} threads each"
             )
-            p.start()
-            processes.append(p)
 
-        # Create progress bar in the main process
-        pbar = tqdm(total=len(requests))
+            # Define the task queue, result queue, and stop event
+            task_queue = multiprocessing.JoinableQueue()
+            result_queue = multiprocessing.Queue()
+            stop_event = multiprocessing.Event()
+
+            # Add the request batches to the task queue, longest first
+            for item in _make_batches(pending, num_workers):
+                task_queue.put(item)
+
+            # Add sentinel values to stop workers
+            for _ in range(num_workers):
+                task_queue.put(None)
 
-        # Collect results and update progress bar
-        results_received = 0
-        total_results = len(requests)
-        while results_received < total_results:
+            # Start worker processes
+            processes = []
+            for _ in range(num_workers):
+                p = multiprocessing.Process(
+                    target=worker,
+                    args=(task_queue, result_queue, stop_event, model_path, n_threads, n_threads_batch),
+                )
+                p.start()
+                processes.append(p)
+
+            # Create progress bar in the main process
+            pbar = tqdm(total=len(pending))
+
+            # Collect results and update progress bar
+            results_received = 0
+            total_results = len(pending)
             try:
-                # Get result from result queue
-                idx, resp = result_queue.get(timeout=1)
-                req = idx_to_req[idx]
-                req.resps.append(resp)
-                results_received += 1
-                pbar.update(1)
-            except queue.Empty:
-                continue
-            except Exception:
-                continue
-            
-        pbar.close()
-
-        # Ensure all processes have finished
-        stop_event.set()
-        for p in processes:
-            p.join()
+                while results_received < total_results:
+                    try:
+                        # Get a batch of results from the result queue
+                        idxs, resps = result_queue.get(timeout=1)
+                    except queue.Empty:
+                        if not any(p.is_alive() for p in processes):
+                            raise RuntimeError("All evaluation workers exited before finishing")
+                        continue
+                    if isinstance(resps, Exception):
+                        raise resps
+                    store(idxs, resps)
+                    results_received += len(idxs)
+                    pbar.update(len(idxs))
+            finally:
+                pbar.close()
+
+                # Ensure all processes have finished
+                stop_event.set()
+                for p in processes:
+                    if results_received < total_results:
+                        p.terminate()
+                    p.join()
+    finally:
+        if cache is not None:
+            cache.close()
 
     # Postprocess outputs
     for task_output in eval_tasks:
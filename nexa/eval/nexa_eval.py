@@ -25,7 +25,7 @@ from nexa.eval.nexa_perf import (
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class NexaEval:
-    def __init__(self, model_path: str, tasks: str = None, limit: float = None, nctx: int = None, num_workers: int = None):
+    def __init__(self, model_path: str, tasks: str = None, limit: float = None, nctx: int = None, num_workers: int = None, response_cache: bool = False):
         model_path = NEXA_RUN_MODEL_MAP.get(model_path, model_path)
         self.model_path = model_path
         
@@ -43,6 +43,7 @@ class NexaEval:
             "tasks": self.tasks,
             "limit": self.limit,
             "num_workers": self.num_workers,
+            "response_cache": response_cache,
             "output_path": str(output_path),
             "include_path": None,
             "verbosity": "INFO",
@@ -68,6 +69,7 @@ class NexaEval:
                 model_path=args.model_path,
                 limit=args.limit,
                 num_workers=args.num_workers,
+                response_cache=args.response_cache,
                 tasks=task_names,
                 task_manager=task_manager
             )
@@ -12,7 +12,7 @@ class GGUFLM:
     def __init__(self, model_path=None, **kwargs):
         if model_path is None:
             raise ValueError("model_path must be provided.")
-        self.model = NexaTextInference(model_path)
+        self.model = NexaTextInference(model_path, **kwargs)
         self.logprobs = 10
         self.temperature = 0
 
@@ -37,33 +37,46 @@ class GGUFLM:
         except Exception as e:
             logger.error(f"Unexpected error occured: {e}")
 
+    def _encode_pair(self, context, continuation):
+        # Move trailing whitespace of the context to the continuation so the
+        # continuation tokens match the tokenization of the whole string
+        n_spaces = len(context) - len(context.rstrip())
+        if n_spaces > 0:
+            continuation = context[-n_spaces:] + continuation
+            context = context[:-n_spaces]
+        llama = self.model.model
+        whole_enc = llama.tokenize((context + continuation).encode("utf-8"))
+        context_enc = llama.tokenize(context.encode("utf-8"))
+        if not context_enc:
+            context_enc = [llama.token_bos()]
+            whole_enc = context_enc + whole_enc
+        # Split the whole encoding, a token merged across the boundary then
+        # belongs to the context as in lm-eval
+        context_enc_len = len(context_enc)
+        context_enc = whole_enc[:context_enc_len]
+        continuation_enc = whole_enc[context_enc_len:]
+        return context_enc, continuation_enc
+
     def loglikelihood(self, requests, disable_tqdm: bool = False):
         if not requests:
             return []
-        res = []
-        for context, continuation in tqdm(
-            [req.args for req in requests], disable=disable_tqdm
-        ):
-            response = self.gguf_completion(context=context, continuation=continuation)
-            if response and "choices" in response and response["choices"]:
-                choice = response["choices"][0]
-                logprobs = choice.get("logprobs")
-                if (
-                    logprobs
-                    and "token_logprobs" in logprobs
-                    and logprobs["token_logprobs"]
-                ):
-                    logprob, is_greedy = self.get_result(logprobs, len(context))
-                    res.append((logprob, is_greedy))
-                else:
-                    logger.warning(
-                        "Invalid logprobs data. Expected 'logprobs' to contain 'token_logprobs' list."
-                    )
-            else:
-                logger.error(
-                    f"Invalid response for loglikelihood. Response: {response}"
+        # Group the requests by context so each context is evaluated once,
+        # sorted so consecutive contexts share the longest prefix
+        groups = {}
+        for i, (context, continuation) in enumerate(req.args for req in requests):
+            context_enc, continuation_enc = self._encode_pair(context, continuation)
+            groups.setdefault(tuple(context_enc), []).append((i, continuation_enc))
+
+        res = [None] * len(requests)
+        with tqdm(total=len(requests), disable=disable_tqdm) as pbar:
+            for context_enc in sorted(groups):
+                group = groups[context_enc]
+                results = self.model.model.loglikelihood(
+                    context_enc, [continuation_enc for _, continuation_enc in group]
                 )
-                assert False
+                for (i, _), result in zip(group, results):
+                    res[i] = result
+                pbar.update(len(group))
         return res
 
     def generate_until(self, requests, disable_tqdm: bool = False):
@@ -91,25 +104,3 @@ class GGUFLM:
                 logger.error(f"Invalid response for greedy_until. Response: {response}")
                 res.append(None)  # Add default value in case of error
         return res
-
-
-    def get_result(self, logprobs, context_length):
-        is_greedy = True
-        offsets = logprobs["text_offset"]
-        tokens = logprobs["tokens"]
-        tokens_logprobs = logprobs["token_logprobs"]
-
-        idx = 0
-        while idx < len(offsets) and offsets[idx] < context_length:
-            idx += 1
-        continuation_logprobs = sum(tokens_logprobs[idx:-1])
-        for i in range(idx, len(tokens)):
-            token = tokens[i]
-            top_tokens = logprobs["top_logprobs"][i]
-            top_token = max(top_tokens.keys(), key=lambda x: top_tokens[x])
-            if top_token != token:
-                is_greedy = False
-                break
-
-        return continuation_logprobs, is_greedy
-    
\ No newline at end of file
@@ -353,16 +353,85 @@ class _bootstrap_internal:
         return res
 
 
-def bootstrap_stderr(f, xs, iters):
-    import multiprocessing as mp
+def _confusion_counts(items):
+    """Per-item indicators of (tp, fp, fn, tn) for binary (gold, pred) items.
 
-    pool = mp.Pool(mp.cpu_count())
+    Returns None unless every label is 0 or 1, sklearn then needs to handle
+    the items itself.
+    """
+    golds, preds = (np.asarray(x) for x in zip(*items))
+    if not (np.isin(golds, (0, 1)).all() and np.isin(preds, (0, 1)).all()):
+        return None
+    golds, preds = golds.astype(bool), preds.astype(bool)
+    return np.stack(
+        [golds & preds, ~golds & preds, golds & ~preds, ~golds & ~preds]
+    ).astype(np.int64)
+
+
+def _bootstrap_f1(items):
+    counts = _confusion_counts(items)
+    if counts is None:
+        return None
+
+    def f(idx):
+        tp, fp, fn, _ = (c[idx].sum(axis=1) for c in counts)
+        denom = 2 * tp + fp + fn
+        return np.divide(2 * tp, denom, out=np.zeros(len(idx)), where=denom > 0)
+
+    return f
+
+
+def _bootstrap_mcc(items):
+    counts = _confusion_counts(items)
+    if counts is None:
+        return None
+
+    def f(idx):
+        tp, fp, fn, tn = (c[idx].sum(axis=1).astype(np.float64) for c in counts)
+        denom = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+        return np.divide(
+            tp * tn - fp * fn, denom, out=np.zeros(len(idx)), where=denom > 0
+        )
+
+    return f
+
+
+# bootstrapped metrics whose value on a resample can be computed for a whole
+# matrix of resample indices at once, bleu and ter are corpus-level scores that
+# stay in the process pool
+_vectorized_bootstrap = {
+    f1_score: _bootstrap_f1,
+    matthews_corrcoef: _bootstrap_mcc,
+}
+
+
+def _vectorized_bootstrap_stderr(stat, n, iters, seed=1234):
+    rng = np.random.default_rng(seed)
+    # keep each index matrix at a few million entries
+    chunk_size = max(1, min(iters, (1 << 22) // n))
+    res = np.empty(iters, dtype=np.float64)
+    for start in range(0, iters, chunk_size):
+        stop = min(iters, start + chunk_size)
+        res[start:stop] = stat(rng.integers(0, n, size=(stop - start, n)))
+    return float(np.std(res, ddof=1))
+
+
+def bootstrap_stderr(f, xs, iters):
     # this gives a biased estimate of the stderr (i.e w/ the mean, it gives something
     # equivalent to stderr calculated without Bessel's correction in the stddev.
     # Unfortunately, I haven't been able to figure out what the right correction is
     # to make the bootstrap unbiased - i considered multiplying by sqrt(n/(n-1)) but
     # that would be ad-hoc and I can't prove that that would actually be an unbiased estimator)
     # Thankfully, shouldn't matter because our samples are pretty big usually anyways
+    if f in _vectorized_bootstrap:
+        stat = _vectorized_bootstrap[f](xs)
+        if stat is not None:
+            return _vectorized_bootstrap_stderr(stat, len(xs), iters)
+
+    # opaque metrics are evaluated on each resample in a process pool
+    import multiprocessing as mp
+
+    pool = mp.Pool(mp.cpu_count())
     res = []
     chunk_size = min(1000, iters)
     from tqdm import tqdm
@@ -2,10 +2,12 @@ import collections
 import fnmatch
 import hashlib
 import importlib.util
+import json
 import logging
 import os
 import re
 from itertools import islice
+from pathlib import Path
 
 import numpy as np
 import yaml
@@ -31,6 +33,72 @@ def hash_string(string: str) -> str:
     return hashlib.sha256(string.encode("utf-8")).hexdigest()
 
 
+class ResponseCache:
+    """Append-only store of model responses, keyed by request.
+
+    Every response is written as one JSON line as soon as it is received, so
+    an interrupted run keeps everything computed before it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._responses = {}
+        needs_newline = False
+        if self.path.exists():
+            with self.path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    needs_newline = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # partially written line of an interrupted run
+                    self._responses[record["key"]] = record["resp"]
+        self._file = self.path.open("a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+
+    @staticmethod
+    def key(request_type: str, arguments, occurrence: int = 0) -> str:
+        """Key of the `occurrence`-th identical request of a run."""
+        return hash_string(
+            json.dumps(
+                [request_type, arguments, occurrence],
+                sort_keys=True,
+                default=handle_non_serializable,
+                ensure_ascii=False,
+            )
+        )
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._responses
+
+    def get(self, key: str):
+        resp = self._responses[key]
+        # JSON has no tuples, loglikelihood responses are (logprob, is_greedy)
+        return tuple(resp) if isinstance(resp, list) else resp
+
+    def put(self, key: str, resp) -> None:
+        if resp is None:
+            return  # failed requests are retried on the next run
+        self._responses[key] = resp
+        self._file.write(
+            json.dumps(
+                {"key": key, "resp": resp},
+                default=handle_non_serializable,
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+
+    def flush(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
 def handle_arg_string(arg):
     if arg.lower() == "true":
         return True
@@ -1,19 +1,26 @@
+import base64
 import json
 import logging
+import sqlite3
+import struct
+import contextlib
 from pathlib import Path
 from typing import Tuple
+from urllib.parse import parse_qs, urlparse
 import shutil
 import requests
 import concurrent.futures
 import time
 import os
+import hashlib
+import threading
 from tqdm import tqdm
-import platform
 
 from nexa.constants import (
     NEXA_API_URL,
     NEXA_LOGO,
     NEXA_MODEL_LIST_PATH,
+    NEXA_MODEL_REGISTRY_PATH,
     NEXA_MODELS_HUB_DIR,
     NEXA_MODELS_HUB_OFFICIAL_DIR,
     NEXA_MODELS_HUB_HF_DIR,
@@ -115,6 +122,9 @@ def pull_model(model_path, hf = False, **kwargs):
         else: 
             if is_model_exists(model_path):
                 location, run_type = get_model_info(model_path)
+                if run_type is None:
+                    # Entries imported from model_list.json may lack a run type
+                    run_type = get_run_type_from_metadata(get_model_metadata(model_path))
                 print(f"Model {model_path} already exists at {location}")
                 return location, run_type
 
@@ -277,36 +287,207 @@ def get_model_presigned_link(full_path, token):
         raise
 
 
-def download_chunk(url, start, end, output_file, chunk_number):
+_download_sessions = threading.local()
+
+
+def _get_download_session():
+    """Return the keep-alive session of the calling thread."""
+    session = getattr(_download_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        _download_sessions.session = session
+    return session
+
+
+def download_chunk(url, start, end, output_file, chunk_number, on_progress=None, file_hash=None):
+    """
+    Stream bytes start-end (inclusive) of url into output_file at offset start.
+
+    Returns:
+    tuple: The number of bytes written, the chunk number and the SHA-256 of the chunk.
+    """
     headers = {"Range": f"bytes={start}-{end}"}
+    length = end - start + 1
     max_retries = 3
     for attempt in range(max_retries):
+        written = 0
         try:
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            chunk_file = f"{output_file}.part{chunk_number}"
-            with open(chunk_file, "wb") as f:
-                f.write(response.content)
-            return len(response.content), chunk_number
+            with _get_download_session().get(url, headers=headers, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise requests.RequestException(f"Server ignored the range request for bytes {start}-{end}")
+                sha256 = hashlib.sha256()
+                with open(output_file, "r+b") as f:
+                    f.seek(start)
+                    for data in response.iter_content(chunk_size=1024 * 1024):
+                        if written + len(data) > length:
+                            raise requests.RequestException(f"Received more than {length} bytes for chunk {chunk_number}")
+                        f.write(data)
+                        sha256.update(data)
+                        if file_hash is not None:
+                            file_hash.update(chunk_number, written, data, f)
+                        written += len(data)
+                        if on_progress is not None:
+                            on_progress(len(data))
+                    if written != length:
+                        raise requests.RequestException(f"Received {written} of {length} bytes for chunk {chunk_number}")
+                    # The manifest must never list a chunk that is not on disk
+                    f.flush()
+                    os.fsync(f.fileno())
+            return written, chunk_number, sha256.hexdigest()
         except requests.RequestException as e:
+            if on_progress is not None and written:
+                on_progress(-written)
             if attempt == max_retries - 1:
                 raise
             time.sleep(2 ** attempt)  # Exponential backoff
-            
-            
-def default_use_processes():
+
+
+@contextlib.contextmanager
+def _exclusive_file_lock(lock_path):
+    """Hold an exclusive lock on lock_path, waiting for other processes that hold it."""
+    while True:
+        f = open(lock_path, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass  # LK_LOCK gives up after 10 seconds
+            else:
+                import fcntl
+
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                # The previous holder may have removed the file before we got the lock
+                try:
+                    if os.stat(lock_path).st_ino != os.fstat(f.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+            try:
+                yield
+            finally:
+                if os.name == "nt":
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    # Unlink while still locked so waiters notice and retry on a new file
+                    os.unlink(lock_path)
+            return
+        finally:
+            f.close()
+
+
+def _load_download_manifest(manifest_path, source):
+    """Return the completed chunks recorded for a download of source, if any."""
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("source") == source:
+            return {int(i): digest for i, digest in manifest["chunks"].items()}
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def _save_download_manifest(manifest_path, source, chunks):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"source": source, "chunks": chunks}, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _hash_file_range(f, start, end, *hashes):
+    """Update hashes with bytes start-end (inclusive) of the open file f."""
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = f.read(min(remaining, 8 * 1024 * 1024))
+        if not data:
+            raise ValueError(f"Partial download is truncated at byte {f.tell()}")
+        for sha256 in hashes:
+            sha256.update(data)
+        remaining -= len(data)
+
+
+class _OrderedFileHash:
     """
-    Distinct operating systems may have different default behaviors for threading vs multiprocessing.
+    SHA-256 of a file whose chunks are downloaded concurrently.
+
+    The chunk next in file order streams its bytes into the hash as they are
+    written, only chunks that finish before their turn are read back from disk.
     """
-    platform_name = platform.system()
-    if platform_name == "Linux":
-        return True
-    elif platform_name == "Windows":
-        return False
-    elif platform_name == "Darwin":
-        return False
-    else:
-        return False
+
+    def __init__(self, chunks):
+        self.sha256 = hashlib.sha256()
+        self.chunks = chunks
+        self.next_chunk = 0
+        # Bytes of the next chunk already in the hash
+        self._n_fed = 0
+        self._lock = threading.Lock()
+
+    def update(self, chunk_number, offset, data, f):
+        """Hash data written at offset of the chunk through f, if the chunk is next."""
+        with self._lock:
+            if chunk_number != self.next_chunk:
+                return
+            if self._n_fed < offset:
+                # The chunk became next while downloading, catch up on what it wrote
+                position = f.tell()
+                f.flush()
+                start = self.chunks[chunk_number][0]
+                _hash_file_range(f, start + self._n_fed, start + offset - 1, self.sha256)
+                f.seek(position)
+                self._n_fed = offset
+            # A retried download repeats the bytes it had already streamed
+            if offset + len(data) > self._n_fed:
+                self.sha256.update(memoryview(data)[self._n_fed - offset :])
+                self._n_fed = offset + len(data)
+
+    def skip(self, sha256):
+        """Move past the next chunk, sha256 being the hash that includes it."""
+        with self._lock:
+            self.sha256 = sha256
+            self.next_chunk += 1
+            self._n_fed = 0
+
+    def advance(self, completed, part_path):
+        """Move past the completed chunks that are next, reading back what was not streamed."""
+        with self._lock:
+            f = None
+            try:
+                while self.next_chunk in completed:
+                    start, end = self.chunks[self.next_chunk]
+                    if start + self._n_fed <= end:
+                        if f is None:
+                            f = open(part_path, "rb")
+                        _hash_file_range(f, start + self._n_fed, end, self.sha256)
+                    self.next_chunk += 1
+                    self._n_fed = 0
+            finally:
+                if f is not None:
+                    f.close()
+
+
+def _expected_sha256(headers):
+    """Return the SHA-256 of the whole file advertised in the response headers, if any."""
+    # S3 full object checksum (returned with x-amz-checksum-mode), composite
+    # checksums of multipart uploads end in -<parts> and do not cover the file
+    checksum = headers.get("x-amz-checksum-sha256")
+    if checksum and "-" not in checksum:
+        try:
+            return base64.b64decode(checksum).hex()
+        except ValueError:
+            pass
+    for header in ("x-amz-meta-sha256", "X-Linked-ETag"):
+        value = headers.get(header, "").strip('"').lower()
+        if len(value) == 64 and all(c in "0123456789abcdef" for c in value):
+            return value
+    return None
 
 
 def download_file_with_progress(
@@ -314,86 +495,145 @@ def download_file_with_progress(
     file_path: Path,
     chunk_size: int = 40 * 1024 * 1024,
     max_workers: int = 20,
-    use_processes: bool = default_use_processes(),
+    expected_sha256: str = None,
     **kwargs
 ):
-    file_path.parent.mkdir(parents=True, exist_ok=True)
+    """
+    Download a file with parallel range requests.
 
-    try:
-        response = requests.head(url, timeout=30)
-        response.raise_for_status()
-        file_size = int(response.headers.get("Content-Length", 0))
-        if file_size == 0:
-            raise ValueError("File size is 0 or Content-Length header is missing")
+    Ranges are streamed straight into a preallocated `<file>.part` file over keep-alive
+    sessions. The ranges completed so far are recorded with their SHA-256 in a
+    `<file>.part.json` manifest, so an interrupted download only fetches the missing
+    ranges when run again. Recorded ranges are hashed again before they are reused.
+    Concurrent downloads of the same file wait on a `<file>.part.lock` lock file.
 
-        chunks = [
-            (i, min(i + chunk_size - 1, file_size - 1))
-            for i in range(0, file_size, chunk_size)
-        ]
+    The SHA-256 of the file is computed from the finished ranges in order while the
+    others download. It is checked against expected_sha256, or else a checksum sent by
+    the server, and the download fails on a mismatch.
 
-        progress_bar = tqdm(
-            total=file_size,
-            unit="B",
-            unit_scale=True,
-            desc=file_path.name,
-            unit_divisor=1024,
-        )
+    Returns:
+    str: The SHA-256 of the downloaded file.
+    """
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = Path(f"{file_path}.part")
+    manifest_path = Path(f"{file_path}.part.json")
 
-        start_time = time.time()
+    try:
+        with _exclusive_file_lock(f"{file_path}.part.lock"):
+            return _download_file_locked(
+                url, file_path, part_path, manifest_path, chunk_size, max_workers, expected_sha256
+            )
 
-        executor_class = (
-            concurrent.futures.ProcessPoolExecutor
-            if use_processes
-            else concurrent.futures.ThreadPoolExecutor
-        )
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Error occurred while making the request: {e}")
+    except ValueError as e:
+        raise Exception(f"Error: {e}")
+    except Exception as e:
+        # Keep the partial file and its manifest so the next pull can resume
+        raise Exception(f"An unexpected error occurred: {e}")
 
-        with executor_class(max_workers=max_workers) as executor:
+
+def _download_file_locked(url, file_path, part_path, manifest_path, chunk_size, max_workers, expected_sha256):
+    # Ask S3 for the full object checksum. Presigned URLs must not carry
+    # x-amz headers that were not signed, S3 rejects them with 403.
+    query = {key.lower() for key in parse_qs(urlparse(url).query)}
+    headers = {} if query & {"x-amz-signature", "signature"} else {"x-amz-checksum-mode": "ENABLED"}
+    response = requests.head(url, headers=headers, timeout=30, allow_redirects=True)
+    if response.status_code == 403 and headers:
+        response = requests.head(url, timeout=30, allow_redirects=True)
+    response.raise_for_status()
+    file_size = int(response.headers.get("Content-Length", 0))
+    if file_size == 0:
+        raise ValueError("File size is 0 or Content-Length header is missing")
+    if expected_sha256 is None:
+        expected_sha256 = _expected_sha256(response.headers)
+
+    chunks = [
+        (i, min(i + chunk_size - 1, file_size - 1))
+        for i in range(0, file_size, chunk_size)
+    ]
+
+    # Presigned URLs change between pulls, identify the file by its size and
+    # validators instead. Without a validator a leftover partial file may come
+    # from another revision, so it is never resumed.
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    source = {"size": file_size, "etag": etag, "last_modified": last_modified, "chunk_size": chunk_size}
+    completed = {}
+    file_hash = _OrderedFileHash(chunks)
+    if (etag or last_modified) and part_path.exists() and part_path.stat().st_size == file_size:
+        completed = _load_download_manifest(manifest_path, source)
+        with open(part_path, "rb") as f:
+            for i, digest in sorted(completed.items()):
+                chunk_sha256 = hashlib.sha256()
+                # The leading chunks go into the file hash with the same read
+                if i == file_hash.next_chunk:
+                    file_sha256 = file_hash.sha256.copy()
+                    _hash_file_range(f, *chunks[i], chunk_sha256, file_sha256)
+                else:
+                    file_sha256 = None
+                    _hash_file_range(f, *chunks[i], chunk_sha256)
+                if chunk_sha256.hexdigest() != digest:
+                    del completed[i]
+                elif file_sha256 is not None:
+                    file_hash.skip(file_sha256)
+    if not completed:
+        with open(part_path, "wb") as f:
+            f.truncate(file_size)
+    _save_download_manifest(manifest_path, source, completed)
+
+    progress_bar = tqdm(
+        total=file_size,
+        initial=sum(chunks[i][1] - chunks[i][0] + 1 for i in completed),
+        unit="B",
+        unit_scale=True,
+        desc=file_path.name,
+        unit_divisor=1024,
+    )
+    progress_lock = threading.Lock()
+
+    def on_progress(n):
+        with progress_lock:
+            progress_bar.update(n)
+
+    missing = [i for i in range(len(chunks)) if i not in completed]
+    failed_chunks = []
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
             future_to_chunk = {
                 executor.submit(
-                    download_chunk, url, start, end, str(file_path), i
-                ): (i, start, end)
-                for i, (start, end) in enumerate(chunks)
+                    download_chunk, url, chunks[i][0], chunks[i][1], str(part_path), i, on_progress, file_hash
+                ): i
+                for i in missing
             }
-            
-            completed_chunks = [False] * len(chunks)
+
             for future in concurrent.futures.as_completed(future_to_chunk):
+                chunk_number = future_to_chunk[future]
                 try:
-                    chunk_size, chunk_number = future.result()
-                    completed_chunks[chunk_number] = True
-                    progress_bar.update(chunk_size)
+                    _, chunk_number, digest = future.result()
+                    completed[chunk_number] = digest
+                    _save_download_manifest(manifest_path, source, completed)
                 except Exception as e:
                     print(f"Error downloading chunk {chunk_number}: {e}")
+                    failed_chunks.append(chunk_number)
+                    continue
+                file_hash.advance(completed, part_path)
 
-        progress_bar.close()
+    progress_bar.close()
 
-        if all(completed_chunks):
-            with open(file_path, "wb") as final_file:
-                for i in range(len(chunks)):
-                    chunk_file = f"{file_path}.part{i}"
-                    with open(chunk_file, "rb") as part_file:
-                        final_file.write(part_file.read())
-                    os.remove(chunk_file)
-            
-            end_time = time.time()
-            total_time = end_time - start_time
-            average_speed = file_size / total_time / (1024 * 1024)  # in MB/s
+    if failed_chunks:
+        raise Exception(f"{len(failed_chunks)} chunks failed to download, pull again to resume the download")
 
-        else:
-            raise Exception("Some chunks failed to download")
+    sha256 = file_hash.sha256.hexdigest()
+    if expected_sha256 is not None and sha256 != expected_sha256.lower():
+        # The data is bad, do not resume from it
+        part_path.unlink()
+        manifest_path.unlink()
+        raise ValueError(f"Checksum mismatch for {file_path.name}: expected {expected_sha256}, got {sha256}")
 
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Error occurred while making the request: {e}")
-    except ValueError as e:
-        raise Exception(f"Error: {e}")
-    except Exception as e:
-        # Clean up partial files
-        for i in range(len(chunks)):
-            chunk_file = f"{file_path}.part{i}"
-            if os.path.exists(chunk_file):
-                os.remove(chunk_file)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        raise Exception(f"An unexpected error occurred: {e}")
+    os.replace(part_path, file_path)
+    manifest_path.unlink()
+    return sha256
 
 
 def download_model_from_official(model_path, model_type, **kwargs):
@@ -482,60 +722,212 @@ def download_gguf_from_hf(repo_id, filename):
         print(f"Failed to download the model: {e}")
         return False, None
 
-def is_model_exists(model_name):
-    if not NEXA_MODEL_LIST_PATH.exists():
-        return False
+@contextlib.contextmanager
+def _model_registry(write=False):
+    """
+    Open the model registry, a SQLite database shared by all nexa processes.
 
-    with open(NEXA_MODEL_LIST_PATH, "r") as f:
-        model_list = json.load(f)
+    With write=True the block runs in one transaction that holds the database write lock,
+    so concurrent pulls in several processes never lose each other's entries.
+    """
+    NEXA_MODEL_REGISTRY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(NEXA_MODEL_REGISTRY_PATH), timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            _init_model_registry(conn)
+        if write:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            if write:
+                conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def _init_model_registry(conn):
+    """Create the registry schema and import the entries of the legacy model_list.json."""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another process may have initialized the registry while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS models ("
+                "name TEXT PRIMARY KEY, type TEXT, location TEXT NOT NULL, run_type TEXT, metadata TEXT)"
+            )
+            if NEXA_MODEL_LIST_PATH.exists():
+                with open(NEXA_MODEL_LIST_PATH, "r") as f:
+                    model_list = json.load(f)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO models (name, type, location, run_type) VALUES (?, ?, ?, ?)",
+                    [
+                        (model_name, model_info.get("type"), model_info.get("location"), model_info.get("run_type"))
+                        for model_name, model_info in model_list.items()
+                        if model_info.get("location")
+                    ],
+                )
+            conn.execute("PRAGMA user_version = 1")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
 
-    return model_name in model_list
 
+_GGUF_SCALAR_FORMATS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d",
+}
+_GGUF_STRING = 8
+_GGUF_ARRAY = 9
 
-def add_model_to_list(model_name, model_location, model_type, run_type):
-    NEXA_MODEL_LIST_PATH.parent.mkdir(parents=True, exist_ok=True)
 
-    if NEXA_MODEL_LIST_PATH.exists():
-        with open(NEXA_MODEL_LIST_PATH, "r") as f:
-            model_list = json.load(f)
-    else:
-        model_list = {}
+def read_gguf_metadata(file_path):
+    """
+    Read the key-value metadata from the header of a GGUF file without reading the tensors.
+    Array values (such as the tokenizer vocabulary) are skipped.
+
+    Returns:
+    dict: The metadata values as strings, like Llama.metadata, or None if it is not a GGUF file.
+    """
+    with open(file_path, "rb") as f:
+        def read(fmt):
+            return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+        def read_string():
+            return f.read(read("<Q")).decode("utf-8", errors="replace")
+
+        if f.read(4) != b"GGUF" or read("<I") < 2:
+            return None
+        read("<Q")  # tensor count
+        n_kv = read("<Q")
+
+        metadata = {}
+        for _ in range(n_kv):
+            key = read_string()
+            value_type = read("<I")
+            if value_type == _GGUF_STRING:
+                metadata[key] = read_string()
+            elif value_type == _GGUF_ARRAY:
+                item_type = read("<I")
+                n_items = read("<Q")
+                if item_type == _GGUF_STRING:
+                    for _ in range(n_items):
+                        f.seek(read("<Q"), os.SEEK_CUR)
+                elif item_type in _GGUF_SCALAR_FORMATS:
+                    f.seek(n_items * struct.calcsize(_GGUF_SCALAR_FORMATS[item_type]), os.SEEK_CUR)
+                else:
+                    # Nested arrays, the rest of the header can not be located cheaply
+                    break
+            elif value_type in _GGUF_SCALAR_FORMATS:
+                value = read(_GGUF_SCALAR_FORMATS[value_type])
+                if isinstance(value, bool):
+                    metadata[key] = "true" if value else "false"
+                elif isinstance(value, float):
+                    metadata[key] = f"{value:f}"
+                else:
+                    metadata[key] = str(value)
+            else:
+                break
+        return metadata
+
+
+def is_model_exists(model_name):
+    with _model_registry() as registry:
+        row = registry.execute("SELECT 1 FROM models WHERE name = ?", (model_name,)).fetchone()
+    return row is not None
 
-    model_list[model_name] = {
-        "type": model_type,
-        "location": model_location,
-        "run_type": run_type
-    }
 
-    with open(NEXA_MODEL_LIST_PATH, "w") as f:
-        json.dump(model_list, f, indent=2)
+def add_model_to_list(model_name, model_location, model_type, run_type):
+    # Cache the GGUF header so the model can be inspected without opening the weights
+    metadata = None
+    if model_type == "gguf" and model_location and os.path.isfile(model_location):
+        try:
+            metadata = read_gguf_metadata(model_location)
+        except (OSError, struct.error) as e:
+            logging.warning(f"Failed to read GGUF metadata from {model_location}: {e}")
+
+    with _model_registry(write=True) as registry:
+        registry.execute(
+            "INSERT INTO models (name, type, location, run_type, metadata) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET type = excluded.type, location = excluded.location, "
+            "run_type = excluded.run_type, metadata = excluded.metadata",
+            (model_name, model_type, model_location, run_type, json.dumps(metadata) if metadata is not None else None),
+        )
 
 
 def get_model_info(model_name):
-    if not NEXA_MODEL_LIST_PATH.exists():
+    with _model_registry() as registry:
+        row = registry.execute(
+            "SELECT location, run_type FROM models WHERE name = ?", (model_name,)
+        ).fetchone()
+    if row is None:
         return None, None
+    return row["location"], row["run_type"]
+
+
+def get_model_metadata(model_name):
+    """
+    Return the cached GGUF metadata of a pulled model, or None if there is none.
+
+    Entries imported from model_list.json have no metadata yet, their GGUF header is
+    read and stored on first use.
+    """
+    model_name = NEXA_RUN_MODEL_MAP.get(model_name, model_name)
+    with _model_registry() as registry:
+        row = registry.execute(
+            "SELECT type, location, metadata FROM models WHERE name = ?", (model_name,)
+        ).fetchone()
+    if row is None:
+        return None
+    if row["metadata"] is not None:
+        return json.loads(row["metadata"])
+    if row["type"] != "gguf" or not row["location"] or not os.path.isfile(row["location"]):
+        return None
+    try:
+        metadata = read_gguf_metadata(row["location"])
+    except (OSError, struct.error) as e:
+        logging.warning(f"Failed to read GGUF metadata from {row['location']}: {e}")
+        return None
+    if metadata is not None:
+        with _model_registry(write=True) as registry:
+            registry.execute(
+                "UPDATE models SET metadata = ? WHERE name = ?", (json.dumps(metadata), model_name)
+            )
+    return metadata
+
 
-    with open(NEXA_MODEL_LIST_PATH, "r") as f:
-        model_list = json.load(f)
+# Architectures of the GGUF embedding models on the hub
+_GGUF_EMBEDDING_ARCHITECTURES = {"bert", "nomic-bert", "jina-bert-v2"}
 
-    model_data = model_list.get(model_name, {})
-    location = model_data.get("location")
-    run_type = model_data.get("run_type")
 
-    return location, run_type
+def get_run_type_from_metadata(metadata):
+    """Return the run type of a GGUF model from its metadata, or None if it is unknown."""
+    architecture = (metadata or {}).get("general.architecture")
+    if architecture is None or architecture == "clip":
+        return None
+    if architecture in _GGUF_EMBEDDING_ARCHITECTURES:
+        return ModelType.TEXT_EMBEDDING.value
+    return ModelType.NLP.value
 
 
 def list_models():
-    if not NEXA_MODEL_LIST_PATH.exists():
-        print("No models found.")
-        return
     try:
-        with open(NEXA_MODEL_LIST_PATH, "r") as f:
-            model_list = json.load(f)
+        with _model_registry() as registry:
+            rows = registry.execute(
+                "SELECT name, type, run_type, location FROM models ORDER BY rowid"
+            ).fetchall()
+        if not rows:
+            print("No models found.")
+            return
 
         table = [
-            (model_name, model_info["type"], model_info["run_type"], model_info["location"])
-            for model_name, model_info in model_list.items()
+            (row["name"], row["type"], row["run_type"], row["location"])
+            for row in rows
         ]
         headers = ["Model Name", "Type", "Run Type", "Location"]
         from tabulate import tabulate
@@ -552,35 +944,30 @@ def list_models():
 def remove_model(model_path):
     model_path = NEXA_RUN_MODEL_MAP.get(model_path, model_path)
 
-    if not NEXA_MODEL_LIST_PATH.exists():
-        print("No models found.")
-        return
-
     try:
-        with open(NEXA_MODEL_LIST_PATH, "r") as f:
-            model_list = json.load(f)
-
-        if model_path not in model_list:
-            print(f"Model {model_path} not found.")
-            return
-
-        model_info = model_list.pop(model_path)
-        model_location = model_info['location']
-        model_path = Path(model_location)
-
-        # Delete the model files
-        if model_path.is_file():
-            model_path.unlink()
-            print(f"Deleted model file: {model_path}")
-        elif model_path.is_dir():
-            shutil.rmtree(model_path)
-            print(f"Deleted model directory: {model_path}")
-        else:
-            print(f"Warning: Model location not found: {model_path}")
+        with _model_registry(write=True) as registry:
+            row = registry.execute(
+                "SELECT name, location FROM models WHERE name = ?", (model_path,)
+            ).fetchone()
+            if row is None:
+                print(f"Model {model_path} not found.")
+                return
+
+            model_location = row["location"]
+            model_path = Path(model_location)
+
+            # Delete the model files
+            if model_path.is_file():
+                model_path.unlink()
+                print(f"Deleted model file: {model_path}")
+            elif model_path.is_dir():
+                shutil.rmtree(model_path)
+                print(f"Deleted model directory: {model_path}")
+            else:
+                print(f"Warning: Model location not found: {model_path}")
 
-        # Update the model list file
-        with open(NEXA_MODEL_LIST_PATH, "w") as f:
-            json.dump(model_list, f, indent=2)
+            # Update the registry
+            registry.execute("DELETE FROM models WHERE name = ?", (row["name"],))
 
         print(f"Model {model_path} removed from the list.")
         return model_location
@@ -569,7 +569,9 @@ class _LlamaBatch:
             self.batch.logits[i] = logits_all
         self.batch.logits[n_tokens - 1] = True
 
-    def add_sequence(self, batch: Sequence[int], seq_id: int, logits_all: bool):
+    def add_sequence(
+        self, batch: Sequence[int], seq_id: int, logits_all: bool, n_past: int = 0
+    ):
         assert self.batch is not None
         n_tokens = len(batch)
         n_tokens0 = self.batch.n_tokens
@@ -577,11 +579,11 @@ class _LlamaBatch:
         for i in range(n_tokens):
             j = n_tokens0 + i
             self.batch.token[j] = batch[i]
-            self.batch.pos[j] = i
+            self.batch.pos[j] = n_past + i
             self.batch.seq_id[j][0] = seq_id
             self.batch.n_seq_id[j] = 1
             self.batch.logits[j] = logits_all
-        self.batch.logits[n_tokens - 1] = True
+        self.batch.logits[n_tokens0 + n_tokens - 1] = True
 
 
 class _LlamaTokenDataArray:
@@ -693,6 +695,10 @@ def _should_add_bos(model: _LlamaModel) -> bool:
 
 
 def _normalize_embedding(embedding):
+    if isinstance(embedding, np.ndarray):
+        # Normalize every row at once
+        norm = np.linalg.norm(embedding, axis=-1, keepdims=True)
+        return embedding / np.where(norm == 0.0, 1.0, norm)
     norm = float(np.linalg.norm(embedding))
     if norm == 0.0:
         return embedding
@@ -737,6 +743,9 @@ class _LlamaSamplingContext:
     # NOTE: Missing parsed_grammar
     prev: list[int] = field(default_factory=list)
     cur: list[llama_cpp.llama_token_data] = field(default_factory=list)
+    # Buffers reused across sample() calls so per-token sampling does not allocate
+    token_data_array: Optional[_LlamaTokenDataArray] = None
+    last_tokens_data: Optional["llama_cpp.Array[llama_cpp.llama_token]"] = None
 
     def reset(self):
         self.prev = []
@@ -767,6 +776,7 @@ class _LlamaSamplingContext:
         ctx_main: _LlamaContext,
         idx: int = 0,
         logits_array: Optional[npt.NDArray[np.single]] = None,
+        grammar_mask: Optional[npt.NDArray[np.bool_]] = None,
     ):
         n_vocab = ctx_main.model.n_vocab()
         id: int = 0
@@ -782,22 +792,28 @@ class _LlamaSamplingContext:
         for token, logit_bias in self.params.logit_bias.items():
             logits_array[token] += logit_bias
 
-        token_data_array = _LlamaTokenDataArray(
-            n_vocab=n_vocab
-        )  # TODO: Only create this once
+        if self.token_data_array is None or self.token_data_array.n_vocab != n_vocab:
+            self.token_data_array = _LlamaTokenDataArray(n_vocab=n_vocab)
+        token_data_array = self.token_data_array
         token_data_array.copy_logits(logits_array)
 
         # apply penalties
         if len(self.prev) > 0:
             nl_token = ctx_main.model.token_nl()
             nl_logit = logits_array[nl_token]
-            last_tokens = self.prev[-self.params.penalty_last_n :]
-            last_tokens_size = min(len(last_tokens), self.params.penalty_last_n)
+            penalty_last_n = self.params.penalty_last_n
+            last_tokens = self.prev[-penalty_last_n:] if penalty_last_n > 0 else []
+            last_tokens_size = len(last_tokens)
             if last_tokens_size > 0:
-                last_tokens_p = (llama_cpp.llama_token * len(last_tokens))(*last_tokens)
+                if (
+                    self.last_tokens_data is None
+                    or len(self.last_tokens_data) < last_tokens_size
+                ):
+                    self.last_tokens_data = (llama_cpp.llama_token * penalty_last_n)()
+                self.last_tokens_data[:last_tokens_size] = last_tokens
                 ctx_main.sample_repetition_penalties(
                     token_data_array,
-                    last_tokens_p,
+                    self.last_tokens_data,
                     last_tokens_size,
                     self.params.penalty_repeat,
                     self.params.penalty_freq,
@@ -806,7 +822,10 @@ class _LlamaSamplingContext:
             if not self.params.penalize_nl:
                 token_data_array.candidates_data.logit[nl_token] = nl_logit
 
-        if self.grammar is not None:
+        if grammar_mask is not None:
+            # The tokens allowed by the grammar were already computed
+            token_data_array.candidates_data.logit[~grammar_mask] = -np.inf
+        elif self.grammar is not None:
             ctx_main.sample_grammar(token_data_array, self.grammar)
 
         if self.params.temp < 0:
@@ -857,4 +876,8 @@ class _LlamaSamplingContext:
     def accept(self, ctx_main: _LlamaContext, id: int, apply_grammar: bool):
         if apply_grammar and self.grammar is not None:
             ctx_main.grammar_accept_token(self.grammar, id)
-        self.prev.append(id)
\ No newline at end of file
+        self.prev.append(id)
+        # Only the penalty window is ever read back, keep the history bounded
+        n_keep = max(self.params.n_prev, self.params.penalty_last_n)
+        if len(self.prev) > 2 * n_keep:
+            del self.prev[:-n_keep]
\ No newline at end of file
@@ -5,9 +5,11 @@ import sys
 import uuid
 import time
 import json
+import codecs
 import ctypes
 import typing
 import fnmatch
+import functools
 import warnings
 import contextlib
 import multiprocessing
@@ -24,14 +26,23 @@ from typing import (
     Deque,
     Callable,
     Dict,
+    Tuple,
 )
 from collections import deque
 from pathlib import Path
 
 
 from nexa.gguf.llama.llama_types import *
-from nexa.gguf.llama.llama_grammar import LlamaGrammar
-from nexa.gguf.llama.llama_tokenizer import BaseLlamaTokenizer, LlamaTokenizer
+from nexa.gguf.llama.llama_cache import BaseLlamaCache, LlamaEmbeddingCache
+from nexa.gguf.llama.llama_grammar import LlamaGrammar, _LlamaGrammarMatcher
+from nexa.gguf.llama.llama_scheduler import LlamaScheduler
+from nexa.gguf.llama.llama_tokenizer import (
+    BaseLlamaTokenizer,
+    LlamaTokenizer,
+    SegmentedTokenizer,
+    StopSequenceMatcher,
+    StreamingDetokenizer,
+)
 import nexa.gguf.llama.llama_cpp as llama_cpp
 import nexa.gguf.llama.llama_chat_format as llama_chat_format
 
@@ -168,7 +179,7 @@ class Llama:
             yarn_beta_fast: YaRN low correction dim
             yarn_beta_slow: YaRN high correction dim
             yarn_orig_ctx: YaRN original context size
-            logits_all: Return logits for all tokens, not just the last token. Must be True for completion to return logprobs.
+            logits_all: Keep logits for all evaluated tokens in a dense n_ctx x n_vocab array. If False, only the logits that are read are kept: the last row for sampling, plus the rows of the requested positions when completion returns logprobs.
             embedding: Embedding mode only.
             offload_kqv: Offload K, Q, V to GPU.
             flash_attn: Use flash attention.
@@ -335,10 +346,8 @@ class Llama:
             yarn_beta_slow if yarn_beta_slow != 0.0 else 0
         )
         self.context_params.yarn_orig_ctx = yarn_orig_ctx if yarn_orig_ctx != 0 else 0
-        # self.context_params.logits_all = (
-        #     logits_all if draft_model is None else True
-        # )  # Must be set to True for speculative decoding
-        self.context_params.logits_all = True
+        # Speculative decoding requests logits for the drafted tokens per batch
+        self.context_params.logits_all = logits_all
         self.context_params.embeddings = embedding  # TODO: Rename to embeddings
         self.context_params.offload_kqv = offload_kqv
         self.context_params.flash_attn = flash_attn
@@ -350,6 +359,11 @@ class Llama:
         # Sampling Params
         self.last_n_tokens_size = last_n_tokens_size
 
+        self.cache: Optional[BaseLlamaCache] = None
+        self.embedding_cache: Optional[LlamaEmbeddingCache] = None
+        self._embedding_model_hash: Optional[str] = None
+        self.scheduler: Optional[LlamaScheduler] = None
+
         self.lora_base = lora_base
         self.lora_scale = lora_scale
         self.lora_path = lora_path
@@ -371,6 +385,7 @@ class Llama:
 
         # Override tokenizer
         self.tokenizer_ = tokenizer or LlamaTokenizer(self)
+        self._segmented_tokenizer: Optional[SegmentedTokenizer] = None
 
         # Set the default value for the context and correct the batch
         if n_ctx == 0:
@@ -439,6 +454,9 @@ class Llama:
         )
 
         self.draft_model = draft_model
+        # Speculative decoding counters
+        self.n_draft_tokens = 0
+        self.n_draft_accepted = 0
 
         self._n_vocab = self.n_vocab()
         self._n_ctx = self.n_ctx()
@@ -447,16 +465,28 @@ class Llama:
         self._token_eos = self.token_eos()
 
         self._candidates = _LlamaTokenDataArray(n_vocab=self._n_vocab)
+        # Grammar mask of the next position, computed by jump-forward decoding
+        self._grammar_mask: Optional[npt.NDArray[np.bool_]] = None
+        self._grammar_logits: Optional[npt.NDArray[np.single]] = None
+        # Vocabulary pieces used to spell grammar-forced text, built on first use
+        self._grammar_pieces: Optional[Dict[bytes, int]] = None
+        # Tokens appended by jump-forward decoding without sampling
+        self.n_forced_tokens = 0
 
         self.n_tokens = 0
         self.input_ids: npt.NDArray[np.intc] = np.ndarray((n_ctx,), dtype=np.intc)
         self.scores: npt.NDArray[np.single] = np.ndarray(
-            (n_ctx, self._n_vocab), dtype=np.single
+            (n_ctx if logits_all else 1, self._n_vocab), dtype=np.single
         )
+        # With logits_all=False `scores` only holds the rows for positions
+        # [_scores_offset, _scores_offset + _n_scores), see `_store_logits`.
+        self._scores_offset = 0
+        self._n_scores = 0
+        # First position whose logits must be kept (set while logprobs are requested)
+        self._logits_keep_from: Optional[int] = None
 
-        self._mirostat_mu = ctypes.c_float(
-            2.0 * 5.0
-        )  # TODO: Move this to sampling context
+        self._sampling_context: Optional[_LlamaSamplingContext] = None
+        self._sampling_key: Optional[tuple] = None
 
         try:
             self.metadata = self._model.metadata()
@@ -551,7 +581,11 @@ class Llama:
 
     @property
     def _scores(self) -> npt.NDArray[np.single]:
-        return self.scores[: self.n_tokens, :]
+        if self.context_params.logits_all:
+            return self.scores[: self.n_tokens, :]
+        # Rows start at position `_scores_offset`
+        n_rows = min(self._n_scores, self.n_tokens - self._scores_offset)
+        return self.scores[: max(n_rows, 0), :]
 
     @property
     def eval_tokens(self) -> Deque[int]:
@@ -560,7 +594,7 @@ class Llama:
     @property
     def eval_logits(self) -> Deque[List[float]]:
         return deque(
-            self.scores[: self.n_tokens, :].tolist(),
+            self._scores.tolist(),
             maxlen=self._n_ctx if self.context_params.logits_all else 1,
         )
 
@@ -582,6 +616,63 @@ class Llama:
         """
         return self.tokenizer_.tokenize(text, add_bos, special)
 
+    def tokenize_prompt(self, text: bytes, add_bos: bool = True) -> List[int]:
+        """Tokenize a prompt with special tokens, such as a rendered chat prompt.
+
+        Gives the same tokens as `tokenize(text, add_bos, special=True)`, but the
+        prompt is split before special tokens and segments tokenized by earlier
+        calls are reused, so a conversation only pays for its new turns.
+
+        Args:
+            text: The utf-8 encoded prompt to tokenize.
+            add_bos: Whether to add a beginning of sequence token.
+
+        Returns:
+            A list of tokens.
+        """
+        # Models that append an EOS with the BOS are tokenized as a whole
+        if not isinstance(self.tokenizer_, LlamaTokenizer) or (
+            add_bos and self._model.add_eos_token()
+        ):
+            return self.tokenize(text, add_bos=add_bos, special=True)
+        if self._segmented_tokenizer is None:
+            self._segmented_tokenizer = SegmentedTokenizer(
+                self.tokenizer_, self._special_token_boundaries()
+            )
+        return self._segmented_tokenizer.tokenize(text, add_bos=add_bos)
+
+    def _special_token_boundaries(self) -> List[bytes]:
+        """Return the texts of the special tokens a prompt can be split before
+        without changing its tokenization."""
+        special = (
+            llama_cpp.LLAMA_TOKEN_ATTR_CONTROL
+            | llama_cpp.LLAMA_TOKEN_ATTR_USER_DEFINED
+            | llama_cpp.LLAMA_TOKEN_ATTR_UNKNOWN
+        )
+        texts = set()
+        candidates = set()
+        for token in range(self._model.n_vocab()):
+            attr = self._model.token_get_attr(token)
+            if attr & special:
+                text = llama_cpp.llama_token_get_text(self._model.model, token)
+                texts.add(text)
+                # Tokens that strip whitespace on their left change the previous segment
+                if not attr & (
+                    llama_cpp.LLAMA_TOKEN_ATTR_UNKNOWN | llama_cpp.LLAMA_TOKEN_ATTR_LSTRIP
+                ):
+                    candidates.add(text)
+        # Skip tokens that a longer special token may contain or straddle, as
+        # the tokenizer would match the longer one instead
+        joined = b"\0".join(texts)
+        suffixes = {text[i:] for text in texts for i in range(1, len(text))}
+        return [
+            text
+            for text in candidates
+            if text
+            and joined.count(text) == 1
+            and not any(text[:i] in suffixes for i in range(1, len(text) + 1))
+        ]
+
     def detokenize(
         self, tokens: List[int], prev_tokens: Optional[List[int]] = None, special: bool = False
     ) -> bytes:
@@ -597,6 +688,57 @@ class Llama:
         """
         return self.tokenizer_.detokenize(tokens, prev_tokens=prev_tokens, special=special)
 
+    def set_cache(self, cache: Optional[BaseLlamaCache]):
+        """Set the cache.
+
+        Args:
+            cache: The cache to set.
+        """
+        self.cache = cache
+
+    def set_embedding_cache(self, cache: Optional[LlamaEmbeddingCache]):
+        """Set the cache consulted by `embed` before evaluating inputs.
+
+        Args:
+            cache: The embedding cache to set.
+        """
+        self.embedding_cache = cache
+        self._embedding_model_hash = None
+
+    def set_scheduler(self, scheduler: Optional[LlamaScheduler]):
+        """Set the scheduler that decodes concurrent completions together.
+
+        Args:
+            scheduler: The scheduler to set.
+        """
+        self.scheduler = scheduler
+
+    def _use_scheduler(
+        self,
+        logprobs: Optional[int],
+        stopping_criteria: Optional[StoppingCriteriaList],
+        logits_processor: Optional[LogitsProcessorList],
+        grammar: Optional[LlamaGrammar],
+        logit_bias: Optional[Dict[str, float]],
+    ) -> bool:
+        """Whether a completion can be decoded by the scheduler."""
+        return (
+            self.scheduler is not None
+            and self.draft_model is None
+            and logprobs is None
+            and stopping_criteria is None
+            and logits_processor is None
+            and grammar is None
+            and logit_bias is None
+        )
+
+    @property
+    def draft_acceptance_rate(self) -> Optional[float]:
+        """Fraction of the drafted tokens accepted by speculative decoding."""
+        if self.n_draft_tokens == 0:
+            return None
+        return self.n_draft_accepted / self.n_draft_tokens
+
     def set_seed(self, seed: int):
         """Set the random seed.
 
@@ -623,30 +765,75 @@ class Llama:
             batch = tokens[i : min(len(tokens), i + self.n_batch)]
             n_past = self.n_tokens
             n_tokens = len(batch)
-            self._batch.set_batch(
-                batch=batch, n_past=n_past, logits_all=self.context_params.logits_all
+            logits_all = (
+                self.context_params.logits_all
+                or self.draft_model is not None
+                or (
+                    self._logits_keep_from is not None
+                    and n_past + n_tokens - 1 > self._logits_keep_from
+                )
             )
+            self._batch.set_batch(batch=batch, n_past=n_past, logits_all=logits_all)
             self._ctx.decode(self._batch)
             # Save tokens
             self.input_ids[n_past : n_past + n_tokens] = batch
             # Save logits
-            if self.context_params.logits_all:
-                rows = n_tokens
-                cols = self._n_vocab
-                logits = np.ctypeslib.as_array(
-                    self._ctx.get_logits(), shape=(rows * cols,)
-                )
-                self.scores[n_past : n_past + n_tokens, :].reshape(-1)[::] = logits
-            else:
-                rows = 1
-                cols = self._n_vocab
-                logits = np.ctypeslib.as_array(
-                    self._ctx.get_logits(), shape=(rows * cols,)
-                )
-                self.scores[n_past + n_tokens - 1, :].reshape(-1)[::] = logits
+            rows = n_tokens if logits_all else 1
+            logits = np.ctypeslib.as_array(
+                self._ctx.get_logits(), shape=(rows, self._n_vocab)
+            )
+            self._store_logits(n_past + n_tokens - rows, logits)
             # Update n_tokens
             self.n_tokens += n_tokens
 
+    def _store_logits(self, pos: int, logits: npt.NDArray[np.single]):
+        """Store the logits of the positions starting at `pos`.
+
+        With logits_all=False only the rows that can still be read are kept:
+        the latest rows, plus every row from `_logits_keep_from` on while
+        logprobs are requested, so memory scales with the number of requested
+        positions instead of the context size.
+        """
+        rows = logits.shape[0]
+        if self.context_params.logits_all:
+            self.scores[pos : pos + rows, :] = logits
+            return
+        offset, n_scores = self._scores_offset, self._n_scores
+        keep_from = self._logits_keep_from
+        start = pos
+        if keep_from is not None and offset <= pos == self.n_tokens <= offset + n_scores:
+            # Extend the kept rows, dropping the ones before `keep_from`
+            start = max(offset, min(keep_from, pos))
+        n_kept = pos - start
+        n_rows = n_kept + rows
+        capacity = self.scores.shape[0]
+        if n_rows > capacity or (keep_from is None and n_rows < capacity):
+            # Grow geometrically while rows are being kept, otherwise shrink
+            # back to the rows of the latest batch
+            if keep_from is not None:
+                capacity = max(n_rows, 2 * capacity)
+            else:
+                capacity = n_rows
+            scores = np.ndarray((capacity, self._n_vocab), dtype=np.single)
+            scores[:n_kept] = self.scores[start - offset : pos - offset]
+            self.scores = scores
+        elif n_kept > 0 and start != offset:
+            self.scores[:n_kept] = self.scores[start - offset : pos - offset]
+        self.scores[n_kept:n_rows, :] = logits
+        self._scores_offset = start
+        self._n_scores = n_rows
+
+    def _get_scores(self, start: int, stop: int) -> npt.NDArray[np.single]:
+        """Return the logits for the positions in [start, stop)."""
+        if self.context_params.logits_all:
+            return self.scores[start:stop, :]
+        offset = self._scores_offset
+        if start < offset or stop > min(offset + self._n_scores, self.n_tokens):
+            raise RuntimeError(
+                f"Logits for positions {start} to {stop} were not kept"
+            )
+        return self.scores[start - offset : stop - offset, :]
+
     def sample(
         self,
         top_k: int = 40,
@@ -683,9 +870,11 @@ class Llama:
         assert self.n_tokens > 0
 
         if idx is None:
-            logits: npt.NDArray[np.single] = self._scores[-1, :]
+            logits: npt.NDArray[np.single] = self._get_scores(
+                self.n_tokens - 1, self.n_tokens
+            )[0]
         else:
-            logits = self._scores[idx, :]
+            logits = self._get_scores(idx, idx + 1)[0]
 
         if logits_processor is not None:
             logits[:] = (
@@ -694,28 +883,64 @@ class Llama:
                 else logits_processor(self._input_ids[: idx + 1], logits)
             )
 
-        sampling_params = _LlamaSamplingParams(
-            top_k=top_k,
-            top_p=top_p,
-            min_p=min_p,
-            tfs_z=tfs_z,
-            typical_p=typical_p,
-            temp=temp,
-            penalty_last_n=self.last_n_tokens_size,
-            penalty_repeat=repeat_penalty,
-            penalty_freq=frequency_penalty,
-            penalty_present=presence_penalty,
-            mirostat=mirostat_mode,
-            mirostat_tau=mirostat_tau,
-            mirostat_eta=mirostat_eta,
-            penalize_nl=penalize_nl,
+        # Reuse the sampling context (and its candidate buffers) while the
+        # parameters stay the same, which is the case for a whole generate() call
+        sampling_key = (
+            top_k,
+            top_p,
+            min_p,
+            tfs_z,
+            typical_p,
+            temp,
+            repeat_penalty,
+            frequency_penalty,
+            presence_penalty,
+            mirostat_mode,
+            mirostat_tau,
+            mirostat_eta,
+            penalize_nl,
         )
-        sampling_context = _LlamaSamplingContext(
-            params=sampling_params,
-            grammar=grammar,
+        sampling_context = self._sampling_context
+        if (
+            sampling_context is None
+            or self._sampling_key != sampling_key
+            or sampling_context.grammar is not grammar
+        ):
+            sampling_params = _LlamaSamplingParams(
+                top_k=top_k,
+                top_p=top_p,
+                min_p=min_p,
+                tfs_z=tfs_z,
+                typical_p=typical_p,
+                temp=temp,
+                penalty_last_n=self.last_n_tokens_size,
+                penalty_repeat=repeat_penalty,
+                penalty_freq=frequency_penalty,
+                penalty_present=presence_penalty,
+                mirostat=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+                penalize_nl=penalize_nl,
+            )
+            sampling_context = _LlamaSamplingContext(
+                params=sampling_params,
+                mirostat_mu=ctypes.c_float(2.0 * mirostat_tau),
+                grammar=grammar,
+                token_data_array=self._candidates,
+            )
+            self._sampling_context = sampling_context
+            self._sampling_key = sampling_key
+        # Only the penalty window of the history is needed
+        n_past = self.n_tokens if idx is None else idx + 1
+        sampling_context.prev = self.input_ids[
+            max(0, n_past - self.last_n_tokens_size) : n_past
+        ].tolist()
+        grammar_mask, self._grammar_mask = self._grammar_mask, None
+        id = sampling_context.sample(
+            ctx_main=self._ctx,
+            logits_array=logits,
+            grammar_mask=grammar_mask if grammar is not None else None,
         )
-        sampling_context.prev = list(self.eval_tokens)
-        id = sampling_context.sample(ctx_main=self._ctx, logits_array=logits)
         sampling_context.accept(
             ctx_main=self._ctx,
             id=id,
@@ -743,6 +968,84 @@ class Llama:
         else:
             return id
 
+    def _tokenize_forced_text(self, text: bytes) -> List[int]:
+        """Tokenize text forced by a grammar into tokens that spell exactly that text."""
+        tokens = self.tokenize(text, add_bos=False, special=False)
+        if self._model.detokenize(tokens, special=True) == text:
+            return tokens
+        # The tokenizer changed the text (e.g. added a leading space), match the
+        # longest vocabulary pieces instead
+        if self._grammar_pieces is None:
+            skip = llama_cpp.LLAMA_TOKEN_ATTR_CONTROL | llama_cpp.LLAMA_TOKEN_ATTR_UNUSED
+            pieces: Dict[bytes, int] = {}
+            for token in range(self._n_vocab):
+                attr = self._model.token_get_attr(token)
+                if attr & skip:
+                    continue
+                piece = self._model.detokenize([token], special=True)
+                # Prefer normal tokens over byte fallback tokens of the same text
+                if piece and (piece not in pieces or attr & llama_cpp.LLAMA_TOKEN_ATTR_NORMAL):
+                    pieces[piece] = token
+            self._grammar_pieces = pieces
+        pieces = self._grammar_pieces
+        max_len = max(map(len, pieces), default=0)
+        tokens = []
+        start = 0
+        while start < len(text):
+            for end in range(min(len(text), start + max_len), start, -1):
+                token = pieces.get(text[start:end])
+                if token is not None:
+                    break
+            else:
+                break
+            tokens.append(token)
+            start = end
+        return tokens
+
+    def _grammar_forced_tokens(
+        self, grammar: LlamaGrammar, matcher: _LlamaGrammarMatcher, limit: int
+    ) -> Generator[int, None, None]:
+        """Yield the tokens the grammar forces next, accepting each into it.
+
+        The text the grammar forces is read off its stacks by `matcher` and
+        tokenized, the last of its tokens is left to sampling since it could
+        merge with the text that follows. After that, tokens are forced while a
+        single token of the vocabulary is allowed. The mask of the first
+        position with several allowed tokens is kept for the next `sample`
+        call, so the grammar is applied to the vocabulary once per position
+        either way.
+        """
+        assert self._model.model is not None
+        text = matcher.forced_text(limit)
+        if text:
+            for token in self._tokenize_forced_text(text.encode("utf-8"))[:-1]:
+                self._ctx.grammar_accept_token(grammar, token)
+                matcher.accept_bytes(self._model.detokenize([token], special=True))
+                self.n_forced_tokens += 1
+                limit -= 1
+                yield token
+
+        if self._grammar_logits is None:
+            self._grammar_logits = np.zeros(self._n_vocab, dtype=np.single)
+        candidates = self._candidates
+        for _ in range(limit):
+            candidates.copy_logits(self._grammar_logits)
+            self._ctx.sample_grammar(candidates, grammar)
+            allowed = np.isfinite(candidates.candidates_data.logit)
+            n_allowed = np.count_nonzero(allowed)
+            if n_allowed != 1:
+                if n_allowed > 1:
+                    self._grammar_mask = allowed
+                return
+            token = int(np.argmax(allowed))
+            self._ctx.grammar_accept_token(grammar, token)
+            self.n_forced_tokens += 1
+            if llama_cpp.llama_token_is_eog(self._model.model, token):
+                yield token
+                return
+            matcher.accept_bytes(self._model.detokenize([token], special=True))
+            yield token
+
     def generate(
         self,
         tokens: Sequence[int],
@@ -785,8 +1088,8 @@ class Llama:
         Yields:
             The generated tokens.
         """
-        # Reset mirostat sampling
-        self._mirostat_mu = ctypes.c_float(2.0 * mirostat_tau)
+        # Reset the sampling context (including mirostat state)
+        self._sampling_context = None
 
         # Check for kv cache prefix match
         if reset and self.n_tokens > 0:
@@ -796,6 +1099,12 @@ class Llama:
                     longest_prefix += 1
                 else:
                     break
+            keep_from = self._logits_keep_from
+            if keep_from is not None and not self.context_params.logits_all:
+                # Re-evaluate the positions whose logits were not kept
+                if self._scores_offset <= keep_from:
+                    keep_from = max(keep_from, self._scores_offset + self._n_scores)
+                longest_prefix = min(longest_prefix, keep_from)
             if longest_prefix > 0:
                 reset = False
                 tokens = tokens[longest_prefix:]
@@ -815,6 +1124,18 @@ class Llama:
         sample_idx = self.n_tokens + len(tokens) - 1
         tokens = list(tokens)
 
+        # Forced tokens have no logits of their own, so jump-forward is only
+        # used when nothing needs the logits of every position. Completions
+        # read them for any logprobs value, including 0.
+        jump_forward = (
+            grammar is not None
+            and stopping_criteria is None
+            and logprobs is None
+        )
+        self._grammar_mask = None
+        # Follows the grammar at the character level to find the text it forces
+        matcher = grammar._matcher() if jump_forward else None
+
         # Eval and sample
         while True:
             self.eval(tokens)
@@ -846,10 +1167,15 @@ class Llama:
                 else:
                     token = result
                     logprobs_info = None
+                if matcher is not None and not llama_cpp.llama_token_is_eog(
+                    self._model.model, token
+                ):
+                    matcher.accept_bytes(self._model.detokenize([token], special=True))
 
                 sample_idx += 1
                 if stopping_criteria is not None and stopping_criteria(
-                    self._input_ids, self._scores[-1, :]
+                    self._input_ids,
+                    self._get_scores(self.n_tokens - 1, self.n_tokens)[0],
                 ):
                     return
                 tokens_or_none = yield token, logprobs_info
@@ -858,21 +1184,37 @@ class Llama:
                 if tokens_or_none is not None:
                     tokens.extend(tokens_or_none)
 
-                if sample_idx < self.n_tokens and token != self._input_ids[sample_idx]:
-                    self.n_tokens = sample_idx
-                    self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
-                    break
+                if sample_idx < self.n_tokens:
+                    if token != self._input_ids[sample_idx]:
+                        self.n_tokens = sample_idx
+                        self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+                        break
+                    self.n_draft_accepted += 1
+
+                if (
+                    jump_forward
+                    and tokens_or_none is None
+                    and sample_idx >= self.n_tokens
+                ):
+                    # Append the tokens forced by the grammar without sampling
+                    # them, they are evaluated together with the sampled token
+                    for forced in self._grammar_forced_tokens(
+                        grammar, matcher, self._n_ctx - self.n_tokens - len(tokens)
+                    ):
+                        sample_idx += 1
+                        tokens_or_none = yield forced, None
+                        tokens.append(forced)
+                        if tokens_or_none is not None:
+                            tokens.extend(tokens_or_none)
+                            break
 
             if self.draft_model is not None:
                 self.input_ids[self.n_tokens : self.n_tokens + len(tokens)] = tokens
                 draft_tokens = self.draft_model(
                     self.input_ids[: self.n_tokens + len(tokens)]
-                )
-                tokens.extend(
-                    draft_tokens.astype(int)[
-                        : self._n_ctx - self.n_tokens - len(tokens)
-                    ]
-                )
+                ).astype(int)[: self._n_ctx - self.n_tokens - len(tokens)]
+                tokens.extend(draft_tokens)
+                self.n_draft_tokens += len(draft_tokens)
 
     def create_embedding(
         self, input: Union[str, List[str]], model: Optional[str] = None
@@ -921,11 +1263,16 @@ class Llama:
         normalize: bool = False,
         truncate: bool = True,
         return_count: bool = False,
+        return_numpy: bool = False,
     ):
         """Embed a string.
 
+        All inputs are packed into as few batches as possible, one sequence per input.
+        Pooled embeddings found in `embedding_cache` are not evaluated again.
+
         Args:
             input: The utf-8 encoded string to embed.
+            return_numpy: Return NumPy arrays instead of lists, a (len(input), n_embd) array for pooled embeddings.
 
         Returns:
             A list of embeddings
@@ -951,11 +1298,27 @@ class Llama:
         else:
             inputs = input
 
+        # look up pooled embeddings computed before, only the misses are evaluated
+        cache = self.embedding_cache if not logits_all else None
+        cached: List[Optional[Tuple[npt.NDArray[np.single], int]]] = [None] * len(inputs)
+        if cache is not None:
+            if self._embedding_model_hash is None:
+                paths = [self.model_path] + ([self.lora_path] if self.lora_path else [])
+                self._embedding_model_hash = cache.model_hash(*paths)
+            cached = cache.get(
+                self._embedding_model_hash,
+                n_embd,
+                normalize,
+                n_batch if truncate else None,
+                inputs,
+            )
+        misses = [i for i, entry in enumerate(cached) if entry is None]
+
         # reset batch
         self._batch.reset()
 
         # decode and fetch embeddings
-        data: Union[List[List[float]], List[List[List[float]]]] = []
+        data: List[npt.NDArray[np.single]] = []
 
         def decode_batch(seq_sizes: List[int]):
             assert self._ctx.ctx is not None
@@ -963,41 +1326,40 @@ class Llama:
             self._ctx.decode(self._batch)
             self._batch.reset()
 
-            # store embeddings
+            # store embeddings, copied out of the context in one go per sequence
             if pooling_type == llama_cpp.LLAMA_POOLING_TYPE_NONE:
+                embeddings = np.ctypeslib.as_array(
+                    llama_cpp.llama_get_embeddings(self._ctx.ctx),
+                    shape=(sum(seq_sizes), n_embd),
+                )
                 pos: int = 0
-                for i, size in enumerate(seq_sizes):
-                    ptr = llama_cpp.llama_get_embeddings(self._ctx.ctx)
-                    embedding: List[List[float]] = [
-                        ptr[pos + j * n_embd : pos + (j + 1) * n_embd]
-                        for j in range(size)
-                    ]
-                    if normalize:
-                        embedding = [_normalize_embedding(e) for e in embedding]
-                    data.append(embedding)
+                for size in seq_sizes:
+                    data.append(embeddings[pos : pos + size].copy())
                     pos += size
             else:
                 for i in range(len(seq_sizes)):
-                    ptr = llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, i)
-                    embedding: List[float] = ptr[:n_embd]
-                    if normalize:
-                        embedding = _normalize_embedding(embedding)
-                    data.append(embedding)
+                    embedding = np.ctypeslib.as_array(
+                        llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, i),
+                        shape=(n_embd,),
+                    )
+                    data.append(embedding.copy())
 
         # init state
-        total_tokens = 0
+        total_tokens = sum(entry[1] for entry in cached if entry is not None)
+        miss_tokens: List[int] = []
         s_batch = []
         t_batch = 0
         p_batch = 0
 
         # accumulate batches and encode
-        for text in inputs:
-            tokens = self.tokenize(text.encode("utf-8"))
+        for i in misses:
+            tokens = self.tokenize(inputs[i].encode("utf-8"))
             if truncate:
                 tokens = tokens[:n_batch]
 
             n_tokens = len(tokens)
             total_tokens += n_tokens
+            miss_tokens.append(n_tokens)
 
             # check for overrun
             if n_tokens > n_batch:
@@ -1021,12 +1383,43 @@ class Llama:
             p_batch += 1
 
         # hanlde last batch
-        decode_batch(s_batch)
+        if s_batch:
+            decode_batch(s_batch)
 
         if self.verbose:
             llama_cpp.llama_print_timings(self._ctx.ctx)
 
-        output = data[0] if isinstance(input, str) else data
+        embeds: Union[npt.NDArray[np.single], List[npt.NDArray[np.single]]]
+        if pooling_type == llama_cpp.LLAMA_POOLING_TYPE_NONE:
+            embeds = [_normalize_embedding(e) for e in data] if normalize else data
+            if not return_numpy:
+                embeds = [e.tolist() for e in embeds]
+        else:
+            computed = (
+                np.stack(data) if data else np.empty((0, n_embd), dtype=np.single)
+            )
+            if normalize:
+                computed = _normalize_embedding(computed)
+            if cache is None:
+                embeds = computed
+            else:
+                cache.put(
+                    self._embedding_model_hash,  # type: ignore
+                    normalize,
+                    n_batch if truncate else None,
+                    [inputs[i] for i in misses],
+                    computed,
+                    miss_tokens,
+                )
+                embeds = np.empty((len(inputs), n_embd), dtype=np.single)
+                embeds[misses] = computed
+                for i, entry in enumerate(cached):
+                    if entry is not None:
+                        embeds[i] = entry[0]
+            if not return_numpy:
+                embeds = embeds.tolist()
+
+        output = embeds[0] if isinstance(input, str) else embeds
 
         llama_cpp.llama_kv_cache_clear(self._ctx.ctx)
         self.reset()
@@ -1036,6 +1429,128 @@ class Llama:
         else:
             return output
 
+    def loglikelihood(
+        self, context: Sequence[int], continuations: Sequence[Sequence[int]]
+    ) -> List[Tuple[float, bool]]:
+        """Score continuations of a shared context.
+
+        The context is evaluated once, reusing the prefix already in the KV
+        cache, and every continuation is decoded in its own sequence forked
+        from the context cells, packing several continuations per batch.
+
+        Args:
+            context: The context tokens.
+            continuations: The tokens of each continuation.
+
+        Returns:
+            For each continuation, the sum of its token logprobs and whether
+            every token is the greedy choice.
+        """
+        if self.scheduler is not None:
+            with self.scheduler.exclusive():
+                return self._loglikelihood(context, continuations)
+        return self._loglikelihood(context, continuations)
+
+    def _loglikelihood(
+        self, context: Sequence[int], continuations: Sequence[Sequence[int]]
+    ) -> List[Tuple[float, bool]]:
+        assert self._ctx.ctx is not None
+        context = list(context)
+        n_context = len(context)
+        if n_context == 0:
+            raise ValueError("Context must contain at least one token")
+        n_longest = max((len(c) for c in continuations), default=0)
+        if n_context + n_longest > self._n_ctx:
+            raise ValueError(
+                f"Requested tokens ({n_context + n_longest}) exceed context window of {self._n_ctx}"
+            )
+
+        # Evaluate the context, keeping only the logits of its last token
+        self._logits_keep_from = None
+        longest_prefix = self.longest_token_prefix(self._input_ids, context[:-1])
+        self.n_tokens = longest_prefix
+        self.eval(context[longest_prefix:])
+        first = self.logits_to_logprobs(self._get_scores(n_context - 1, n_context)[0])
+
+        results: List[Tuple[float, bool]] = []
+        for tokens in continuations:
+            if len(tokens) == 0:
+                results.append((0.0, True))
+            else:
+                token = tokens[0]
+                results.append(
+                    (float(first[token]), int(np.argmax(first)) == token)
+                )
+
+        # Split the remaining tokens of every continuation into batch sized
+        # pieces, decoded in order so long continuations span several batches
+        pieces: List[Tuple[int, int, Sequence[int]]] = []
+        for k, tokens in enumerate(continuations):
+            for offset in range(0, len(tokens) - 1, self.n_batch):
+                pieces.append(
+                    (k, offset, tokens[offset : min(len(tokens) - 1, offset + self.n_batch)])
+                )
+
+        seq_ids: Dict[int, int] = {}
+        free_seq_ids: List[int] = []
+        n_cells = n_context
+        batch: List[Tuple[int, int, Sequence[int]]] = []
+
+        def decode_batch():
+            nonlocal n_cells
+            self._ctx.decode(self._batch)
+            logits = np.ctypeslib.as_array(
+                self._ctx.get_logits(), shape=(self._batch.n_tokens(), self._n_vocab)
+            )
+            row = 0
+            for k, offset, piece in batch:
+                n = len(piece)
+                logprobs = self.logits_to_logprobs(logits[row : row + n])
+                target = np.asarray(
+                    continuations[k][offset + 1 : offset + 1 + n], dtype=np.intc
+                )
+                logprob, is_greedy = results[k]
+                results[k] = (
+                    logprob + float(logprobs[np.arange(n), target].sum()),
+                    is_greedy and bool(np.all(np.argmax(logprobs, axis=-1) == target)),
+                )
+                row += n
+                # Free the sequence once its last piece is decoded
+                if offset + n == len(continuations[k]) - 1:
+                    seq_id = seq_ids.pop(k)
+                    self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+                    free_seq_ids.append(seq_id)
+                    n_cells -= offset + n
+            self._batch.reset()
+            batch.clear()
+
+        self._batch.reset()
+        try:
+            for k, offset, piece in pieces:
+                if batch and (
+                    self._batch.n_tokens() + len(piece) > self.n_batch
+                    or n_cells + len(piece) > self._n_ctx
+                ):
+                    decode_batch()
+                if k not in seq_ids:
+                    # Fork the context into a new sequence
+                    seq_id = free_seq_ids.pop() if free_seq_ids else len(seq_ids) + 1
+                    self._ctx.kv_cache_seq_cp(0, seq_id, -1, -1)
+                    seq_ids[k] = seq_id
+                self._batch.add_sequence(
+                    piece, seq_ids[k], logits_all=True, n_past=n_context + offset
+                )
+                batch.append((k, offset, piece))
+                n_cells += len(piece)
+            if batch:
+                decode_batch()
+        finally:
+            self._batch.reset()
+            for seq_id in seq_ids.values():
+                self._ctx.kv_cache_seq_rm(seq_id, -1, -1)
+
+        return results
+
     def _create_completion(
         self,
         prompt: Union[str, List[int]],
@@ -1161,6 +1676,10 @@ class Llama:
                 RuntimeWarning,
             )
 
+        scheduled = self._use_scheduler(
+            logprobs, stopping_criteria, logits_processor, grammar, logit_bias
+        )
+
         # NOTE: This likely doesn't work correctly for the first token in the prompt
         # because of the extra space added to the start of the prompt_tokens
         if logit_bias is not None:
@@ -1207,19 +1726,65 @@ class Llama:
         else:
             stop_sequences = []
 
-        if logprobs is not None and self.context_params.logits_all is False:
-            raise ValueError(
-                "logprobs is not supported for models created with logits_all=False"
-            )
+        # Keep the logits of the positions logprobs are returned for, scheduled
+        # completions leave the model's own state alone
+        if not scheduled:
+            if logprobs is not None:
+                self._logits_keep_from = 0 if echo else len(prompt_tokens) - 1
+            else:
+                self._logits_keep_from = None
+
+        if self.cache and not scheduled:
+            try:
+                cache_item = self.cache[prompt_tokens]
+                cache_prefix_len = Llama.longest_token_prefix(
+                    cache_item.input_ids[: cache_item.n_tokens].tolist(), prompt_tokens
+                )
+                eval_prefix_len = Llama.longest_token_prefix(
+                    self._input_ids.tolist(), prompt_tokens
+                )
+                if cache_prefix_len > eval_prefix_len:
+                    self.load_state(cache_item)
+                    if self.verbose:
+                        print("Llama._create_completion: cache hit", file=sys.stderr)
+            except KeyError:
+                if self.verbose:
+                    print("Llama._create_completion: cache miss", file=sys.stderr)
 
-        if seed is not None:
+        if seed is not None and not scheduled:
             self._ctx.set_rng_seed(seed)
 
         finish_reason = "length"
         multibyte_fix = 0
         logprobs_or_none = None
 
-        for token, logprobs_info in self.generate(
+        # The completion is detokenized incrementally, `detokenizer.offsets[i]` is
+        # the byte offset of completion_tokens[i] in `all_text`
+        detokenizer = StreamingDetokenizer(
+            self.tokenizer_, prev_tokens=prompt_tokens, bos_token=bos_token_id
+        )
+        for token in completion_tokens:
+            detokenizer.push(token)
+        all_text = detokenizer.text
+        stop_matcher = StopSequenceMatcher(stop_sequences)
+        stop_index: Optional[int] = None
+        # Character length of the returned text, used for logprobs text offsets
+        returned_decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        returned_chars = 0
+
+        def advance_returned(n: int) -> None:
+            nonlocal returned_tokens, returned_chars
+            start = detokenizer.offsets[returned_tokens]
+            returned_tokens += n
+            end = detokenizer.offsets[returned_tokens]
+            returned_chars += len(returned_decoder.decode(bytes(all_text[start:end])))
+
+        if scheduled:
+            # Decoded together with the other in-flight completions
+            generate = functools.partial(self.scheduler.generate, max_tokens=max_tokens)
+        else:
+            generate = self.generate
+        for token, logprobs_info in generate(
             prompt_tokens,
             top_k=top_k,
             top_p=top_p,
@@ -1241,11 +1806,13 @@ class Llama:
         ):
             assert self._model.model is not None
             if llama_cpp.llama_token_is_eog(self._model.model, token):
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+                text = bytes(all_text)
                 finish_reason = "stop"
                 break
 
             completion_tokens.append(token)
+            token_text_offset = len(all_text)
+            piece = detokenizer.push(token)
 
             if logprobs_info and logprobs_or_none is None:
                 logprobs_or_none = {
@@ -1257,11 +1824,16 @@ class Llama:
 
             if logprobs_info:
                 logprobs_or_none["tokens"].append(self.detokenize([token]).decode("utf-8", errors="ignore"))
-                logprobs_or_none["text_offset"].append(len(self.detokenize(completion_tokens[:-1])))
+                logprobs_or_none["text_offset"].append(token_text_offset)
                 logprobs_or_none["token_logprobs"].append(logprobs_info["token_logprob"])
                 logprobs_or_none["top_logprobs"].append(logprobs_info["top_logprobs"])
 
-            all_text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            # Only the bytes of the new token need to be matched
+            stop_index = stop_matcher.feed(piece)
+            if stop_index is not None:
+                text = bytes(all_text[:stop_index])
+                finish_reason = "stop"
+                break
 
             # Contains multi-byte UTF8
             for k, char in enumerate(all_text[-3:]):
@@ -1276,93 +1848,45 @@ class Llama:
                 multibyte_fix -= 1
                 continue
 
-            any_stop = [s for s in stop_sequences if s in all_text]
-            if len(any_stop) > 0:
-                first_stop = any_stop[0]
-                text = all_text[: all_text.index(first_stop)]
-                finish_reason = "stop"
-                break
-
             if stream:
-                remaining_tokens = completion_tokens[returned_tokens:]
-                remaining_text = self.detokenize(
-                    remaining_tokens,
-                    prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-                )
-                remaining_length = len(remaining_text)
-
                 # We want to avoid yielding any characters from
                 # the generated text if they are part of a stop
                 # sequence.
-                first_stop_position = 0
-                for s in stop_sequences:
-                    for i in range(min(len(s), remaining_length), 0, -1):
-                        if remaining_text.endswith(s[:i]):
-                            if i > first_stop_position:
-                                first_stop_position = i
-                            break
-
-                token_end_position = 0
+                remaining_length = len(all_text) - detokenizer.offsets[returned_tokens]
+                first_stop_position = min(stop_matcher.partial_len, remaining_length)
+                returned_limit = len(all_text) - first_stop_position
 
                 if logprobs is not None:
                     # not sure how to handle this branch when dealing
                     # with CJK output, so keep it unchanged
-                    for token in remaining_tokens:
-                        if token == bos_token_id:
-                            continue
-                        token_end_position += len(
-                            self.detokenize(
-                                [token],
-                                prev_tokens=prompt_tokens
-                                + completion_tokens[:returned_tokens],
-                            )
-                        )
+                    while returned_tokens < len(completion_tokens):
+                        token = completion_tokens[returned_tokens]
+                        token_start = detokenizer.offsets[returned_tokens]
+                        token_end = detokenizer.offsets[returned_tokens + 1]
                         # Check if stop sequence is in the token
-                        if token_end_position > (
-                            remaining_length - first_stop_position
-                        ):
+                        if token_end > returned_limit:
                             break
-                        token_str = self.detokenize(
-                            [token],
-                            prev_tokens=prompt_tokens
-                            + completion_tokens[:returned_tokens],
-                        ).decode("utf-8", errors="ignore")
-                        text_offset = len(prompt) + len(
-                            self.detokenize(
-                                completion_tokens[:returned_tokens],
-                                prev_tokens=prompt_tokens
-                                + completion_tokens[:returned_tokens],
-                            ).decode("utf-8", errors="ignore")
+                        if token == bos_token_id:
+                            advance_returned(1)
+                            continue
+                        token_str = bytes(all_text[token_start:token_end]).decode(
+                            "utf-8", errors="ignore"
                         )
+                        text_offset = len(prompt) + returned_chars
                         token_offset = len(prompt_tokens) + returned_tokens
-                        logits = self._scores[token_offset - 1, :]
-                        current_logprobs = Llama.logits_to_logprobs(logits).tolist()
-                        sorted_logprobs = list(
-                            sorted(
-                                zip(current_logprobs, range(len(current_logprobs))),
-                                reverse=True,
-                            )
+                        current_logprobs = Llama.logits_to_logprobs(
+                            self._get_scores(token_offset - 1, token_offset)[0]
                         )
-                        top_logprob = {
-                            self.detokenize([i]).decode(
-                                "utf-8", errors="ignore"
-                            ): logprob
-                            for logprob, i in sorted_logprobs[:logprobs]
-                        }
-                        top_logprob.update({token_str: current_logprobs[int(token)]})
+                        token_logprob = float(current_logprobs[int(token)])
+                        top_logprob = self._top_logprobs(current_logprobs, logprobs)
+                        top_logprob.update({token_str: token_logprob})
                         logprobs_or_none = {
-                            "tokens": [
-                                self.detokenize(
-                                    [token],
-                                    prev_tokens=prompt_tokens
-                                    + completion_tokens[:returned_tokens],
-                                ).decode("utf-8", errors="ignore")
-                            ],
+                            "tokens": [token_str],
                             "text_offset": [text_offset],
-                            "token_logprobs": [current_logprobs[int(token)]],
+                            "token_logprobs": [token_logprob],
                             "top_logprobs": [top_logprob],
                         }
-                        returned_tokens += 1
+                        advance_returned(1)
                         yield {
                             "id": completion_id,
                             "object": "text_completion",
@@ -1370,11 +1894,7 @@ class Llama:
                             "model": model_name,
                             "choices": [
                                 {
-                                    "text": self.detokenize(
-                                        [token],
-                                        prev_tokens=prompt_tokens
-                                        + completion_tokens[:returned_tokens],
-                                    ).decode("utf-8", errors="ignore"),
+                                    "text": token_str,
                                     "index": 0,
                                     "logprobs": logprobs_or_none,
                                     "finish_reason": None,
@@ -1382,32 +1902,22 @@ class Llama:
                             ],
                         }
                 else:
-                    while len(remaining_tokens) > 0:
-                        decode_success = False
-                        for i in range(1, len(remaining_tokens) + 1):
+                    while returned_tokens < len(completion_tokens):
+                        token_start = detokenizer.offsets[returned_tokens]
+                        for i in range(returned_tokens + 1, len(completion_tokens) + 1):
                             try:
-                                bs = self.detokenize(
-                                    remaining_tokens[:i],
-                                    prev_tokens=prompt_tokens
-                                    + completion_tokens[:returned_tokens],
-                                )
-                                ts = bs.decode("utf-8")
-                                decode_success = True
+                                ts = bytes(
+                                    all_text[token_start : detokenizer.offsets[i]]
+                                ).decode("utf-8")
                                 break
                             except UnicodeError:
                                 pass
                         else:
-                            break
-                        if not decode_success:
                             # all remaining tokens cannot be decoded to a UTF-8 character
                             break
-                        token_end_position += len(bs)
-                        if token_end_position > (
-                            remaining_length - first_stop_position
-                        ):
+                        if detokenizer.offsets[i] > returned_limit:
                             break
-                        remaining_tokens = remaining_tokens[i:]
-                        returned_tokens += i
+                        advance_returned(i - returned_tokens)
 
                         yield {
                             "id": completion_id,
@@ -1425,82 +1935,61 @@ class Llama:
                         }
 
             if len(completion_tokens) >= max_tokens:
-                text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+                text = bytes(all_text)
                 finish_reason = "length"
                 break
 
         if stopping_criteria is not None and stopping_criteria(
-            self._input_ids, self._scores[-1, :]
+            self._input_ids, self._get_scores(self.n_tokens - 1, self.n_tokens)[0]
         ):
-            text = self.detokenize(completion_tokens, prev_tokens=prompt_tokens)
+            text = bytes(all_text)
             finish_reason = "stop"
 
         if self.verbose:
             self._ctx.print_timings()
 
         if stream:
-            remaining_tokens = completion_tokens[returned_tokens:]
-            all_text = self.detokenize(
-                remaining_tokens,
-                prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-            )
-            any_stop = [s for s in stop_sequences if s in all_text]
-            if len(any_stop) > 0:
-                end = min(all_text.index(stop) for stop in any_stop)
+            returned_start = detokenizer.offsets[returned_tokens]
+            if stop_index is not None:
+                end = max(stop_index - returned_start, 0)
             else:
-                end = len(all_text)
+                end = len(all_text) - returned_start
 
             token_end_position = 0
-            for token in remaining_tokens:
-                token_end_position += len(
-                    self.detokenize(
-                        [token],
-                        prev_tokens=prompt_tokens + completion_tokens[:returned_tokens],
-                    )
+            while returned_tokens < len(completion_tokens):
+                token = completion_tokens[returned_tokens]
+                token_bytes = bytes(
+                    all_text[
+                        detokenizer.offsets[returned_tokens] : detokenizer.offsets[
+                            returned_tokens + 1
+                        ]
+                    ]
                 )
+                token_end_position += len(token_bytes)
 
                 # logprobs_or_none: Optional[CompletionLogprobs] = None
                 if logprobs is not None:
                     if token == bos_token_id:
+                        advance_returned(1)
                         continue
-                    token_str = self.detokenize([token]).decode(
-                        "utf-8", errors="ignore"
-                    )
-                    text_offset = len(prompt) + len(
-                        self.detokenize(
-                            completion_tokens[:returned_tokens],
-                            prev_tokens=prompt_tokens
-                            + completion_tokens[:returned_tokens],
-                        )
-                    )
+                    token_str = token_bytes.decode("utf-8", errors="ignore")
+                    text_offset = len(prompt) + returned_chars
                     token_offset = len(prompt_tokens) + returned_tokens - 1
-                    logits = self._scores[token_offset, :]
-                    current_logprobs = Llama.logits_to_logprobs(logits).tolist()
-                    sorted_logprobs = list(
-                        sorted(
-                            zip(current_logprobs, range(len(current_logprobs))),
-                            reverse=True,
-                        )
+                    current_logprobs = Llama.logits_to_logprobs(
+                        self._get_scores(token_offset, token_offset + 1)[0]
                     )
-                    top_logprob = {
-                        self.detokenize([i]).decode("utf-8", errors="ignore"): logprob
-                        for logprob, i in sorted_logprobs[:logprobs]
-                    }
-                    top_logprob.update({token_str: current_logprobs[int(token)]})
+                    token_logprob = float(current_logprobs[int(token)])
+                    top_logprob = self._top_logprobs(current_logprobs, logprobs)
+                    top_logprob.update({token_str: token_logprob})
                     logprobs_or_none = {
-                        "tokens": [
-                            self.detokenize([token]).decode("utf-8", errors="ignore")
-                        ],
+                        "tokens": [token_str],
                         "text_offset": [text_offset],
-                        "token_logprobs": [current_logprobs[int(token)]],
+                        "token_logprobs": [token_logprob],
                         "top_logprobs": [top_logprob],
                     }
 
                 if token_end_position >= end:
-                    last_text = self.detokenize([token])
-                    if token_end_position == end - 1:
-                        break
-                    returned_tokens += 1
+                    advance_returned(1)
                     yield {
                         "id": completion_id,
                         "object": "text_completion",
@@ -1508,8 +1997,8 @@ class Llama:
                         "model": model_name,
                         "choices": [
                             {
-                                "text": last_text[
-                                    : len(last_text) - (token_end_position - end)
+                                "text": token_bytes[
+                                    : len(token_bytes) - (token_end_position - end)
                                 ].decode("utf-8", errors="ignore"),
                                 "index": 0,
                                 "logprobs": logprobs_or_none,
@@ -1518,7 +2007,7 @@ class Llama:
                         ],
                     }
                     break
-                returned_tokens += 1
+                advance_returned(1)
                 yield {
                     "id": completion_id,
                     "object": "text_completion",
@@ -1526,9 +2015,7 @@ class Llama:
                     "model": model_name,
                     "choices": [
                         {
-                            "text": self.detokenize([token]).decode(
-                                "utf-8", errors="ignore"
-                            ),
+                            "text": token_bytes.decode("utf-8", errors="ignore"),
                             "index": 0,
                             "logprobs": logprobs_or_none,
                             "finish_reason": None,
@@ -1552,8 +2039,17 @@ class Llama:
                     }
                 ],
             }
+            if self.cache and not scheduled:
+                if self.verbose:
+                    print("Llama._create_completion: cache save", file=sys.stderr)
+                self.cache[prompt_tokens + completion_tokens] = self.save_state()
             return
 
+        if self.cache and not scheduled:
+            if self.verbose:
+                print("Llama._create_completion: cache save", file=sys.stderr)
+            self.cache[prompt_tokens + completion_tokens] = self.save_state()
+
         text_str = text.decode("utf-8", errors="ignore")
 
         if echo:
@@ -1580,41 +2076,35 @@ class Llama:
             else:
                 all_tokens = completion_tokens
 
-            all_token_strs = [
-                self.detokenize([token], prev_tokens=all_tokens[:i]).decode(
-                    "utf-8", errors="ignore"
-                )
-                for i, token in enumerate(all_tokens)
-            ]
-            all_logprobs = Llama.logits_to_logprobs(self._scores)[token_offset:]
-            # TODO: may be able to change this loop to use np.take_along_dim
+            # Detokenize once, keeping the character offset before every token
+            all_detokenizer = StreamingDetokenizer(
+                self.tokenizer_, bos_token=bos_token_id
+            )
+            all_decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            all_token_strs: List[str] = []
+            all_text_offsets: List[int] = []
+            n_chars = 0
+            for token in all_tokens:
+                all_text_offsets.append(n_chars)
+                token_bytes = all_detokenizer.push(token)
+                all_token_strs.append(token_bytes.decode("utf-8", errors="ignore"))
+                n_chars += len(all_decoder.decode(token_bytes))
+            all_logprobs = Llama.logits_to_logprobs(
+                self._get_scores(token_offset, token_offset + len(all_tokens))
+            )
             for idx, (token, token_str, logprobs_token) in enumerate(
                 zip(all_tokens, all_token_strs, all_logprobs)
             ):
                 if token == bos_token_id:
                     continue
-                text_offsets.append(
-                    text_offset
-                    + len(
-                        self.detokenize(all_tokens[:idx]).decode(
-                            "utf-8", errors="ignore"
-                        )
-                    )
-                )
+                text_offsets.append(text_offset + all_text_offsets[idx])
                 tokens.append(token_str)
-                sorted_logprobs = list(
-                    sorted(
-                        zip(logprobs_token, range(len(logprobs_token))), reverse=True
-                    )
+                token_logprob = float(logprobs_token[int(token)])
+                token_logprobs.append(token_logprob)
+                top_logprob: Optional[Dict[str, float]] = self._top_logprobs(
+                    logprobs_token, logprobs
                 )
-                token_logprobs.append(logprobs_token[int(token)])
-                top_logprob: Optional[Dict[str, float]] = {
-                    self.detokenize([i], prev_tokens=all_tokens[:idx]).decode(
-                        "utf-8", errors="ignore"
-                    ): logprob
-                    for logprob, i in sorted_logprobs[:logprobs]
-                }
-                top_logprob.update({token_str: logprobs_token[int(token)]})
+                top_logprob.update({token_str: token_logprob})
                 top_logprobs.append(top_logprob)
             # Weird idosincracy of the OpenAI API where
             # token_logprobs and top_logprobs are null for
@@ -1740,6 +2230,11 @@ class Llama:
             grammar=grammar,
             logit_bias=logit_bias,
         )
+        if self.scheduler is not None and not self._use_scheduler(
+            logprobs, stopping_criteria, logits_processor, grammar, logit_bias
+        ):
+            # Wait for the scheduled completions and use the context directly
+            completion_or_chunks = self.scheduler.exclusive_iter(completion_or_chunks)
         if stream:
             chunks: Iterator[CreateCompletionStreamResponse] = completion_or_chunks
             return chunks
@@ -2057,13 +2552,21 @@ class Llama:
             n_tokens=self.n_tokens,
             llama_state=bytes(llama_state_compact),
             llama_state_size=n_bytes,
+            scores_offset=self._scores_offset,
         )
 
     def load_state(self, state: LlamaState) -> None:
         assert self._ctx.ctx is not None
-        # Only filling in up to `n_tokens` and then zero-ing out the rest
-        self.scores[: state.n_tokens, :] = state.scores.copy()
-        self.scores[state.n_tokens :, :] = 0.0
+        if self.context_params.logits_all:
+            # Only filling in up to `n_tokens` and then zero-ing out the rest
+            n_scores = state.scores_offset + len(state.scores)
+            self.scores[: state.scores_offset, :] = 0.0
+            self.scores[state.scores_offset : n_scores, :] = state.scores
+            self.scores[n_scores:, :] = 0.0
+        else:
+            self.scores = state.scores.copy()
+            self._scores_offset = state.scores_offset
+            self._n_scores = len(state.scores)
         self.input_ids = state.input_ids.copy()
         self.n_tokens = state.n_tokens
         state_size = state.llama_state_size
@@ -2112,6 +2615,22 @@ class Llama:
     def __del__(self) -> None:
         self.close()
 
+    def _top_logprobs(
+        self, logprobs_token: npt.NDArray[np.single], k: int
+    ) -> Dict[str, float]:
+        """Return the `k` most likely tokens of a row of logprobs keyed by their text."""
+        k = min(k, logprobs_token.shape[-1])
+        if k <= 0:
+            return {}
+        top_ids = np.argpartition(logprobs_token, -k)[-k:]
+        top_ids = top_ids[np.argsort(logprobs_token[top_ids])[::-1]]
+        return {
+            self.detokenize([int(i)]).decode("utf-8", errors="ignore"): float(
+                logprobs_token[i]
+            )
+            for i in top_ids
+        }
+
     @staticmethod
     def logits_to_logprobs(
         logits: Union[npt.NDArray[np.single], List], axis: int = -1
@@ -2243,12 +2762,15 @@ class LlamaState:
         n_tokens: int,
         llama_state: bytes,
         llama_state_size: int,
+        scores_offset: int = 0,
     ):
         self.input_ids = input_ids
         self.scores = scores
         self.n_tokens = n_tokens
         self.llama_state = llama_state
         self.llama_state_size = llama_state_size
+        # Position of the first row in `scores`
+        self.scores_offset = scores_offset
 
 
 LogitsProcessor = Callable[
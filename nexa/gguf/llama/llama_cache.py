@@ -1,6 +1,11 @@
-import sys
+import os
+import hashlib
+import threading
 from abc import ABC, abstractmethod
 from typing import (
+    Dict,
+    Iterable,
+    List,
     Optional,
     Sequence,
     Tuple,
@@ -8,12 +13,126 @@ from typing import (
 from collections import OrderedDict
 
 import diskcache
+import numpy as np
+import numpy.typing as npt
 
 import nexa.gguf.llama as llama_cpp
 
 from nexa.gguf.llama.llama_types import *
 
 
+class _TokenTrieNode:
+    __slots__ = ("edge", "children", "key", "n_keys")
+
+    def __init__(self, edge: Tuple[int, ...] = ()):
+        self.edge = edge
+        self.children: Dict[int, "_TokenTrieNode"] = {}
+        self.key: Optional[Tuple[int, ...]] = None
+        self.n_keys = 0
+
+
+class _TokenTrie:
+    """Radix trie over token sequences used to find the cached key sharing the
+    longest prefix with a prompt in O(prefix length) instead of scanning every key."""
+
+    def __init__(self, keys: Iterable[Tuple[int, ...]] = ()):
+        self.root = _TokenTrieNode()
+        for key in keys:
+            self.insert(key)
+
+    def __len__(self) -> int:
+        return self.root.n_keys
+
+    def insert(self, key: Tuple[int, ...]) -> None:
+        node = self.root
+        path = [node]
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos])
+            if child is None:
+                child = _TokenTrieNode(key[pos:])
+                node.children[key[pos]] = child
+                node = child
+                path.append(node)
+                pos = len(key)
+                break
+            edge = child.edge
+            n = _common_prefix_len(edge, key, pos)
+            if n < len(edge):
+                # Split the edge so that the shared part becomes its own node
+                mid = _TokenTrieNode(edge[:n])
+                mid.n_keys = child.n_keys
+                child.edge = edge[n:]
+                mid.children[child.edge[0]] = child
+                node.children[key[pos]] = mid
+                child = mid
+            node = child
+            path.append(node)
+            pos += n
+        if node.key is not None:
+            return
+        node.key = key
+        for n in path:
+            n.n_keys += 1
+
+    def remove(self, key: Tuple[int, ...]) -> None:
+        node = self.root
+        path = [node]
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos])
+            if child is None or key[pos : pos + len(child.edge)] != child.edge:
+                return
+            node = child
+            path.append(node)
+            pos += len(child.edge)
+        if node.key is None:
+            return
+        node.key = None
+        for n in path:
+            n.n_keys -= 1
+        # Prune empty branches and merge pass-through nodes to keep the trie compact
+        for parent, child in zip(reversed(path[:-1]), reversed(path[1:])):
+            if child.n_keys == 0:
+                del parent.children[child.edge[0]]
+            elif child.key is None and len(child.children) == 1:
+                (grandchild,) = child.children.values()
+                grandchild.edge = child.edge + grandchild.edge
+                parent.children[child.edge[0]] = grandchild
+
+    def longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        """Return a stored key that shares the longest (non-empty) prefix with `key`."""
+        node = self.root
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos])
+            if child is None:
+                break
+            n = _common_prefix_len(child.edge, key, pos)
+            pos += n
+            node = child
+            if n < len(child.edge):
+                break
+        if pos == 0:
+            return None
+        # Every key below `node` shares exactly `pos` tokens with `key`, prefer the
+        # node's own key, otherwise descend to the nearest stored key.
+        while node.key is None:
+            node = next(iter(node.children.values()))
+        return node.key
+
+
+def _common_prefix_len(edge: Tuple[int, ...], key: Tuple[int, ...], pos: int) -> int:
+    if key[pos : pos + len(edge)] == edge:
+        return len(edge)
+    n = 0
+    for a, b in zip(edge, key[pos:]):
+        if a != b:
+            break
+        n += 1
+    return n
+
+
 class BaseLlamaCache(ABC):
     """Base cache class for a llama.cpp model."""
 
@@ -55,26 +174,23 @@ class LlamaRAMCache(BaseLlamaCache):
         self.cache_state: OrderedDict[Tuple[int, ...], "llama_cpp.llama.LlamaState"] = (
             OrderedDict()
         )
+        self._trie = _TokenTrie()
+        self._cache_size = 0
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, llama_cpp.llama.Llama.longest_token_prefix(k, key))
-            for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        return self._trie.longest_prefix_key(key)
+
+    def _evict(self, key: Tuple[int, ...]) -> None:
+        state = self.cache_state.pop(key)
+        self._trie.remove(key)
+        self._cache_size -= state.llama_state_size
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
@@ -91,10 +207,12 @@ class LlamaRAMCache(BaseLlamaCache):
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
         key = tuple(key)
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._evict(key)
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
-            self.cache_state.popitem(last=False)
+        self._trie.insert(key)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            self._evict(next(iter(self.cache_state)))
 
 
 # Alias for backwards compatibility
@@ -108,48 +226,160 @@ class LlamaDiskCache(BaseLlamaCache):
         self, cache_dir: str = ".cache/llama_cache", capacity_bytes: int = (2 << 30)
     ):
         super().__init__(capacity_bytes)
-        self.cache = diskcache.Cache(cache_dir)
+        self.cache = diskcache.Cache(
+            cache_dir,
+            size_limit=capacity_bytes,
+            eviction_policy="least-recently-used",
+        )
+        self._trie = _TokenTrie(self.cache.iterkeys())  # type: ignore
 
     @property
     def cache_size(self):
+        # diskcache keeps the volume counter up to date on every write
         return int(self.cache.volume())  # type: ignore
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key: Optional[Tuple[int, ...]] = None
-        for k in self.cache.iterkeys():  # type: ignore
-            prefix_len = llama_cpp.llama.Llama.longest_token_prefix(k, key)
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k  # type: ignore
-        return min_key
+        while True:
+            _key = self._trie.longest_prefix_key(key)
+            if _key is None or _key in self.cache:
+                return _key
+            # Entry was culled by diskcache since it was indexed
+            self._trie.remove(_key)
 
     def __getitem__(self, key: Sequence[int]) -> "llama_cpp.llama.LlamaState":
         key = tuple(key)
-        _key = self._find_longest_prefix_key(key)
-        if _key is None:
-            raise KeyError("Key not found")
-        value: "llama_cpp.llama.LlamaState" = self.cache.pop(_key)  # type: ignore
-        # NOTE: This puts an integer as key in cache, which breaks,
-        # Llama.longest_token_prefix(k, key) above since k is not a tuple of ints/tokens
-        # self.cache.push(_key, side="front")  # type: ignore
-        return value
+        while True:
+            _key = self._find_longest_prefix_key(key)
+            if _key is None:
+                raise KeyError("Key not found")
+            # Reading updates the access time used by the LRU eviction policy
+            value: Optional["llama_cpp.llama.LlamaState"] = self.cache.get(_key)  # type: ignore
+            if value is not None:
+                return value
+            self._trie.remove(_key)
 
     def __contains__(self, key: Sequence[int]) -> bool:
         return self._find_longest_prefix_key(tuple(key)) is not None
 
     def __setitem__(self, key: Sequence[int], value: "llama_cpp.llama.LlamaState"):
-        print("LlamaDiskCache.__setitem__: called", file=sys.stderr)
         key = tuple(key)
-        if key in self.cache:
-            print("LlamaDiskCache.__setitem__: delete", file=sys.stderr)
-            del self.cache[key]
         self.cache[key] = value
-        print("LlamaDiskCache.__setitem__: set", file=sys.stderr)
-        while self.cache_size > self.capacity_bytes and len(self.cache) > 0:
-            key_to_remove = next(iter(self.cache))
-            del self.cache[key_to_remove]
-        print("LlamaDiskCache.__setitem__: trim", file=sys.stderr)
\ No newline at end of file
+        self._trie.insert(key)
+        if self.cache_size > self.capacity_bytes:
+            self.cache.cull()
+
+
+class LlamaEmbeddingCache:
+    """Content-addressed cache of pooled embeddings on disk.
+
+    Embeddings are stored as rows of a memory-mapped float32 file per model, and
+    a diskcache index maps (model hash, normalize, truncation length, text hash)
+    to the row and the number of tokens that were embedded. The truncation length
+    is the number of tokens inputs are cut to, None if they are not truncated.
+    """
+
+    def __init__(self, cache_dir: str = ".cache/llama_embedding_cache"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # Index entries are tiny, never evict them or rows would be orphaned silently
+        self.index = diskcache.Cache(
+            os.path.join(cache_dir, "index"), eviction_policy="none"
+        )
+        self._vectors: Dict[str, np.memmap] = {}
+        self._lock = threading.Lock()
+
+    def model_hash(self, *paths: str) -> str:
+        """Hash the contents of the model (and adapter) files.
+
+        File digests are remembered by path, size and modification time so each
+        file is only read once.
+        """
+        h = hashlib.sha256()
+        for path in paths:
+            stat = os.stat(path)
+            key = ("file", os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+            digest: Optional[str] = self.index.get(key)  # type: ignore
+            if digest is None:
+                file_hash = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 24), b""):
+                        file_hash.update(chunk)
+                digest = file_hash.hexdigest()
+                self.index.set(key, digest)
+            h.update(digest.encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def _key(model_hash: str, normalize: bool, truncate: Optional[int], text: str) -> Tuple:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return ("embedding", model_hash, bool(normalize), truncate, text_hash)
+
+    def _map(self, model_hash: str, n_embd: int, n_rows: int) -> np.memmap:
+        """Map the vector file of a model, growing it to hold at least `n_rows` rows."""
+        name = f"{model_hash}-{n_embd}"
+        vectors = self._vectors.get(name)
+        if vectors is not None and len(vectors) >= n_rows:
+            return vectors
+        path = os.path.join(self.cache_dir, f"{name}.f32")
+        row_bytes = n_embd * np.dtype(np.float32).itemsize
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < n_rows * row_bytes:
+            size = max(n_rows, 2 * (size // row_bytes), 1024) * row_bytes
+            with open(path, "ab") as f:
+                f.truncate(size)
+        vectors = np.memmap(
+            path, dtype=np.float32, mode="r+", shape=(size // row_bytes, n_embd)
+        )
+        self._vectors[name] = vectors
+        return vectors
+
+    def get(
+        self,
+        model_hash: str,
+        n_embd: int,
+        normalize: bool,
+        truncate: Optional[int],
+        texts: Sequence[str],
+    ) -> List[Optional[Tuple[npt.NDArray[np.single], int]]]:
+        """Look up the embedding and token count of each text, None if not cached."""
+        results: List[Optional[Tuple[npt.NDArray[np.single], int]]] = []
+        for text in texts:
+            entry = self.index.get(self._key(model_hash, normalize, truncate, text))
+            if entry is None:
+                results.append(None)
+                continue
+            row, n_tokens = entry  # type: ignore
+            with self._lock:
+                vectors = self._map(model_hash, n_embd, row + 1)
+                results.append((np.array(vectors[row]), n_tokens))
+        return results
+
+    def put(
+        self,
+        model_hash: str,
+        normalize: bool,
+        truncate: Optional[int],
+        texts: Sequence[str],
+        embeddings: npt.NDArray[np.single],
+        n_tokens: Sequence[int],
+    ) -> None:
+        """Store a (len(texts), n_embd) array of embeddings."""
+        if len(texts) == 0:
+            return
+        n_embd = embeddings.shape[1]
+        rows_key = ("rows", model_hash, n_embd)
+        # The transaction serializes row allocation with other processes sharing the cache
+        with self._lock, self.index.transact():
+            start: int = self.index.get(rows_key, 0)  # type: ignore
+            vectors = self._map(model_hash, n_embd, start + len(texts))
+            vectors[start : start + len(texts)] = embeddings
+            vectors.flush()
+            for i, text in enumerate(texts):
+                self.index.set(
+                    self._key(model_hash, normalize, truncate, text),
+                    (start + i, int(n_tokens[i])),
+                )
+            self.index.set(rows_key, start + len(texts))
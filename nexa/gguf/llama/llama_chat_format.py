@@ -7,7 +7,13 @@ import ctypes
 import dataclasses
 import random
 import string
+import hashlib
+import functools
+import weakref
+import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
 from typing import (
     Any,
@@ -161,6 +167,29 @@ def register_chat_completion_handler(name: str):
 ### Chat Formatter ###
 
 
+# Compiled templates are immutable and safe to render from several threads
+_CHAT_TEMPLATE_ENVIRONMENT = ImmutableSandboxedEnvironment(
+    loader=jinja2.BaseLoader(),
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+_STRICT_TEMPLATE_ENVIRONMENT = ImmutableSandboxedEnvironment(
+    autoescape=jinja2.select_autoescape(["html", "xml"]),
+    undefined=jinja2.StrictUndefined,
+)
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_template(template: str, strict: bool = False) -> jinja2.Template:
+    """Compile a jinja2 template once per process, keyed by its source.
+
+    Chat templates trim blocks, `strict` templates raise on undefined variables
+    and escape html instead (used by the function calling handlers)."""
+    if strict:
+        return _STRICT_TEMPLATE_ENVIRONMENT.from_string(template)
+    return _CHAT_TEMPLATE_ENVIRONMENT.from_string(template)
+
+
 @dataclasses.dataclass
 class ChatFormatterResponse:
     """Dataclass that stores completion parameters for a given chat format and
@@ -207,11 +236,7 @@ class Jinja2ChatFormatter(ChatFormatter):
             set(stop_token_ids) if stop_token_ids is not None else None
         )
 
-        self._environment = ImmutableSandboxedEnvironment(
-            loader=jinja2.BaseLoader(),
-            trim_blocks=True,
-            lstrip_blocks=True,
-        ).from_string(self.template)
+        self._environment = _compile_template(self.template)
 
     def __call__(
         self,
@@ -569,10 +594,9 @@ def chat_formatter_to_chat_completion_handler(
             tools=tools,
             tool_choice=tool_choice,
         )
-        prompt = llama.tokenize(
+        prompt = llama.tokenize_prompt(
             result.prompt.encode("utf-8"),
             add_bos=not result.added_special,
-            special=True,
         )
         if result.stop is not None:
             stop = [] if stop is None else [stop] if isinstance(stop, str) else stop
@@ -720,10 +744,7 @@ def hf_tokenizer_config_to_chat_formatter(
     assert isinstance(tokenizer_config["eos_token"], str)
     eos_token = tokenizer_config["eos_token"]
 
-    env = ImmutableSandboxedEnvironment(
-        trim_blocks=True,
-        lstrip_blocks=True,
-    ).from_string(chat_template)
+    env = _compile_template(chat_template)
 
     def format_tokenizer_config(
         messages: List[llama_types.ChatCompletionRequestMessage],
@@ -1663,14 +1684,9 @@ def functionary_chat_handler(
     if function_body is not None:
         try:
             with suppress_stdout_stderr(disable=llama.verbose):
-                grammar_text = llama_grammar.json_schema_to_gbnf(
-                    json.dumps(function_body)
-                )
-                grammar = llama_grammar.LlamaGrammar.from_string(
-                    llama_grammar.json_schema_to_gbnf(json.dumps(function_body)),
-                    verbose=llama.verbose,
+                grammar = llama_grammar.LlamaGrammar.from_json_schema(
+                    json.dumps(function_body), verbose=llama.verbose
                 )
-                print(grammar_text)
         except Exception as e:
             if llama.verbose:
                 print(
@@ -2017,13 +2033,9 @@ def functionary_v1_v2_chat_handler(
 
         try:
             with suppress_stdout_stderr(disable=llama.verbose):
-                grammar_text = llama_grammar.json_schema_to_gbnf(
+                grammar = llama_grammar.LlamaGrammar.from_json_schema(
                     json.dumps(function_body)
                 )
-                grammar = llama_grammar.LlamaGrammar.from_string(
-                    llama_grammar.json_schema_to_gbnf(json.dumps(function_body))
-                )
-                print(grammar_text)
         except Exception as e:
             if llama.verbose:
                 print(
@@ -2695,18 +2707,29 @@ class Llava15ChatHandler:
         "{% endif %}"
     )
 
-    def __init__(self, clip_model_path: str, verbose: bool = True):
+    def __init__(
+        self,
+        clip_model_path: str,
+        verbose: bool = True,
+        image_cache_bytes: int = (256 << 20),
+    ):
         import nexa.gguf.llama.llava_cpp as llava_cpp
 
         self.clip_model_path = clip_model_path
         self.verbose = verbose
+        self.image_cache_bytes = image_cache_bytes
 
         self._llava_cpp = llava_cpp  # TODO: Fix
         self._exit_stack = ExitStack()
-        self._last_image_embed: Optional[
-            llava_cpp.CtypesPointer[llava_cpp.llava_image_embed]
-        ] = None
-        self._last_image_hash: Optional[int] = None
+        # LRU of image embeddings by image digest, as (embed, size in bytes)
+        self._image_embeds: OrderedDict[
+            bytes, Tuple[llava_cpp.CtypesPointer[llava_cpp.llava_image_embed], int]
+        ] = OrderedDict()
+        self._image_embeds_size = 0
+        self._image_embeds_lock = threading.Lock()
+        # Images in the KV cache of the last llama used, as (start, end, digest)
+        self._image_spans: List[Tuple[int, int, bytes]] = []
+        self._image_spans_llama: Optional[weakref.ReferenceType] = None
 
         if not os.path.exists(clip_model_path):
             raise ValueError(f"Clip model path does not exist: {clip_model_path}")
@@ -2725,17 +2748,48 @@ class Llava15ChatHandler:
 
             self._exit_stack.callback(clip_free)
 
-        def last_image_embed_free():
+        def image_embeds_free():
             with suppress_stdout_stderr(disable=self.verbose):
-                if self._last_image_embed is not None:
-                    self._llava_cpp.llava_image_embed_free(self._last_image_embed)
-                    self._last_image_embed = None
+                self._trim_image_embeds(0)
 
-        self._exit_stack.callback(last_image_embed_free)
+        self._exit_stack.callback(image_embeds_free)
 
     def load_image(self, image_url: str) -> bytes:
         return self._load_image(image_url)
 
+    def _embed_image(self, llama: llama.Llama, image_digest: bytes, image_bytes: bytes):
+        """Return the CLIP embedding of an image, encoding it on a cache miss."""
+        with self._image_embeds_lock:
+            entry = self._image_embeds.get(image_digest)
+            if entry is not None:
+                self._image_embeds.move_to_end(image_digest)
+                return entry[0]
+        # The image bytes are only read, pass the buffer of the bytes object as is
+        embed = self._llava_cpp.llava_image_embed_make_with_bytes(
+            self.clip_ctx,
+            llama.context_params.n_threads_batch,
+            ctypes.cast(ctypes.c_char_p(image_bytes), ctypes.POINTER(ctypes.c_uint8)),
+            len(image_bytes),
+        )
+        size = embed.contents.n_image_pos * llama.n_embd() * ctypes.sizeof(ctypes.c_float)
+        with self._image_embeds_lock:
+            entry = self._image_embeds.get(image_digest)
+            if entry is not None:
+                # Encoded concurrently by another request
+                self._llava_cpp.llava_image_embed_free(embed)
+                return entry[0]
+            self._image_embeds[image_digest] = (embed, size)
+            self._image_embeds_size += size
+        return embed
+
+    def _trim_image_embeds(self, capacity_bytes: int):
+        """Free the least recently used image embeddings until they fit in `capacity_bytes`."""
+        with self._image_embeds_lock:
+            while self._image_embeds and self._image_embeds_size > capacity_bytes:
+                _, (embed, size) = self._image_embeds.popitem(last=False)
+                self._llava_cpp.llava_image_embed_free(embed)
+                self._image_embeds_size -= size
+
     def __call__(
         self,
         *,
@@ -2786,10 +2840,7 @@ class Llava15ChatHandler:
             ] + messages
 
         image_urls = self.get_image_urls(messages)
-        template = ImmutableSandboxedEnvironment(
-            trim_blocks=True,
-            lstrip_blocks=True,
-        ).from_string(self.CHAT_FORMAT)
+        template = _compile_template(self.CHAT_FORMAT)
         text = template.render(
             messages=messages,
             add_generation_prompt=True,
@@ -2798,63 +2849,123 @@ class Llava15ChatHandler:
         )
         split_text = self.split_text_on_image_urls(text, image_urls)
 
-        def embed_image_bytes(image_bytes: bytes):
-            if (
-                self._last_image_embed is not None
-                and self._last_image_hash is not None
-                and hash(image_bytes) == self._last_image_hash
-            ):
-                return self._last_image_embed
-            with suppress_stdout_stderr(disable=self.verbose):
-                # Free the previous image embed
-                if self._last_image_embed is not None:
-                    self._llava_cpp.llava_image_embed_free(self._last_image_embed)
-                    self._last_image_embed = None
-                    self._last_image_hash = None
-                embed = self._llava_cpp.llava_image_embed_make_with_bytes(
-                    self.clip_ctx,
-                    llama.context_params.n_threads_batch,
-                    (ctypes.c_uint8 * len(image_bytes)).from_buffer(
-                        bytearray(image_bytes)
-                    ),
-                    len(image_bytes),
-                )
-                self._last_image_embed = embed
-                self._last_image_hash = hash(image_bytes)
-                return embed
+        # Load all images of the prompt concurrently
+        prompt_image_urls = [value for type_, value in split_text if type_ == "image_url"]
+        if len(prompt_image_urls) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(prompt_image_urls), 8)) as executor:
+                images = list(executor.map(self.load_image, prompt_image_urls))
+        else:
+            images = [self.load_image(url) for url in prompt_image_urls]
 
-        # Evaluate prompt
-        llama.reset()
-        llama._ctx.kv_cache_clear()
+        # Tokenize text and identify images by content digest
+        segments: List[Tuple[Literal["text", "image_url"], Any]] = []
+        image_iter = iter(images)
         for type_, value in split_text:
             if type_ == "text":
                 tokens = llama.tokenize(
                     value.encode("utf8"), add_bos=False, special=True
                 )
-                if llama.n_tokens + len(tokens) > llama.n_ctx():
-                    raise ValueError(
-                        f"Prompt exceeds n_ctx: {llama.n_tokens + len(tokens)} > {llama.n_ctx()}"
-                    )
-                llama.eval(tokens)
+                segments.append(("text", tokens))
             else:
-                image_bytes = self.load_image(value)
-                embed = embed_image_bytes(image_bytes)
-                if llama.n_tokens + embed.contents.n_image_pos > llama.n_ctx():
-                    raise ValueError(
-                        f"Prompt exceeds n_ctx: {llama.n_tokens + embed.contents.n_image_pos} > {llama.n_ctx()}"
-                    )
-                n_past = ctypes.c_int(llama.n_tokens)
-                n_past_p = ctypes.pointer(n_past)
-                with suppress_stdout_stderr(disable=self.verbose):
-                    self._llava_cpp.llava_eval_image_embed(
-                        llama.ctx,
-                        embed,
-                        llama.n_batch,
-                        n_past_p,
+                image_bytes = next(image_iter)
+                segments.append(
+                    ("image_url", (hashlib.sha256(image_bytes).digest(), image_bytes))
+                )
+
+        # Find the longest prefix of the prompt that is already in the KV cache
+        if self._image_spans_llama is None or self._image_spans_llama() is not llama:
+            self._image_spans = []
+        spans = {
+            start: (end, digest)
+            for start, end, digest in self._image_spans
+            if end <= llama.n_tokens
+        }
+        n_keep = 0
+        first_segment, first_offset = len(segments), 0
+        for i, (type_, value) in enumerate(segments):
+            if type_ == "text":
+                limit = min(len(value), llama.n_tokens - n_keep)
+                mismatch = np.flatnonzero(
+                    llama.input_ids[n_keep : n_keep + limit] != value[:limit]
+                )
+                n_match = int(mismatch[0]) if len(mismatch) > 0 else limit
+                n_keep += n_match
+                if n_match < len(value):
+                    first_segment, first_offset = i, n_match
+                    break
+            else:
+                span = spans.get(n_keep)
+                if (
+                    span is None
+                    or span[1] != value[0]
+                    or not np.all(llama.input_ids[n_keep : span[0]] == -1)
+                ):
+                    first_segment, first_offset = i, 0
+                    break
+                n_keep = span[0]
+
+        # Evaluate the rest of the prompt
+        if n_keep == 0:
+            llama.reset()
+            llama._ctx.kv_cache_clear()
+        else:
+            llama.n_tokens = n_keep
+            llama._ctx.kv_cache_seq_rm(-1, n_keep, -1)
+        self._image_spans = [span for span in self._image_spans if span[1] <= n_keep]
+        self._image_spans_llama = weakref.ref(llama)
+        if llama.verbose and n_keep > 0:
+            print(
+                f"{type(self).__name__}: {n_keep} prompt tokens reused from the KV cache",
+                file=sys.stderr,
+            )
+        # Encode the images on a background thread, CLIP runs while the text before
+        # each image is evaluated. Output of both threads is suppressed here at once
+        # as redirecting file descriptors is not thread safe.
+        with suppress_stdout_stderr(disable=self.verbose), ThreadPoolExecutor(
+            max_workers=1
+        ) as executor:
+            image_embeds = {}
+            for type_, value in segments[first_segment:]:
+                if type_ == "image_url" and value[0] not in image_embeds:
+                    image_embeds[value[0]] = executor.submit(
+                        self._embed_image, llama, *value
                     )
-                # Required to avoid issues with hf tokenizer
-                llama.input_ids[llama.n_tokens : n_past.value] = -1
-                llama.n_tokens = n_past.value
+            try:
+                for i in range(first_segment, len(segments)):
+                    type_, value = segments[i]
+                    if type_ == "text":
+                        tokens = value[first_offset:] if i == first_segment else value
+                        if llama.n_tokens + len(tokens) > llama.n_ctx():
+                            raise ValueError(
+                                f"Prompt exceeds n_ctx: {llama.n_tokens + len(tokens)} > {llama.n_ctx()}"
+                            )
+                        llama.eval(tokens)
+                    else:
+                        image_digest = value[0]
+                        embed = image_embeds[image_digest].result()
+                        if llama.n_tokens + embed.contents.n_image_pos > llama.n_ctx():
+                            raise ValueError(
+                                f"Prompt exceeds n_ctx: {llama.n_tokens + embed.contents.n_image_pos} > {llama.n_ctx()}"
+                            )
+                        n_past = ctypes.c_int(llama.n_tokens)
+                        n_past_p = ctypes.pointer(n_past)
+                        self._llava_cpp.llava_eval_image_embed(
+                            llama.ctx,
+                            embed,
+                            llama.n_batch,
+                            n_past_p,
+                        )
+                        # Required to avoid issues with hf tokenizer
+                        llama.input_ids[llama.n_tokens : n_past.value] = -1
+                        self._image_spans.append(
+                            (llama.n_tokens, n_past.value, image_digest)
+                        )
+                        llama.n_tokens = n_past.value
+            finally:
+                # Embeddings are only freed once no longer needed by this prompt
+                for future in image_embeds.values():
+                    future.exception()
+                self._trim_image_embeds(self.image_cache_bytes)
 
         # Get prompt tokens to avoid a cache miss
         prompt = llama.input_ids[: llama.n_tokens].tolist()
@@ -3422,10 +3533,7 @@ def chatml_function_calling(
         "{% endfor %}"
         "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
     )
-    template_renderer = ImmutableSandboxedEnvironment(
-        autoescape=jinja2.select_autoescape(["html", "xml"]),
-        undefined=jinja2.StrictUndefined,
-    ).from_string(function_calling_template)
+    template_renderer = _compile_template(function_calling_template, strict=True)
 
     # Convert legacy functions to tools
     if functions is not None:
@@ -3,9 +3,11 @@
 # flake8: noqa
 from pathlib import Path
 import sys
+import codecs
 import ctypes
 import enum
 import typing
+import functools
 import dataclasses
 
 from itertools import groupby
@@ -832,41 +834,233 @@ def print_grammar(file: typing.TextIO, state: ParseState) -> None:
         raise err
 
 
-class LlamaGrammar:
+class _LlamaGrammarRules:
+    """The ctypes rule arrays of a parsed grammar.
+
+    `llama_grammar_init` copies the rules into the grammar it creates, so the
+    arrays are built once and shared by every grammar of the same text.
+    """
+
     def __init__(self, parse_state: ParseState):
         self.parse_state = parse_state
 
-        self._grammar_rules = parse_state.rules
-        self._n_rules = len(self._grammar_rules)
-        self._start_rule_index = parse_state.symbol_ids["root"]
+        self.grammar_rules = parse_state.rules
+        self.n_rules = len(self.grammar_rules)
+        self.start_rule_index = parse_state.symbol_ids["root"]
 
-        self._element_lists = [
+        self.element_lists = [
             [
                 llama_cpp.llama_grammar_element(ctypes.c_int(elem.type), ctypes.c_uint32(elem.value))
                 for elem in subvector
             ]
-            for subvector in self._grammar_rules
+            for subvector in self.grammar_rules
         ]
 
         # Step 2: Convert each list to llama_grammar_element array and get pointer
-        self._element_arrays = [
+        self.element_arrays = [
             (llama_cpp.llama_grammar_element * len(sublist))(*sublist)
-            for sublist in self._element_lists
+            for sublist in self.element_lists
         ]
 
         # Step 3: Get pointer of each array
-        self._element_array_pointers = [
-            ctypes.cast(subarray, llama_cpp.llama_grammar_element_p) for subarray in self._element_arrays
+        self.element_array_pointers = [
+            ctypes.cast(subarray, llama_cpp.llama_grammar_element_p) for subarray in self.element_arrays
         ]
 
         # Step 4: Make array of these pointers and get its pointer
-        self._rules = (llama_cpp.llama_grammar_element_p * len(self._element_array_pointers))(
-            *self._element_array_pointers
+        self.rules = (llama_cpp.llama_grammar_element_p * len(self.element_array_pointers))(
+            *self.element_array_pointers
+        )
+
+
+class _LlamaGrammarMatcher:
+    """Character level copy of the parse stacks of a grammar.
+
+    Mirrors `llama_grammar_advance_stack` and `llama_grammar_match_char` of
+    llama.cpp in Python, so the text the grammar forces next can be read off the
+    stacks without trying every token of the vocabulary. It has to be fed every
+    token the grammar accepts, with `accept_bytes`.
+    """
+
+    # Ambiguous grammars can have many stacks, give up on those
+    max_stacks = 256
+    # Character classes larger than this are never forced
+    max_class_size = 64
+    whitespace = frozenset(map(ord, " \t\n\r"))
+
+    def __init__(self, rules: typing.List[typing.List[GrammarElement]], start_rule_index: int):
+        self._rules = [[(int(elem.type), elem.value) for elem in rule] for rule in rules]
+        self._alternatives = [
+            [0] + [i + 1 for i, (type_, _) in enumerate(rule) if type_ == GrammarElementType.ALT]
+            for rule in self._rules
+        ]
+        self._char_sets: typing.Dict[typing.Tuple[int, int], Optional[typing.FrozenSet[int]]] = {}
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.stacks: Optional[Set[tuple]] = self._advance_all(
+            () if self._is_end(start_rule_index, start) else ((start_rule_index, start),)
+            for start in self._alternatives[start_rule_index]
         )
 
+    def _is_end(self, rule: int, pos: int) -> bool:
+        return self._rules[rule][pos][0] in (GrammarElementType.END, GrammarElementType.ALT)
+
+    def _advance(self, stack: tuple, out: Set[tuple]):
+        """Expand rule references until every stack has a character element on top."""
+        if not stack:
+            out.add(stack)
+            return
+        rule, pos = stack[-1]
+        type_, value = self._rules[rule][pos]
+        if type_ != GrammarElementType.RULE_REF:
+            out.add(stack)
+            return
+        base = stack[:-1]
+        if not self._is_end(rule, pos + 1):
+            base += ((rule, pos + 1),)
+        for start in self._alternatives[value]:
+            if self._is_end(value, start):
+                self._advance(base, out)
+            else:
+                self._advance(base + ((value, start),), out)
+
+    def _advance_all(self, stacks: typing.Iterable[tuple]) -> Optional[Set[tuple]]:
+        out: Set[tuple] = set()
+        for stack in stacks:
+            self._advance(stack, out)
+            if len(out) > self.max_stacks:
+                return None
+        return out
+
+    def _match_char(self, rule: int, pos: int, c: int) -> typing.Tuple[bool, int]:
+        elems = self._rules[rule]
+        positive = elems[pos][0] in (GrammarElementType.CHAR, GrammarElementType.CHAR_ANY)
+        found = False
+        while True:
+            type_, value = elems[pos]
+            if elems[pos + 1][0] == GrammarElementType.CHAR_RNG_UPPER:
+                found = found or value <= c <= elems[pos + 1][1]
+                pos += 2
+            elif type_ == GrammarElementType.CHAR_ANY:
+                found = True
+                pos += 1
+            else:
+                found = found or value == c
+                pos += 1
+            if elems[pos][0] != GrammarElementType.CHAR_ALT:
+                return found == positive, pos
+
+    def _char_set(self, rule: int, pos: int) -> Optional[typing.FrozenSet[int]]:
+        """Return the characters the element at pos matches, None if there are too many."""
+        key = (rule, pos)
+        if key in self._char_sets:
+            return self._char_sets[key]
+        elems = self._rules[rule]
+        chars: Optional[Set[int]] = None
+        if elems[pos][0] == GrammarElementType.CHAR:
+            chars = set()
+            while True:
+                type_, value = elems[pos]
+                if elems[pos + 1][0] == GrammarElementType.CHAR_RNG_UPPER:
+                    upper = elems[pos + 1][1]
+                    if upper - value >= self.max_class_size:
+                        chars = None
+                        break
+                    chars.update(range(value, upper + 1))
+                    pos += 2
+                else:
+                    chars.add(value)
+                    pos += 1
+                if elems[pos][0] != GrammarElementType.CHAR_ALT:
+                    break
+        result = frozenset(chars) if chars is not None and len(chars) <= self.max_class_size else None
+        self._char_sets[key] = result
+        return result
+
+    def _accept_char(self, stacks: Set[tuple], c: int) -> Optional[Set[tuple]]:
+        advanced = []
+        for stack in stacks:
+            if not stack:
+                continue
+            rule, pos = stack[-1]
+            matched, pos = self._match_char(rule, pos, c)
+            if matched:
+                base = stack[:-1]
+                if not self._is_end(rule, pos):
+                    base += ((rule, pos),)
+                advanced.append(base)
+        return self._advance_all(advanced)
+
+    def accept_bytes(self, data: bytes):
+        """Advance the stacks over the text of an accepted token."""
+        for char in self._decoder.decode(data):
+            if not self.stacks:
+                return
+            self.stacks = self._accept_char(self.stacks, ord(char))
+
+    def forced_text(self, limit: int) -> str:
+        """Return the text every continuation allowed by the grammar starts with.
+
+        Optional whitespace is skipped: where the only alternatives to a single
+        character are whitespace, that character is taken.
+        """
+        stacks = self.stacks
+        if not stacks or self._decoder.getstate()[0]:
+            return ""
+        text: typing.List[str] = []
+        while stacks and len(text) < limit:
+            allowed: Set[int] = set()
+            for stack in stacks:
+                # An empty stack means the grammar can end here
+                chars = self._char_set(*stack[-1]) if stack else None
+                if chars is None:
+                    return "".join(text)
+                allowed |= chars
+            if len(allowed) > 1:
+                allowed -= self.whitespace
+            if len(allowed) != 1:
+                break
+            c = next(iter(allowed))
+            text.append(chr(c))
+            stacks = self._accept_char(stacks, c)
+        return "".join(text)
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_grammar(grammar: str) -> _LlamaGrammarRules:
+    return _LlamaGrammarRules(parse(grammar))
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_json_schema(json_schema: str) -> str:
+    return json_schema_to_gbnf(json_schema)
+
+
+class LlamaGrammar:
+    def __init__(self, parse_state: ParseState):
+        self._init_rules(_LlamaGrammarRules(parse_state))
+
+    def _init_rules(self, rules: _LlamaGrammarRules):
+        self.parse_state = rules.parse_state
+
+        self._grammar_rules = rules.grammar_rules
+        self._n_rules = rules.n_rules
+        self._start_rule_index = rules.start_rule_index
+        # Keep the shared arrays alive for as long as the grammar
+        self._compiled_rules = rules
+        self._rules = rules.rules
+
         self.grammar = None
         self._init_grammar()
 
+    def _matcher(self) -> _LlamaGrammarMatcher:
+        """Return a character level matcher at the start of the grammar."""
+        return _LlamaGrammarMatcher(self._grammar_rules, self._start_rule_index)
+
+    @classmethod
+    def _from_rules(cls, rules: _LlamaGrammarRules) -> "LlamaGrammar":
+        grammar = cls.__new__(cls)
+        grammar._init_rules(rules)
+        return grammar
 
     def _init_grammar(self):
         grammar = llama_cpp.llama_grammar_init(
@@ -879,7 +1073,7 @@ class LlamaGrammar:
         self.grammar = grammar
 
     def __del__(self):
-        if self.grammar is not None:
+        if getattr(self, "grammar", None) is not None:
             llama_cpp.llama_grammar_free(self.grammar)
             self.grammar = None
 
@@ -890,10 +1084,12 @@ class LlamaGrammar:
 
     @classmethod
     def from_string(cls, grammar: str, verbose: bool = True) -> "LlamaGrammar":
-        parsed_grammar = parse(grammar)
+        # Parsing is cached by grammar text, each call only creates the
+        # grammar state from the shared rules
+        rules = _compile_grammar(grammar)
         if verbose:
-            print_grammar(file=sys.stdout, state=parsed_grammar)
-        return cls(parsed_grammar)
+            print_grammar(file=sys.stdout, state=rules.parse_state)
+        return cls._from_rules(rules)
     
     @classmethod
     def from_file(cls, file: Union[str, Path], verbose: bool = True) -> "LlamaGrammar":
@@ -914,7 +1110,12 @@ class LlamaGrammar:
 
     @classmethod
     def from_json_schema(cls, json_schema: str, verbose: bool = True) -> "LlamaGrammar":
-        return cls.from_string(json_schema_to_gbnf(json_schema), verbose=verbose)
+        # Canonicalize the formatting so equal schemas share a cache entry,
+        # key order is kept since it sets the order of the properties
+        canonical = json.dumps(
+            json.loads(json_schema), separators=(",", ":"), ensure_ascii=False
+        )
+        return cls.from_string(_compile_json_schema(canonical), verbose=verbose)
 
 
 """llama.cpp gbnf rules from vendor/llama.cpp/grammars"""
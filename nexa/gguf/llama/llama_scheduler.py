@@ -0,0 +1,410 @@
+from __future__ import annotations
+
+import ctypes
+import queue
+import threading
+import contextlib
+
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Deque,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import nexa.gguf.llama.llama_cpp as llama_cpp
+
+from nexa.gguf.llama._internals_transformers import (
+    _LlamaSamplingContext,
+    _LlamaSamplingParams,
+)
+
+if TYPE_CHECKING:
+    from nexa.gguf.llama.llama import Llama
+
+
+class _ScheduledRequest:
+    def __init__(
+        self,
+        tokens: List[int],
+        max_tokens: int,
+        sampling_params: _LlamaSamplingParams,
+    ):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.sampling_params = sampling_params
+        # Sampled tokens, then None once finished (or the exception that ended it)
+        self.output: "queue.Queue[Union[int, Exception, None]]" = queue.Queue()
+        self.n_generated = 0
+        self.cancelled = False
+
+    @property
+    def n_reserve(self) -> int:
+        """Number of KV cells the request can occupy."""
+        return len(self.tokens) + self.max_tokens
+
+
+class _Slot:
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        # Tokens whose KV cells are held by the sequence, kept after the request
+        # finishes so that a later request can reuse the prefix
+        self.tokens: List[int] = []
+        # Tokens to evaluate before the next token can be sampled
+        self.pending: List[int] = []
+        self.request: Optional[_ScheduledRequest] = None
+        self.sampling_context: Optional[_LlamaSamplingContext] = None
+
+
+def _common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class LlamaScheduler:
+    """Continuous batching scheduler for a `Llama` model.
+
+    Concurrent `generate` calls are decoded together: every admitted request
+    gets its own llama.cpp sequence and sampling state, and each step a single
+    `llama_decode` call evaluates the pending prompt chunks and the last sampled
+    token of all in-flight requests.
+
+    Requests are admitted in order while a sequence is free and the KV cache
+    can hold their prompt plus `max_tokens`. The KV cells of a finished request
+    are kept so that a later request sharing a prefix (e.g. the same chat
+    history) does not evaluate it again, and a prefix shared with an in-flight
+    request is copied from its sequence.
+
+    Everything else using the model's context must hold `exclusive()`.
+
+    Args:
+        llama: The model to decode with.
+        n_parallel: Maximum number of requests decoded together.
+    """
+
+    def __init__(self, llama: "Llama", n_parallel: int = 4):
+        if n_parallel < 1:
+            raise ValueError("n_parallel must be at least 1")
+        self.llama = llama
+        self.n_parallel = n_parallel
+        self.n_ctx = llama.n_ctx()
+        # Sequence 0 is used by the model itself
+        self._slots = [_Slot(seq_id=i + 1) for i in range(n_parallel)]
+        self._pending: Deque[_ScheduledRequest] = deque()
+        self._cond = threading.Condition()
+        self._n_exclusive = 0
+        self._exclusive = False
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="LlamaScheduler", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def n_active(self) -> int:
+        """Number of requests being decoded."""
+        return sum(slot.request is not None for slot in self._slots)
+
+    @property
+    def n_pending(self) -> int:
+        """Number of requests waiting to be admitted."""
+        return len(self._pending)
+
+    def generate(
+        self,
+        tokens: Sequence[int],
+        top_k: int = 40,
+        top_p: float = 0.95,
+        min_p: float = 0.05,
+        typical_p: float = 1.0,
+        temp: float = 0.80,
+        repeat_penalty: float = 1.0,
+        reset: bool = True,
+        frequency_penalty: float = 0.0,
+        presence_penalty: float = 0.0,
+        tfs_z: float = 1.0,
+        mirostat_mode: int = 0,
+        mirostat_tau: float = 5.0,
+        mirostat_eta: float = 0.1,
+        penalize_nl: bool = True,
+        logits_processor=None,
+        logprobs: Optional[bool] = None,
+        top_logprobs: Optional[int] = None,
+        stopping_criteria=None,
+        grammar=None,
+        max_tokens: Optional[int] = None,
+    ) -> Generator[Tuple[int, None], None, None]:
+        """Generate tokens like `Llama.generate`, decoded together with the
+        other in-flight requests.
+
+        The generator ends after `max_tokens` tokens or an end-of-generation
+        token; closing it early cancels the request. Logits processors,
+        stopping criteria, grammars and logprobs are not supported.
+
+        Args:
+            tokens: The prompt tokens.
+            max_tokens: Maximum number of tokens to generate, defaults to the rest of the context window.
+
+        Yields:
+            The generated tokens, paired with None in place of logprobs.
+        """
+        if (
+            logits_processor is not None
+            or stopping_criteria is not None
+            or grammar is not None
+            or logprobs
+        ):
+            raise ValueError(
+                "LlamaScheduler does not support logits processors, stopping criteria, grammars or logprobs"
+            )
+        tokens = list(tokens)
+        if len(tokens) == 0 or len(tokens) >= self.n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx}"
+            )
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = self.n_ctx - len(tokens)
+        max_tokens = min(max_tokens, self.n_ctx - len(tokens))
+        request = _ScheduledRequest(
+            tokens,
+            max_tokens,
+            _LlamaSamplingParams(
+                top_k=top_k,
+                top_p=top_p,
+                min_p=min_p,
+                tfs_z=tfs_z,
+                typical_p=typical_p,
+                temp=temp,
+                penalty_last_n=self.llama.last_n_tokens_size,
+                penalty_repeat=repeat_penalty,
+                penalty_freq=frequency_penalty,
+                penalty_present=presence_penalty,
+                mirostat=mirostat_mode,
+                mirostat_tau=mirostat_tau,
+                mirostat_eta=mirostat_eta,
+                penalize_nl=penalize_nl,
+            ),
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("LlamaScheduler is closed")
+            self._pending.append(request)
+            self._cond.notify_all()
+        try:
+            while True:
+                item = request.output.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item, None
+        finally:
+            with self._cond:
+                request.cancelled = True
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """Wait for the in-flight requests to finish and hold the context.
+
+        No request is admitted while a caller is waiting for or holding the
+        context, the model can be used directly in the meantime.
+        """
+        with self._cond:
+            self._n_exclusive += 1
+            try:
+                while self._exclusive or self.n_active > 0:
+                    self._cond.wait()
+            except BaseException:
+                self._n_exclusive -= 1
+                self._cond.notify_all()
+                raise
+            self._exclusive = True
+            # Free the cells kept for prefix reuse
+            for slot in self._slots:
+                self._clear_slot(slot)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._n_exclusive -= 1
+                self._cond.notify_all()
+
+    def exclusive_iter(self, iterator: Iterator) -> Iterator:
+        """Iterate over `iterator` while holding `exclusive()`."""
+        with self.exclusive():
+            yield from iterator
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _clear_slot(self, slot: _Slot):
+        if slot.tokens:
+            self.llama._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+            slot.tokens = []
+
+    def _finish(self, slot: _Slot, item: Optional[Exception] = None):
+        assert slot.request is not None
+        slot.request.output.put(item)
+        slot.request = None
+        slot.pending = []
+        self._cond.notify_all()
+
+    def _admit(self):
+        """Move pending requests into free sequences, oldest first."""
+        llama = self.llama
+        while self._pending and self._n_exclusive == 0:
+            request = self._pending[0]
+            if request.cancelled:
+                self._pending.popleft()
+                continue
+            free = [slot for slot in self._slots if slot.request is None]
+            if not free:
+                return
+            tokens = request.tokens
+            # Reuse the longest prefix held by any sequence, at least one token
+            # is evaluated to get logits to sample from
+            dst = min(free, key=lambda slot: len(slot.tokens))
+            src: Optional[_Slot] = None
+            n_prefix = 0
+            for slot in self._slots:
+                n = min(_common_prefix_len(slot.tokens, tokens), len(tokens) - 1)
+                if n > n_prefix:
+                    n_prefix = n
+                    if slot.request is None:
+                        dst, src = slot, None
+                    else:
+                        src = slot
+            if src is not None:
+                dst = min(free, key=lambda slot: len(slot.tokens))
+            # Admission control: in-flight requests can grow up to their
+            # reservation, evict kept prefixes if the request does not fit
+            n_used = llama.n_tokens + sum(
+                slot.request.n_reserve if slot.request is not None else len(slot.tokens)
+                for slot in self._slots
+                if slot is not dst
+            )
+            if n_used + request.n_reserve > self.n_ctx:
+                for slot in sorted(free, key=lambda slot: len(slot.tokens)):
+                    if slot is dst or slot is src or not slot.tokens:
+                        continue
+                    n_used -= len(slot.tokens)
+                    self._clear_slot(slot)
+                    if n_used + request.n_reserve <= self.n_ctx:
+                        break
+            if n_used + request.n_reserve > self.n_ctx and llama.n_tokens > 0:
+                n_used -= llama.n_tokens
+                llama._ctx.kv_cache_seq_rm(0, -1, -1)
+                llama.n_tokens = 0
+            if n_used + request.n_reserve > self.n_ctx:
+                return
+            self._pending.popleft()
+            if src is None:
+                llama._ctx.kv_cache_seq_rm(dst.seq_id, n_prefix, -1)
+                del dst.tokens[n_prefix:]
+            else:
+                llama._ctx.kv_cache_seq_rm(dst.seq_id, -1, -1)
+                llama._ctx.kv_cache_seq_cp(src.seq_id, dst.seq_id, 0, n_prefix)
+                dst.tokens = tokens[:n_prefix]
+            dst.pending = tokens[n_prefix:]
+            dst.request = request
+            params = request.sampling_params
+            dst.sampling_context = _LlamaSamplingContext(
+                params=params,
+                mirostat_mu=ctypes.c_float(2.0 * params.mirostat_tau),
+                prev=tokens[-params.penalty_last_n :] if params.penalty_last_n > 0 else [],
+                token_data_array=(
+                    dst.sampling_context.token_data_array
+                    if dst.sampling_context is not None
+                    else None
+                ),
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        for slot in self._slots:
+                            if slot.request is not None:
+                                self._finish(slot, RuntimeError("LlamaScheduler is closed"))
+                        for request in self._pending:
+                            request.output.put(RuntimeError("LlamaScheduler is closed"))
+                        self._pending.clear()
+                        return
+                    for slot in self._slots:
+                        if slot.request is not None and slot.request.cancelled:
+                            self._finish(slot)
+                    self._admit()
+                    active = [slot for slot in self._slots if slot.request is not None]
+                    if active:
+                        break
+                    self._cond.wait()
+            try:
+                finished = self._step(active)
+            except Exception as e:
+                with self._cond:
+                    for slot in active:
+                        # The sequence state is unknown after a failed decode
+                        self.llama._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+                        slot.tokens = []
+                        self._finish(slot, e)
+                continue
+            if finished:
+                with self._cond:
+                    for slot in finished:
+                        self._finish(slot)
+
+    def _step(self, active: List[_Slot]) -> List[_Slot]:
+        """Decode one batch for the active sequences and sample their next tokens."""
+        llama = self.llama
+        batch = llama._batch
+        batch.reset()
+        n_tokens = 0
+        sampled: List[Tuple[_Slot, int]] = []
+        for slot in active:
+            if n_tokens >= llama.n_batch:
+                break
+            # Long prompts are evaluated in chunks across steps
+            chunk = slot.pending[: llama.n_batch - n_tokens]
+            batch.add_sequence(
+                chunk, seq_id=slot.seq_id, logits_all=False, n_past=len(slot.tokens)
+            )
+            slot.tokens.extend(chunk)
+            del slot.pending[: len(chunk)]
+            n_tokens += len(chunk)
+            if not slot.pending:
+                sampled.append((slot, n_tokens - 1))
+        llama._ctx.decode(batch)
+
+        finished: List[_Slot] = []
+        for slot, idx in sampled:
+            request = slot.request
+            sampling_context = slot.sampling_context
+            assert request is not None and sampling_context is not None
+            token = sampling_context.sample(ctx_main=llama._ctx, idx=idx)
+            sampling_context.accept(ctx_main=llama._ctx, id=token, apply_grammar=False)
+            request.output.put(token)
+            request.n_generated += 1
+            if (
+                llama_cpp.llama_token_is_eog(llama._model.model, token)
+                or request.n_generated >= request.max_tokens
+            ):
+                finished.append(slot)
+            else:
+                slot.pending.append(token)
+        return finished
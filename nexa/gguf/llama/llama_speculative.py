@@ -1,10 +1,15 @@
 import abc
 
-from typing import Any
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
 import numpy as np
 import numpy.typing as npt
 
+import nexa.gguf.llama.llama_cpp as llama_cpp
+
+if TYPE_CHECKING:
+    from nexa.gguf.llama.llama import Llama
+
 
 class LlamaDraftModel(abc.ABC):
     @abc.abstractmethod
@@ -17,9 +22,86 @@ class LlamaDraftModel(abc.ABC):
 class LlamaPromptLookupDecoding(LlamaDraftModel):
     """Based on https://github.com/apoorvumang/prompt-lookup-decoding"""
 
-    def __init__(self, max_ngram_size: int = 2, num_pred_tokens: int = 10):
+    def __init__(
+        self, max_ngram_size: int = 2, num_pred_tokens: int = 10, match: str = "longest"
+    ):
+        """
+        Args:
+            max_ngram_size: Longest suffix of the input looked up in the index.
+            num_pred_tokens: Maximum number of drafted tokens.
+            match: Which earlier occurrence of the suffix to copy from when there
+                are several, "longest" for the one followed by the most tokens
+                (the earliest) or "recent" for the latest.
+        """
+        if match not in ("longest", "recent"):
+            raise ValueError(f"Unknown match scoring: {match}")
         self.max_ngram_size = max_ngram_size
         self.num_pred_tokens = num_pred_tokens
+        self.match = match
+
+        # Positions following every n-gram of the indexed tokens, one map per
+        # n-gram size, kept in sync with the input as it grows and is rolled
+        # back when drafts are rejected
+        self._ids = np.empty(1024, dtype=np.intc)
+        self._n_ids = 0
+        self._index: List[Dict[Tuple[int, ...], List[int]]] = [
+            {} for _ in range(max_ngram_size)
+        ]
+
+    def _sync(self, input_ids: npt.NDArray[np.intc]):
+        """Update the index to cover exactly `input_ids`."""
+        n_ids, n_input = self._n_ids, len(input_ids)
+        n = min(n_ids, n_input)
+        mismatch = np.flatnonzero(self._ids[:n] != input_ids[:n])
+        n_prefix = int(mismatch[0]) if len(mismatch) else n
+
+        # Roll back the positions that changed, newest first so each one is the
+        # last entry of its n-gram
+        if n_prefix == 0:
+            for ngrams in self._index:
+                ngrams.clear()
+        else:
+            for end in range(n_ids, n_prefix, -1):
+                for size, ngrams in enumerate(self._index, 1):
+                    if end < size:
+                        break
+                    key = tuple(self._ids[end - size : end].tolist())
+                    positions = ngrams[key]
+                    positions.pop()
+                    if not positions:
+                        del ngrams[key]
+
+        if n_input > len(self._ids):
+            ids = np.empty(max(n_input, 2 * len(self._ids)), dtype=np.intc)
+            ids[:n_prefix] = self._ids[:n_prefix]
+            self._ids = ids
+        self._ids[n_prefix:n_input] = input_ids[n_prefix:]
+        self._n_ids = n_input
+
+        offset = max(0, n_prefix - self.max_ngram_size)
+        tokens = self._ids[offset:n_input].tolist()
+        for end in range(n_prefix + 1, n_input + 1):
+            for size, ngrams in enumerate(self._index, 1):
+                if end < size:
+                    break
+                key = tuple(tokens[end - size - offset : end - offset])
+                ngrams.setdefault(key, []).append(end)
+
+    def _lookup(self) -> npt.NDArray[np.intc]:
+        n_ids = self._n_ids
+        for size in range(min(self.max_ngram_size, n_ids - 1), 0, -1):
+            key = tuple(self._ids[n_ids - size : n_ids].tolist())
+            positions = self._index[size - 1].get(key)
+            if not positions:
+                continue
+            # The suffix itself is the last occurrence and has no continuation
+            if positions[-1] == n_ids:
+                positions = positions[:-1]
+            if positions:
+                start = positions[-1] if self.match == "recent" else positions[0]
+                end = min(start + self.num_pred_tokens, n_ids)
+                return self._ids[start:end].copy()
+        return np.array([], dtype=np.intc)
 
     @staticmethod
     def find_candidate_pred_tokens(
@@ -57,8 +139,73 @@ class LlamaPromptLookupDecoding(LlamaDraftModel):
     def __call__(
         self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
     ) -> npt.NDArray[np.intc]:
-        return self.find_candidate_pred_tokens(
-            input_ids=input_ids,
-            max_ngram_size=self.max_ngram_size,
-            num_pred_tokens=self.num_pred_tokens,
-        )
\ No newline at end of file
+        self._sync(input_ids)
+        return self._lookup()
+
+
+class LlamaSmallModelDecoding(LlamaDraftModel):
+    """Drafts tokens by greedy decoding a smaller model with the same vocabulary,
+    e.g. a 0.5B draft for a 7B target."""
+
+    def __init__(self, model: "Llama", num_pred_tokens: int = 8):
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    @classmethod
+    def from_path(
+        cls, model_path: str, num_pred_tokens: int = 8, **kwargs: Any
+    ) -> "LlamaSmallModelDecoding":
+        from nexa.gguf.llama.llama import Llama
+
+        return cls(
+            Llama(model_path=model_path, logits_all=False, **kwargs),
+            num_pred_tokens=num_pred_tokens,
+        )
+
+    def check_vocab(self, target: "Llama"):
+        """Raise a ValueError if the draft tokenizer differs from the target's.
+
+        Same rules as llama.cpp's speculative example: the special tokens must
+        match and the vocabularies may only differ by a few trailing tokens.
+        """
+        draft = self.model
+        n_vocab_target, n_vocab_draft = target.n_vocab(), draft.n_vocab()
+        if abs(n_vocab_target - n_vocab_draft) > 100:
+            raise ValueError(
+                f"Draft model vocab size ({n_vocab_draft}) differs too much from the target's ({n_vocab_target})"
+            )
+        if (
+            target.token_bos() != draft.token_bos()
+            or target.token_eos() != draft.token_eos()
+        ):
+            raise ValueError("Draft model special tokens differ from the target's")
+        for token in range(5, min(n_vocab_target, n_vocab_draft)):
+            if llama_cpp.llama_token_get_text(
+                target.model, token
+            ) != llama_cpp.llama_token_get_text(draft.model, token):
+                raise ValueError(
+                    f"Draft model token {token} differs from the target's"
+                )
+
+    def __call__(
+        self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any
+    ) -> npt.NDArray[np.intc]:
+        model = self.model
+        if len(input_ids) + self.num_pred_tokens > model.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Only evaluate what changed since the last draft, rejected draft
+        # tokens are dropped from the KV cache by eval
+        n_prefix = model.longest_token_prefix(model._input_ids, input_ids[:-1])
+        model.n_tokens = n_prefix
+        model.eval(input_ids[n_prefix:])
+
+        draft = []
+        for i in range(self.num_pred_tokens):
+            token = int(np.argmax(model._get_scores(model.n_tokens - 1, model.n_tokens)[0]))
+            if llama_cpp.llama_token_is_eog(model.model, token):
+                break
+            draft.append(token)
+            if i + 1 < self.num_pred_tokens:
+                model.eval([token])
+        return np.array(draft, dtype=np.intc)
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+import re
 import abc
+import threading
+from collections import OrderedDict
 from typing import (
+    Dict,
+    Iterable,
     List,
     Optional,
+    Tuple,
     Any,
 )
 
@@ -68,6 +74,190 @@ class LlamaTokenizer(BaseLlamaTokenizer):
         return cls(llama_cpp.Llama(model_path=path, vocab_only=True))
 
 
+class StreamingDetokenizer:
+    """Incrementally detokenize a growing sequence of tokens.
+
+    Every pushed token is detokenized against a short window of the tokens
+    before it, so the cost per token stays constant as the sequence grows.
+    The accumulated bytes are kept in `text` and the byte offset at which
+    the i-th pushed token starts in `offsets[i]` (`offsets[-1] == len(text)`).
+
+    Args:
+        tokenizer: The tokenizer used to detokenize each token.
+        prev_tokens: Tokens preceding the detokenized sequence (e.g. the prompt).
+        bos_token: If the first pushed token is this token, a leading space on
+            the text that follows is dropped, matching `detokenize`.
+        window: Number of previous tokens passed as context to the tokenizer.
+    """
+
+    def __init__(
+        self,
+        tokenizer: BaseLlamaTokenizer,
+        prev_tokens: Optional[List[int]] = None,
+        bos_token: Optional[int] = None,
+        window: int = 8,
+    ):
+        self.tokenizer = tokenizer
+        self.window = window
+        self.bos_token = bos_token
+        self.text = bytearray()
+        self.offsets: List[int] = [0]
+        self._context: List[int] = list(prev_tokens[-window:]) if prev_tokens else []
+        self._strip_space = False
+
+    def push(self, token: int) -> bytes:
+        """Detokenize `token` and append it to `text`, returning its bytes."""
+        piece = self.tokenizer.detokenize(
+            [token], prev_tokens=self._context[-self.window :] or None
+        )
+        if len(self.offsets) == 1:
+            self._strip_space = self.bos_token is not None and token == self.bos_token
+        if self._strip_space and len(self.text) == 0 and piece:
+            self._strip_space = False
+            if piece[:1] == b" ":
+                piece = piece[1:]
+        self.text += piece
+        self.offsets.append(len(self.text))
+        self._context.append(token)
+        if len(self._context) > 2 * self.window:
+            del self._context[: -self.window]
+        return piece
+
+
+class StopSequenceMatcher:
+    """Aho-Corasick matcher for stop sequences over a stream of bytes.
+
+    Bytes are fed as they are generated; each byte is processed once no matter
+    how many stop sequences there are or how long the text grows.
+    """
+
+    def __init__(self, stop_sequences: List[bytes]):
+        self._goto: List[Dict[int, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        # Length of the longest stop sequence ending at each state
+        self._out: List[int] = [0]
+        for seq in stop_sequences:
+            if not seq:
+                continue
+            state = 0
+            for b in seq:
+                nxt = self._goto[state].get(b)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._out.append(0)
+                    self._goto[state][b] = nxt
+                state = nxt
+            self._out[state] = max(self._out[state], len(seq))
+        # Breadth-first construction of the failure links
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for b, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and b not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(b, 0)
+                self._out[nxt] = max(self._out[nxt], self._out[self._fail[nxt]])
+                queue.append(nxt)
+        self._state = 0
+        self._pos = 0
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    @property
+    def partial_len(self) -> int:
+        """Length of the longest suffix of the fed bytes that is a prefix of a stop sequence."""
+        return self._depth[self._state]
+
+    def feed(self, data: bytes) -> Optional[int]:
+        """Feed `data` and return the start offset of the earliest stop sequence
+        completed within it, or None if no stop sequence was completed."""
+        if len(self._goto) == 1:
+            self._pos += len(data)
+            return None
+        goto, fail, out = self._goto, self._fail, self._out
+        state = self._state
+        match: Optional[int] = None
+        for i, b in enumerate(data):
+            while state and b not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(b, 0)
+            if out[state]:
+                start = self._pos + i + 1 - out[state]
+                if match is None or start < match:
+                    match = start
+        self._state = state
+        self._pos += len(data)
+        return match
+
+
+class SegmentedTokenizer:
+    """Tokenize text segment by segment, memoizing the tokens of each segment.
+
+    Text is split right before each of the `boundaries`, special tokens that the
+    tokenizer never merges with the text around them, so tokenizing the segments
+    on their own gives the same tokens as tokenizing the whole text. A rendered
+    chat prompt is split at every turn this way, and the turns that did not
+    change since an earlier request are looked up instead of tokenized again.
+
+    Only the first segment is tokenized with `add_bos`. The tokenizer must not
+    append an EOS token with it (`add_eos_token`), that would end up after the
+    first segment instead of at the end of the text.
+
+    Args:
+        tokenizer: The tokenizer used for segments that are not cached.
+        boundaries: Texts of the special tokens to split before.
+        capacity: Maximum number of cached segments.
+    """
+
+    def __init__(
+        self,
+        tokenizer: BaseLlamaTokenizer,
+        boundaries: Iterable[bytes],
+        capacity: int = 4096,
+    ):
+        self.tokenizer = tokenizer
+        self.capacity = capacity
+        # Longest first so the match at a position is the token the tokenizer sees
+        patterns = sorted({b for b in boundaries if b}, key=len, reverse=True)
+        self._pattern = (
+            re.compile(b"|".join(re.escape(b) for b in patterns)) if patterns else None
+        )
+        self._cache: OrderedDict[Tuple[bytes, bool], List[int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def split(self, text: bytes) -> List[bytes]:
+        """Split `text` before every boundary."""
+        if self._pattern is None:
+            return [text]
+        starts = [m.start() for m in self._pattern.finditer(text) if m.start() > 0]
+        return [text[i:j] for i, j in zip([0] + starts, starts + [len(text)])]
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        """Tokenize `text` with special tokens, like `tokenizer.tokenize(text, add_bos, special=True)`."""
+        tokens: List[int] = []
+        for i, segment in enumerate(self.split(text)):
+            key = (segment, add_bos and i == 0)
+            with self._lock:
+                segment_tokens = self._cache.get(key)
+                if segment_tokens is not None:
+                    self._cache.move_to_end(key)
+            if segment_tokens is None:
+                segment_tokens = self.tokenizer.tokenize(
+                    segment, add_bos=key[1], special=True
+                )
+                with self._lock:
+                    self._cache[key] = segment_tokens
+                    while len(self._cache) > self.capacity:
+                        self._cache.popitem(last=False)
+            tokens.extend(segment_tokens)
+        return tokens
+
+
 class LlamaHFTokenizer(BaseLlamaTokenizer):
     def __init__(self, hf_tokenizer: Any):
         self.hf_tokenizer = hf_tokenizer
@@ -7,6 +7,7 @@ from typing import Iterator, List, Union
 
 from nexa.constants import (
     DEFAULT_TEXT_GEN_PARAMS,
+    NEXA_EMBEDDING_CACHE_DIR,
     NEXA_RUN_CHAT_TEMPLATE_MAP,
     NEXA_RUN_COMPLETION_TEMPLATE_MAP,
     NEXA_STOP_WORDS_MAP,
@@ -36,6 +37,9 @@ class NexaTextInference:
     model_path (str): Path or identifier for the model in Nexa Model Hub.
     local_path (str, optional): Local path of the model.
     embedding (bool): Enable embedding generation.
+    embedding_cache (bool): Store computed embeddings on disk and reuse them for repeated inputs.
+    draft_model (str, optional): Path or identifier of a small model with the same vocabulary, used for speculative decoding.
+    draft_tokens (int): Number of tokens drafted per step for speculative decoding.
     stop_words (list): List of stop words for early stopping.
     profiling (bool): Enable timing measurements for the generation process.
     streamlit (bool): Run the inference in Streamlit UI.
@@ -101,6 +105,26 @@ class NexaTextInference:
         """
         return self.model.embed(input, normalize, truncate)
 
+    def _load_draft_model(self, n_gpu_layers):
+        """Load the small model that drafts tokens for speculative decoding, if any."""
+        draft_path = self.params.get("draft_model", None)
+        if not draft_path:
+            return None
+        from nexa.gguf.llama.llama_speculative import LlamaSmallModelDecoding
+        if not os.path.isfile(draft_path):
+            draft_path, _ = pull_model(draft_path)
+            if draft_path is None:
+                raise ValueError(f"Draft model ({self.params['draft_model']}) is not applicable")
+        return LlamaSmallModelDecoding.from_path(
+            draft_path,
+            num_pred_tokens=self.params.get("draft_tokens", 8),
+            verbose=self.profiling,
+            n_ctx=self.params.get("nctx", 2048),
+            n_gpu_layers=n_gpu_layers,
+            n_threads=self.params.get("n_threads", None),
+            n_threads_batch=self.params.get("n_threads_batch", None),
+        )
+
     @SpinningCursorAnimation()
     def _load_model(self):
         logging.debug(f"Loading model from {self.downloaded_path}, use_cuda_or_metal : {is_gpu_available()}")
@@ -113,6 +137,8 @@ class NexaTextInference:
                 elif self.device == "cpu":
                     n_gpu_layers = 0
 
+                draft_model = self._load_draft_model(n_gpu_layers)
+
                 self.model = Llama(
                     embedding=self.params.get("embedding", False),
                     model_path=self.downloaded_path,
@@ -121,6 +147,10 @@ class NexaTextInference:
                     n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=n_gpu_layers,
                     lora_path=self.params.get("lora_path", ""),
+                    logits_all=False,
+                    n_threads=self.params.get("n_threads", None),
+                    n_threads_batch=self.params.get("n_threads_batch", None),
+                    draft_model=draft_model,
                 )
             except Exception as e:
                 logging.error(f"Failed to load model: {e}. Falling back to CPU.", exc_info=True)
@@ -131,8 +161,19 @@ class NexaTextInference:
                     n_ctx=self.params.get("nctx", 2048),
                     n_gpu_layers=0,  # hardcode to use CPU
                     lora_path=self.params.get("lora_path", ""),
+                    logits_all=False,
+                    n_threads=self.params.get("n_threads", None),
+                    n_threads_batch=self.params.get("n_threads_batch", None),
+                    draft_model=self._load_draft_model(0),
                 )
 
+        if self.model.draft_model is not None:
+            self.model.draft_model.check_vocab(self.model)
+
+        if self.params.get("embedding_cache", False):
+            from nexa.gguf.llama.llama_cache import LlamaEmbeddingCache
+            self.model.set_embedding_cache(LlamaEmbeddingCache(str(NEXA_EMBEDDING_CACHE_DIR)))
+
         load_time = time.time() - start_time
         if self.profiling:
             logging.debug(f"Model loaded in {load_time:.2f} seconds")
@@ -203,6 +244,8 @@ class NexaTextInference:
                 pass
             except Exception as e:
                 logging.error(f"Error during generation: {e}", exc_info=True)
+            if self.profiling and self.model.draft_acceptance_rate is not None:
+                print(f"\nDraft acceptance rate: {self.model.draft_acceptance_rate:.1%}", end="")
             print("\n")
 
     def create_chat_completion(self, messages, **kwargs):
@@ -380,6 +423,17 @@ if __name__ == "__main__":
         type=str,
         help="Path to a LoRA file to apply to the model.",
     )
+    parser.add_argument(
+        "--draft_model",
+        type=str,
+        help="Path or identifier of a small model with the same vocabulary to draft tokens for speculative decoding",
+    )
+    parser.add_argument(
+        "--draft_tokens",
+        type=int,
+        default=8,
+        help="Number of tokens drafted per step for speculative decoding",
+    )
     parser.add_argument(
         "-d",
         "--device",
@@ -25,6 +25,7 @@ class NexaVoiceInference:
       run: Run the voice transcription loop.
       run_streamlit: Run the Streamlit UI.
       transcribe: Transcribe the audio file.
+      stream_transcription: Yield transcribed segments as they are decoded.
 
     Args:
     model_path (str): Path or identifier for the model in Nexa Model Hub.
@@ -170,20 +171,45 @@ class NexaVoiceInference:
             **kwargs,
         )
 
+    def stream_transcription(self, audio, **kwargs):
+        """
+        Transcribe the audio file, yielding each segment as soon as it is decoded.
+
+        Arguments:
+          audio: Path to the input file, a file-like object such as an in-memory
+            `io.BytesIO` buffer, or the audio waveform.
+          kwargs: Any argument accepted by `transcribe`. beam_size, language, task
+            and temperature default to this instance's parameters and vad_filter
+            to True.
+
+        Yields:
+          faster_whisper Segment objects, with start and end times in seconds and
+          the segment text.
+        """
+        params = {
+            "beam_size": self.params["beam_size"],
+            "language": self.params["language"],
+            "task": self.params["task"],
+            "temperature": self.params["temperature"],
+            "vad_filter": True,
+        }
+        params.update(kwargs)
+        # faster-whisper decodes lazily, one 30s window at a time, while the
+        # returned generator is consumed
+        segments, _ = self.model.transcribe(audio, **params)
+        yield from segments
+
     def _transcribe_audio(self, audio_path):
         logging.debug(f"Transcribing audio from: {audio_path}")
         try:
-            segments, _ = self.model.transcribe(
-                audio_path,
-                beam_size=self.params["beam_size"],
-                language=self.params["language"],
-                task=self.params["task"],
-                temperature=self.params["temperature"],
-                vad_filter=True,
-            )
-            transcription = "".join(segment.text for segment in segments)
+            texts = []
+            print("Transcription: ", end="", flush=True)
+            for segment in self.stream_transcription(audio_path):
+                texts.append(segment.text)
+                print(segment.text, end="", flush=True)
+            print()
+            transcription = "".join(texts)
             self._save_transcription(transcription)
-            print(f"Transcription: {transcription}")
         except Exception as e:
             logging.error(f"Error during transcription: {e}", exc_info=True)
 
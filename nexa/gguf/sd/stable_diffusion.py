@@ -699,8 +699,9 @@ class StableDiffusion:
         # Convert the PIL Image to a byte array
         image_bytes = image.tobytes()
 
+        # Copy the pixels into a C buffer in one go, the cast keeps the buffer alive
         data = ctypes.cast(
-            (ctypes.c_byte * len(image_bytes))(*image_bytes),
+            (ctypes.c_uint8 * len(image_bytes)).from_buffer_copy(image_bytes),
             ctypes.POINTER(ctypes.c_uint8),
         )
         return data, width, height
@@ -729,7 +730,7 @@ class StableDiffusion:
     # ============= C sd_image_t to Image =============
 
     def _c_array_to_bytes(self, c_array, buffer_size: int):
-        return bytearray(ctypes.cast(c_array, ctypes.POINTER(ctypes.c_byte * buffer_size)).contents)
+        return ctypes.string_at(c_array, buffer_size)
 
     def _dereference_sd_image_t_p(self, c_image: sd_cpp.sd_image_t):
         """Dereference a C sd_image_t pointer to a Python dictionary with height, width, channel and data (bytes)."""
@@ -787,17 +788,11 @@ class StableDiffusion:
     # ============= Bytes to Image =============
 
     def _bytes_to_image(self, byte_data: bytes, width: int, height: int):
-        """Convert a byte array to a PIL Image."""
-        image = Image.new("RGBA", (width, height))
-
-        for y in range(height):
-            for x in range(width):
-                idx = (y * width + x) * 3
-                image.putpixel(
-                    (x, y),
-                    (byte_data[idx], byte_data[idx + 1], byte_data[idx + 2], 255),
-                )
-        return image
+        """Convert a byte array of RGB pixels to a PIL Image."""
+        # Decoded in C, Pillow adds the opaque alpha channel when converting
+        return Image.frombuffer(
+            "RGB", (width, height), bytes(byte_data), "raw", "RGB", 0, 1
+        ).convert("RGBA")
 
     def __setstate__(self, state):
         self.__init__(**state)
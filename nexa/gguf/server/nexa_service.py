@@ -1,19 +1,22 @@
+import asyncio
 import json
 import logging
 import os
 import socket
+import threading
 import time
 import uuid
-from typing import List, Optional, Dict, Any, Union, Literal
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Dict, Any, Union, Literal
 import base64
 import multiprocessing
 from PIL import Image
-import tempfile
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, HttpUrl, AnyUrl, Field
+import numpy as np
 import requests
 from io import BytesIO
 from PIL import Image
@@ -22,6 +25,7 @@ import re
 from urllib.parse import urlparse
 
 from nexa.constants import (
+    NEXA_EMBEDDING_CACHE_DIR,
     NEXA_RUN_CHAT_TEMPLATE_MAP,
     NEXA_RUN_MODEL_MAP_VLM,
     NEXA_RUN_PROJECTOR_MAP,
@@ -38,6 +42,9 @@ from nexa.gguf.llama.llama_chat_format import (
 from nexa.gguf.llama._utils_transformers import suppress_stdout_stderr
 from nexa.general import pull_model
 from nexa.gguf.llama.llama import Llama
+from nexa.gguf.llama.llama_cache import LlamaEmbeddingCache, LlamaRAMCache
+from nexa.gguf.llama.llama_scheduler import LlamaScheduler
+from nexa.gguf.llama.llama_speculative import LlamaSmallModelDecoding
 from nexa.gguf.sd.stable_diffusion import StableDiffusion
 from faster_whisper import WhisperModel
 import argparse
@@ -83,6 +90,17 @@ is_local_path = False
 model_type = None
 is_huggingface = False
 projector_path = None
+use_prompt_cache = False
+use_embedding_cache = False
+n_parallel = 1
+draft_model_path = None
+draft_tokens = 8
+# Inference runs on dedicated worker threads so the event loop stays responsive
+inference_executor: Optional[ThreadPoolExecutor] = None
+max_queue_size = 64
+request_timeout: Optional[float] = None
+queue_stats = {"queued": 0, "running": 0, "completed": 0, "failed": 0, "rejected": 0, "timed_out": 0}
+queue_lock = threading.Lock()
 # Request Classes
 class GenerationRequest(BaseModel):
     prompt: str = "Tell me a story"
@@ -173,8 +191,28 @@ class EmbeddingRequest(BaseModel):
     input: Union[str, List[str]] = Field(..., description="The input text to get embeddings for. Can be a string or an array of strings.")
     normalize: Optional[bool] = False
     truncate: Optional[bool] = True
+    encoding_format: Optional[Literal["float", "base64"]] = Field("float", description="Return embeddings as lists of floats or as base64 encoded little-endian arrays.")
+    dtype: Optional[Literal["float32", "float16"]] = Field("float32", description="Precision of the returned embeddings.")
 
 # helper functions
+def _load_draft_model(n_gpu_layers):
+    """Load the small model that drafts tokens for speculative decoding, if any."""
+    if not draft_model_path or model_type != "NLP":
+        return None
+    downloaded_path = draft_model_path
+    if not os.path.isfile(downloaded_path):
+        downloaded_path, _ = pull_model(draft_model_path)
+        if downloaded_path is None:
+            raise ValueError(f"Draft model ({draft_model_path}) is not applicable")
+    return LlamaSmallModelDecoding.from_path(
+        downloaded_path,
+        num_pred_tokens=draft_tokens,
+        verbose=False,
+        n_ctx=n_ctx,
+        n_gpu_layers=n_gpu_layers,
+    )
+
+
 async def load_model():
     global model, chat_format, completion_template, model_path, n_ctx, is_local_path, model_type, is_huggingface, projector_path
     if is_local_path:
@@ -210,8 +248,9 @@ async def load_model():
                         verbose=False,
                         chat_format=chat_format,
                         n_gpu_layers=-1 if is_gpu_available() else 0,
-                        logits_all=True,
+                        logits_all=False,
                         n_ctx=n_ctx,
+                        draft_model=_load_draft_model(-1 if is_gpu_available() else 0),
                         embedding=False
                     )
                 except Exception as e:
@@ -223,8 +262,9 @@ async def load_model():
                         verbose=False,
                         chat_format=chat_format,
                         n_gpu_layers=0,  # hardcode to use CPU,
-                        logits_all=True,
+                        logits_all=False,
                         n_ctx=n_ctx,
+                        draft_model=_load_draft_model(0),
                         embedding=False
                     )
 
@@ -240,8 +280,9 @@ async def load_model():
                         verbose=False,
                         chat_format=chat_format,
                         n_gpu_layers=-1 if is_gpu_available() else 0,
-                        logits_all=True,
+                        logits_all=False,
                         n_ctx=n_ctx,
+                        draft_model=_load_draft_model(-1 if is_gpu_available() else 0),
                         embedding=model_type == "Text Embedding"
                     )
                 except Exception as e:
@@ -253,8 +294,9 @@ async def load_model():
                         verbose=False,
                         chat_format=chat_format,
                         n_gpu_layers=0,  # hardcode to use CPU
-                        logits_all=True,
+                        logits_all=False,
                         n_ctx=n_ctx,
+                        draft_model=_load_draft_model(0),
                         embedding=model_type == "Text Embedding"
                     )
                 logging.info(f"model loaded as {model}")
@@ -269,6 +311,21 @@ async def load_model():
             ):
                 chat_format = chat_format
                 logging.debug("Chat format detected")
+
+        if use_prompt_cache and model_type == "NLP":
+            model.set_cache(LlamaRAMCache())
+            logging.info("Prompt cache enabled")
+        if use_embedding_cache and model_type == "Text Embedding":
+            model.set_embedding_cache(LlamaEmbeddingCache(str(NEXA_EMBEDDING_CACHE_DIR)))
+            logging.info(f"Embedding cache enabled at {NEXA_EMBEDDING_CACHE_DIR}")
+        if model.draft_model is not None:
+            model.draft_model.check_vocab(model)
+            logging.info(f"Speculative decoding enabled with {draft_model_path}, {draft_tokens} draft tokens")
+        if n_parallel > 1 and model_type == "NLP":
+            model.set_scheduler(LlamaScheduler(model, n_parallel=n_parallel))
+            logging.info(f"Continuous batching enabled for {n_parallel} parallel requests")
+            if model.draft_model is not None:
+                logging.warning("Speculative decoding runs one request at a time, requests are not batched")
     elif model_type == "Computer Vision":
         with suppress_stdout_stderr():
             model = StableDiffusion(
@@ -322,6 +379,112 @@ async def load_model():
     else:
         raise ValueError(f"Model {model_path} not found in Model Hub. If you are using local path, be sure to add --local_path and --model_type flags.")
     
+def _reserve_queue_slot():
+    with queue_lock:
+        if queue_stats["queued"] >= max_queue_size:
+            queue_stats["rejected"] += 1
+            raise HTTPException(status_code=429, detail="Too many requests are queued. Please retry later.")
+        queue_stats["queued"] += 1
+
+
+def _run_queued(deadline: Optional[float], fn: Callable, *args, **kwargs):
+    with queue_lock:
+        queue_stats["queued"] -= 1
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("Request timed out while queued")
+        queue_stats["running"] += 1
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        with queue_lock:
+            queue_stats["failed"] += 1
+        raise
+    else:
+        with queue_lock:
+            queue_stats["completed"] += 1
+        return result
+    finally:
+        with queue_lock:
+            queue_stats["running"] -= 1
+
+
+def _submit_queued(fn: Callable, *args, **kwargs) -> Future:
+    """Queue `fn` on the inference workers, rejecting it with a 429 when the queue is full."""
+    _reserve_queue_slot()
+    deadline = time.monotonic() + request_timeout if request_timeout else None
+    future = inference_executor.submit(_run_queued, deadline, fn, *args, **kwargs)
+
+    def release_cancelled(future: Future):
+        # Cancelled before a worker picked it up
+        if future.cancelled():
+            with queue_lock:
+                queue_stats["queued"] -= 1
+
+    future.add_done_callback(release_cancelled)
+    return future
+
+
+async def run_inference(fn: Callable, *args, **kwargs):
+    """Run blocking inference on the inference workers and wait for the result."""
+    future = _submit_queued(fn, *args, **kwargs)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=request_timeout)
+    except (asyncio.TimeoutError, TimeoutError):
+        with queue_lock:
+            queue_stats["timed_out"] += 1
+        raise HTTPException(status_code=504, detail="Request timed out")
+
+
+def stream_inference(make_iterator: Callable[[], Iterator[str]]) -> AsyncIterator[str]:
+    """Iterate over `make_iterator()` on the inference workers and stream its items.
+
+    The queue slot is reserved right away so a full queue is answered with a 429
+    before the response starts.
+    """
+    stopped = threading.Event()
+
+    def produce(put: Callable[[Any], None]):
+        for item in make_iterator():
+            if stopped.is_set():
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("Request timed out")
+            put(item)
+
+    deadline = time.monotonic() + request_timeout if request_timeout else None
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    future = _submit_queued(produce, lambda item: loop.call_soon_threadsafe(items.put_nowait, item))
+
+    def finish(future: Future):
+        # None marks the end of the stream
+        error = None if future.cancelled() else future.exception()
+        loop.call_soon_threadsafe(items.put_nowait, error)
+
+    future.add_done_callback(finish)
+
+    async def stream():
+        try:
+            while True:
+                item = await items.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    if isinstance(item, TimeoutError):
+                        with queue_lock:
+                            queue_stats["timed_out"] += 1
+                    logging.error(f"Error while streaming: {item}")
+                    yield f"data: {json.dumps({'error': str(item)})}\n\n"
+                    return
+                yield item
+        finally:
+            # The client is gone or the stream is over, stop producing
+            stopped.set()
+            future.cancel()
+
+    return stream()
+
+
 def nexa_run_text_generation(
     prompt, temperature, stop_words, max_new_tokens, top_k, top_p, logprobs=None, stream=False, is_chat_completion=True
 ) -> Dict[str, Any]:
@@ -413,7 +576,7 @@ def nexa_run_text_generation(
     }
     return result
 
-async def nexa_run_image_generation(
+def nexa_run_image_generation(
     prompt,
     image_path,
     cfg_scale,
@@ -497,7 +660,7 @@ def image_url_to_base64(image_url: str) -> str:
 
 
 def run_nexa_ai_service(model_path_arg=None, is_local_path_arg=False, model_type_arg=None, huggingface=False, projector_local_path_arg=None, **kwargs):
-    global model_path, n_ctx, is_local_path, model_type, is_huggingface, projector_path
+    global model_path, n_ctx, is_local_path, model_type, is_huggingface, projector_path, use_prompt_cache, use_embedding_cache, n_parallel, max_queue_size, request_timeout, draft_model_path, draft_tokens
     is_local_path = is_local_path_arg
     is_huggingface = huggingface
     projector_path = projector_local_path_arg
@@ -517,6 +680,13 @@ def run_nexa_ai_service(model_path_arg=None, is_local_path_arg=False, model_type
     os.environ["HUGGINGFACE"] = str(huggingface)
     os.environ["PROJECTOR_PATH"] = projector_path if projector_path else ""
     n_ctx = kwargs.get("nctx", 2048)
+    use_prompt_cache = kwargs.get("prompt_cache", False)
+    use_embedding_cache = kwargs.get("embedding_cache", False)
+    n_parallel = kwargs.get("n_parallel", 1)
+    max_queue_size = kwargs.get("max_queue_size", 64)
+    request_timeout = kwargs.get("request_timeout", None)
+    draft_model_path = kwargs.get("draft_model", None)
+    draft_tokens = kwargs.get("draft_tokens", 8)
     host = kwargs.get("host", "localhost")
     port = kwargs.get("port", 8000)
     reload = kwargs.get("reload", False)
@@ -525,13 +695,18 @@ def run_nexa_ai_service(model_path_arg=None, is_local_path_arg=False, model_type
 # Endpoints
 @app.on_event("startup")
 async def startup_event():
-    global model_path, is_local_path, model_type, is_huggingface, projector_path
+    global model_path, is_local_path, model_type, is_huggingface, projector_path, inference_executor
     model_path = os.getenv("MODEL_PATH", "gemma")
     is_local_path = os.getenv("IS_LOCAL_PATH", "False").lower() == "true"
     model_type = os.getenv("MODEL_TYPE", None)
     is_huggingface = os.getenv("HUGGINGFACE", "False").lower() == "true"
     projector_path = os.getenv("PROJECTOR_PATH", None)
     await load_model()
+    # Text generation requests are batched by the scheduler, other models run one request at a time
+    inference_executor = ThreadPoolExecutor(
+        max_workers=n_parallel if model_type == "NLP" else 1,
+        thread_name_prefix="nexa-inference",
+    )
 
 
 @app.get("/", response_class=HTMLResponse, tags=["Root"])
@@ -541,6 +716,22 @@ async def read_root(request: Request):
     )
 
 
+@app.get("/v1/metrics", tags=["Root"])
+async def metrics():
+    with queue_lock:
+        stats = dict(queue_stats)
+    stats["max_queue_size"] = max_queue_size
+    scheduler = getattr(model, "scheduler", None)
+    if scheduler is not None:
+        stats["batch_active"] = scheduler.n_active
+        stats["batch_pending"] = scheduler.n_pending
+    if getattr(model, "draft_model", None) is not None:
+        stats["draft_tokens"] = model.n_draft_tokens
+        stats["draft_accepted"] = model.n_draft_accepted
+        stats["draft_acceptance_rate"] = model.draft_acceptance_rate
+    return stats
+
+
 def _resp_async_generator(streamer):
     _id = str(uuid.uuid4())
     for token in streamer:
@@ -560,11 +751,13 @@ async def generate_text(request: GenerationRequest):
 
         if request.stream:
             # Run the generation and stream the response
-            streamer = nexa_run_text_generation(is_chat_completion=False, **generation_kwargs)
-            return StreamingResponse(_resp_async_generator(streamer), media_type="application/x-ndjson")
+            streamer = stream_inference(
+                lambda: _resp_async_generator(nexa_run_text_generation(is_chat_completion=False, **generation_kwargs))
+            )
+            return StreamingResponse(streamer, media_type="application/x-ndjson")
         else:
             # Generate text synchronously and return the response
-            result = nexa_run_text_generation(is_chat_completion=False, **generation_kwargs)
+            result = await run_inference(nexa_run_text_generation, is_chat_completion=False, **generation_kwargs)
             return JSONResponse(content={
                 "id": str(uuid.uuid4()),
                 "object": "text_completion",
@@ -577,6 +770,8 @@ async def generate_text(request: GenerationRequest):
                     "finish_reason": "stop"
                 }]
             })
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logging.error(f"Error in text generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -609,14 +804,21 @@ async def chat_completions(request: ChatCompletionRequest):
                 else:
                     processed_messages.append({"role": msg.role, "content": msg.content})
                     
-            response = model.create_chat_completion(
-                messages=processed_messages,
-                temperature=request.temperature,
-                max_tokens=request.max_tokens,
-                top_k=request.top_k,
-                top_p=request.top_p,
-                stream=request.stream,
-            )
+            def create_vlm_completion():
+                return model.create_chat_completion(
+                    messages=processed_messages,
+                    temperature=request.temperature,
+                    max_tokens=request.max_tokens,
+                    top_k=request.top_k,
+                    top_p=request.top_p,
+                    stream=request.stream,
+                )
+
+            if request.stream:
+                streamer = stream_inference(lambda: _resp_async_generator(create_vlm_completion()))
+                return StreamingResponse(streamer, media_type="application/x-ndjson")
+            else:
+                return await run_inference(create_vlm_completion)
         else:
             # Process regular chat completion request
             generation_kwargs = GenerationRequest(
@@ -632,10 +834,12 @@ async def chat_completions(request: ChatCompletionRequest):
             ).dict()
 
             if request.stream:
-                streamer = nexa_run_text_generation(is_chat_completion=True, **generation_kwargs)
-                return StreamingResponse(_resp_async_generator(streamer), media_type="application/x-ndjson")
+                streamer = stream_inference(
+                    lambda: _resp_async_generator(nexa_run_text_generation(is_chat_completion=True, **generation_kwargs))
+                )
+                return StreamingResponse(streamer, media_type="application/x-ndjson")
             else:
-                result = nexa_run_text_generation(is_chat_completion=True, **generation_kwargs)
+                result = await run_inference(nexa_run_text_generation, is_chat_completion=True, **generation_kwargs)
                 return {
                     "id": str(uuid.uuid4()),
                     "object": "chat.completion",
@@ -645,11 +849,6 @@ async def chat_completions(request: ChatCompletionRequest):
                         "logprobs": result["logprobs"] if "logprobs" in result else None,
                     }],
                 }
-
-        if request.stream:
-            return StreamingResponse(_resp_async_generator(response), media_type="application/x-ndjson")
-        else:
-            return response
     
     except HTTPException as e:
         raise e
@@ -667,7 +866,8 @@ async def function_call(request: FunctionCallRequest):
         ]
         tools = [tool.dict() for tool in request.tools]
 
-        response = model.create_chat_completion(
+        response = await run_inference(
+            model.create_chat_completion,
             messages=messages,
             tools=tools,
             tool_choice=request.tool_choice,
@@ -675,6 +875,8 @@ async def function_call(request: FunctionCallRequest):
 
         return response
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logging.error(f"Error in function calling: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -685,7 +887,7 @@ async def txt2img(request: ImageGenerationRequest):
     try:
         generation_kwargs = request.dict()
 
-        generated_images = await nexa_run_image_generation(**generation_kwargs)
+        generated_images = await run_inference(nexa_run_image_generation, **generation_kwargs)
 
         resp = {"created": time.time(), "data": []}
 
@@ -700,6 +902,8 @@ async def txt2img(request: ImageGenerationRequest):
 
         return resp
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logging.error(f"Error in txt2img generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -709,7 +913,7 @@ async def img2img(request: ImageGenerationRequest):
     try:
         generation_kwargs = request.dict()
 
-        generated_images = await nexa_run_image_generation(**generation_kwargs)
+        generated_images = await run_inference(nexa_run_image_generation, **generation_kwargs)
         resp = {"created": time.time(), "data": []}
 
         for image in generated_images:
@@ -724,94 +928,118 @@ async def img2img(request: ImageGenerationRequest):
         return resp
 
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logging.error(f"Error in img2img generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _transcription_segments(audio: BytesIO, **params) -> Iterator[Dict[str, Any]]:
+    segments, _ = model.transcribe(audio, **params)
+    for segment in segments:
+        yield {"id": segment.id, "start": segment.start, "end": segment.end, "text": segment.text}
+
+
+def _segment_events(segments: Iterator[Dict[str, Any]], object_type: str) -> Iterator[str]:
+    for segment in segments:
+        yield f"data: {json.dumps({'object': object_type, **segment})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def _run_transcription(file: UploadFile, stream: bool, object_type: str, **params):
+    # faster-whisper decodes from a file-like object, no need for a temp file
+    audio = BytesIO(await file.read())
+    if stream:
+        # Segments are sent as they are decoded instead of after the whole file
+        streamer = stream_inference(
+            lambda: _segment_events(_transcription_segments(audio, **params), object_type)
+        )
+        return StreamingResponse(streamer, media_type="text/event-stream")
+
+    def transcribe():
+        return "".join(segment["text"] for segment in _transcription_segments(audio, **params))
+
+    text = await run_inference(transcribe)
+    return JSONResponse(content={"text": text})
+
+
 @app.post("/v1/audio/transcriptions", tags=["Audio"])
 async def transcribe_audio(
     file: UploadFile = File(...),
     beam_size: Optional[int] = Query(5, description="Beam size for transcription"),
     language: Optional[str] = Query(None, description="Language code (e.g., 'en', 'fr')"),
     temperature: Optional[float] = Query(0.0, description="Temperature for sampling"),
+    stream: Optional[bool] = Query(False, description="Stream segments as server-sent events as they are transcribed"),
 ):
-
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_audio:
-            temp_audio.write(await file.read())
-            temp_audio_path = temp_audio.name
-
-        transcribe_params = {
-            "beam_size": beam_size,
-            "language": language,
-            "task": "transcribe",
-            "temperature": temperature,
-            "vad_filter": True
-        }
-        segments, _ = model.transcribe(temp_audio_path, **transcribe_params)
-        transcription = "".join(segment.text for segment in segments)
-        return JSONResponse(content={"text": transcription})
+        return await _run_transcription(
+            file,
+            stream,
+            "transcription.segment",
+            beam_size=beam_size,
+            language=language,
+            task="transcribe",
+            temperature=temperature,
+            vad_filter=True,
+        )
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during transcription: {str(e)}")
-    finally:
-        os.unlink(temp_audio_path)
 
 @app.post("/v1/audio/translations", tags=["Audio"])
 async def translate_audio(
     file: UploadFile = File(...),
     beam_size: Optional[int] = Query(5, description="Beam size for translation"),
     temperature: Optional[float] = Query(0.0, description="Temperature for sampling"),
+    stream: Optional[bool] = Query(False, description="Stream segments as server-sent events as they are translated"),
 ):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_audio:
-            temp_audio.write(await file.read())
-            temp_audio_path = temp_audio.name
-
-        translate_params = {
-            "beam_size": beam_size,
-            "task": "translate",
-            "temperature": temperature,
-            "vad_filter": True
-        }
-        segments, _ = model.transcribe(temp_audio_path, **translate_params)
-        translation = "".join(segment.text for segment in segments)
-        return JSONResponse(content={"text": translation})
+        return await _run_transcription(
+            file,
+            stream,
+            "translation.segment",
+            beam_size=beam_size,
+            task="translate",
+            temperature=temperature,
+            vad_filter=True,
+        )
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during translation: {str(e)}")
-    finally:
-        os.unlink(temp_audio_path)
 
 @app.post("/v1/embeddings", tags=["Embedding"])
 async def create_embedding(request: EmbeddingRequest):
     try:
-        if isinstance(request.input, list):
-            embeddings_results = [model.embed(text, normalize=request.normalize, truncate=request.truncate) for text in request.input]
-        else:
-            embeddings_results = model.embed(request.input, normalize=request.normalize, truncate=request.truncate)
+        input_texts = request.input if isinstance(request.input, list) else [request.input]
 
-        # Prepare the response data
-        if isinstance(request.input, list):
-            data = [
-                {
-                    "object": "embedding",
-                    "embedding": embedding,
-                    "index": i
-                } for i, embedding in enumerate(embeddings_results)
-            ]
+        # Pack every input into a single embed call, which decodes them as parallel sequences
+        embeddings, total_tokens = await run_inference(
+            model.embed,
+            input_texts,
+            normalize=request.normalize,
+            truncate=request.truncate,
+            return_count=True,
+            return_numpy=True,
+        )
+
+        dtype = np.dtype(np.float16 if request.dtype == "float16" else np.float32).newbyteorder("<")
+        if request.encoding_format == "base64":
+            encoded = [base64.b64encode(embedding.astype(dtype).tobytes()).decode("utf-8") for embedding in embeddings]
         else:
-            data = [
-                {
-                    "object": "embedding",
-                    "embedding": embeddings_results,
-                    "index": 0
-                }
-            ]
+            encoded = [embedding.astype(dtype).tolist() for embedding in embeddings]
 
-        # Calculate token usage
-        input_texts = request.input if isinstance(request.input, list) else [request.input]
-        total_tokens = sum(len(text.split()) for text in input_texts)
+        # Prepare the response data
+        data = [
+            {
+                "object": "embedding",
+                "embedding": embedding,
+                "index": i
+            } for i, embedding in enumerate(encoded)
+        ]
 
-        return {
+        return JSONResponse(content={
             "object": "list",
             "data": data,
             "model": model_path,
@@ -819,7 +1047,9 @@ async def create_embedding(request: EmbeddingRequest):
                 "prompt_tokens": total_tokens,
                 "total_tokens": total_tokens
             }
-        }
+        })
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logging.error(f"Error in embedding generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -859,6 +1089,46 @@ if __name__ == "__main__":
         action="store_true",
         help="Use a Hugging Face model",
     )
+    parser.add_argument(
+        "--prompt_cache",
+        action="store_true",
+        help="Cache KV state of recent prompts in RAM to skip re-evaluating shared prefixes",
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        action="store_true",
+        help="Store computed embeddings on disk and reuse them for repeated inputs",
+    )
+    parser.add_argument(
+        "--n_parallel",
+        type=int,
+        default=1,
+        help="Number of text generation requests decoded together (continuous batching)",
+    )
+    parser.add_argument(
+        "--max_queue_size",
+        type=int,
+        default=64,
+        help="Maximum number of queued requests before new ones are rejected with 429",
+    )
+    parser.add_argument(
+        "--request_timeout",
+        type=float,
+        default=None,
+        help="Seconds before a request times out with 504, including time spent queued",
+    )
+    parser.add_argument(
+        "--draft_model",
+        type=str,
+        default=None,
+        help="Path or identifier of a small model with the same vocabulary to draft tokens for speculative decoding",
+    )
+    parser.add_argument(
+        "--draft_tokens",
+        type=int,
+        default=8,
+        help="Number of tokens drafted per step for speculative decoding",
+    )
     args = parser.parse_args()
     run_nexa_ai_service(
         args.model_path,
@@ -866,6 +1136,13 @@ if __name__ == "__main__":
         model_type_arg=args.model_type,
         huggingface=args.huggingface,
         nctx=args.nctx,
+        prompt_cache=args.prompt_cache,
+        embedding_cache=args.embedding_cache,
+        n_parallel=args.n_parallel,
+        max_queue_size=args.max_queue_size,
+        request_timeout=args.request_timeout,
+        draft_model=args.draft_model,
+        draft_tokens=args.draft_tokens,
         host=args.host,
         port=args.port,
         reload=args.reload
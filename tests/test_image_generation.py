@@ -1,4 +1,5 @@
 from nexa.gguf import NexaImageInference
+from nexa.gguf.sd.stable_diffusion import StableDiffusion
 from tempfile import TemporaryDirectory
 from .utils import download_model
 
@@ -31,7 +32,17 @@ def test_img_to_img():
             sample_steps=2
         )
 
+# Test converting the RGB output buffer of stable-diffusion.cpp to an image
+def test_bytes_to_image():
+    pixels = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (10, 20, 30), (40, 50, 60), (70, 80, 90)]
+    data = bytes(value for pixel in pixels for value in pixel)
+    image = StableDiffusion._bytes_to_image(None, data, 3, 2)
+    assert image.mode == "RGBA"
+    assert image.size == (3, 2)
+    assert [image.getpixel((x, y)) for y in range(2) for x in range(3)] == [pixel + (255,) for pixel in pixels]
+
 # Main execution
 if __name__ == "__main__":
     test_txt_to_img()
     test_img_to_img()
+    test_bytes_to_image()
@@ -1,5 +1,7 @@
+import json
 from nexa.gguf import NexaTextInference
 from nexa.gguf.lib_utils import is_gpu_available
+from nexa.gguf.llama.llama_grammar import LlamaGrammar
 
 model = NexaTextInference(
     model_path="gemma",
@@ -52,6 +54,69 @@ def test_create_chat_completion():
         elif "content" in delta:
             print(delta["content"], end="", flush=True)
 
+# Test grammar constrained completion with logprobs, which must not skip over
+# grammar-forced tokens whose logits are read back
+def test_grammar_logprobs():
+    schema = {
+        "type": "object",
+        "properties": {"planet": {"type": "string"}},
+        "required": ["planet"],
+    }
+    # A few tokens so the completion ends inside the '{"planet": "' the grammar forces
+    for max_tokens in (3, 64):
+        output = model.create_completion(
+            "Q: Name a planet as JSON. A: ",
+            max_tokens=max_tokens,
+            grammar=LlamaGrammar.from_json_schema(json.dumps(schema)),
+            logprobs=0,
+        )
+        logprobs = output["choices"][0]["logprobs"]
+        assert len(logprobs["tokens"]) == len(logprobs["token_logprobs"]) > 0
+
+        chunks = list(model.create_completion(
+            "Q: Name a planet as JSON. A: ",
+            max_tokens=max_tokens,
+            grammar=LlamaGrammar.from_json_schema(json.dumps(schema)),
+            logprobs=0,
+            stream=True,
+        ))
+        assert all(chunk["choices"][0]["logprobs"] is not None for chunk in chunks)
+
+def test_grammar_jump_forward():
+    schema = {
+        "type": "object",
+        "properties": {"planet": {"type": "string"}, "moons": {"type": "integer"}},
+        "required": ["planet", "moons"],
+    }
+    n_forced_tokens = model.model.n_forced_tokens
+    output = model.create_completion(
+        "Q: Name a planet and its number of moons as JSON. A: ",
+        max_tokens=64,
+        grammar=LlamaGrammar.from_json_schema(json.dumps(schema)),
+    )
+    print(output["choices"][0]["text"])
+    # The keys and punctuation between the values are forced by the grammar
+    assert model.model.n_forced_tokens > n_forced_tokens
+
+# Test speculative decoding with a draft model, which must not change greedy output.
+# The draft is the model itself so the vocabularies match.
+def test_draft_model():
+    draft_model = NexaTextInference(
+        model_path="gemma",
+        local_path=None,
+        verbose=False,
+        n_gpu_layers=-1 if is_gpu_available() else 0,
+        chat_format="llama-2",
+        draft_model="gemma",
+        draft_tokens=4,
+    )
+    prompt = "Q: Name the planets in the solar system? A: "
+    expected = model.create_completion(prompt, max_tokens=64, temperature=0.0)
+    output = draft_model.create_completion(prompt, max_tokens=64, temperature=0.0)
+    assert output["choices"][0]["text"] == expected["choices"][0]["text"]
+    assert draft_model.model.n_draft_tokens > 0
+    assert 0 < draft_model.model.n_draft_accepted <= draft_model.model.n_draft_tokens
+
 def test_create_embedding():
     model = NexaTextInference(
         model_path="gemma",
@@ -72,4 +137,10 @@ if __name__ == "__main__":
     print("=== Testing 3 ===")
     test_create_chat_completion()
     print("=== Testing 4 ===")
+    test_grammar_logprobs()
+    print("=== Testing 5 ===")
+    test_grammar_jump_forward()
+    print("=== Testing 6 ===")
+    test_draft_model()
+    print("=== Testing 7 ===")
     test_create_embedding()
\ No newline at end of file